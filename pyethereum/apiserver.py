@@ -8,9 +8,12 @@ from pyethereum.chainmanager import chain_manager
 from pyethereum.peermanager import peer_manager
 import pyethereum.dispatch as dispatch
 from pyethereum.blocks import block_structure, Block
+import pyethereum.blocks
+import pyethereum.transactions
 import pyethereum.signals as signals
 from pyethereum.transactions import Transaction
 import pyethereum.processblock as processblock
+import pyethereum.tracing as tracing
 import pyethereum.utils as utils
 import pyethereum.rlp as rlp
 from ._version import get_versions
@@ -173,13 +176,14 @@ def add_transaction():
         bottle.abort(400, 'Invalid Transaction %s' % tx.hex_hash())
 
 
-def get_transaction_and_block(arg=None):
+def get_transaction_and_block(arg=None, snapshot=None):
+    snapshot = snapshot or chain_manager.snapshot()
     try:
         tx_hash = arg.decode('hex')
     except TypeError:
         bottle.abort(500, 'No hex  %s' % arg)
     try: # index
-        tx, blk = chain_manager.index.get_transaction(tx_hash)
+        tx, blk = snapshot.index.get_transaction(tx_hash)
     except KeyError:
         # try miner
         txs = chain_manager.miner.get_transactions()
@@ -196,13 +200,14 @@ def get_txdetails(arg=None):
     """
     /transactions/<hex>          return transaction by hexhash
     """
-    tx, blk = get_transaction_and_block(arg)
+    snapshot = chain_manager.snapshot()
+    tx, blk = get_transaction_and_block(arg, snapshot)
     tx = tx.to_dict()
     tx['block'] = blk.hex_hash()
-    if not chain_manager.in_main_branch(blk):
+    if not snapshot.in_main_branch(blk):
         tx['confirmations'] = 0
     else:
-        tx['confirmations'] = chain_manager.head.number - blk.number
+        tx['confirmations'] = snapshot.head.number - blk.number
     return dict(transactions=[tx])
 
 
@@ -235,14 +240,17 @@ class TraceLogHandler(logging.Handler):
         self.buffer.append(record)
 
 
-def _get_block_before_tx(txhash):
-    tx, blk = chain_manager.index.get_transaction(txhash.decode('hex'))
+def _get_block_before_tx(txhash, snapshot):
+    tx, blk = snapshot.index.get_transaction(txhash.decode('hex'))
     # get the state we had before this transaction
+    # writes, contract code included, go to the snapshot and are discarded
+    # with it
     test_blk = Block.init_from_parent(blk.get_parent(),
                                         blk.coinbase,
                                         extra_data=blk.extra_data,
                                         timestamp=blk.timestamp,
-                                        uncles=blk.uncles)
+                                        uncles=blk.uncles,
+                                        db=snapshot.db)
     pre_state = test_blk.state_root
     for i in range(blk.transaction_count):
         tx_lst_serialized, sr, _ = blk.get_transaction(i)
@@ -254,27 +262,36 @@ def _get_block_before_tx(txhash):
     return test_blk, tx
 
 
-def get_trace(txhash):
+class TraceCollector(tracing.PBLogger):
+
+    "collects the formatted events instead of logging them"
+
+    def __init__(self):
+        self.log = []
+
+    def emit(self, name, kargs):
+        self.log.append({name: kargs})
+
+
+def get_trace(txhash, collector=None):
     try: # index
-        test_blk, tx = _get_block_before_tx(txhash)
+        test_blk, tx = _get_block_before_tx(txhash, chain_manager.snapshot())
     except (KeyError, TypeError):
         return bottle.abort(404, 'Unknown Transaction  %s' % txhash)
 
     # collect debug output
-    log = []
-    def log_receiver(name, data):
-        log.append({name:data})
-
-    processblock.pblogger.listeners.append(log_receiver)
+    collector = collector or TraceCollector()
+    tracing.tracers.register(collector)
 
     # apply tx (thread? we don't want logs from other invocations)
-    processblock.apply_transaction(test_blk, tx)
-
-    # stop collecting debug output
-    processblock.pblogger.listeners.remove(log_receiver)
+    try:
+        processblock.apply_transaction(test_blk, tx)
+    finally:
+        # stop collecting debug output
+        tracing.tracers.unregister(collector)
 
     # format
-    return dict(tx=txhash, trace=log)
+    return dict(tx=txhash, trace=collector.log)
 
 
 @app.get('/trace/<txhash>')
@@ -294,12 +311,13 @@ def dtrace(params, txhash):
     """
     if len(params) != 4:
         return bottle.abort(404, 'Params must be binary string of length 4')
-    processblock.pblogger.log_apply_op = True
-    processblock.pblogger.log_op = (params[0] != '0')
-    processblock.pblogger.log_stack = (params[1] != '0')
-    processblock.pblogger.log_memory = (params[2] != '0')
-    processblock.pblogger.log_storage = (params[3] != '0')
-    return get_trace(txhash)
+    collector = TraceCollector()
+    collector.log_apply_op = True
+    collector.log_op = (params[0] != '0')
+    collector.log_stack = (params[1] != '0')
+    collector.log_memory = (params[2] != '0')
+    collector.log_storage = (params[3] != '0')
+    return get_trace(txhash, collector)
 
 
 # Fetch state data
@@ -309,7 +327,7 @@ def getacct(addr):
     """
     /acct/<addr>        return account details
     """
-    return chain_manager.head.account_to_dict(addr)
+    return chain_manager.snapshot().head.account_to_dict(addr)
 
 
 @app.get('/storage/<addr>/<index>')
@@ -317,7 +335,7 @@ def getacctdata(addr, index):
     """
     /storage/<addr>/<index>        return storage item
     """
-    return str(chain_manager.head.get_storage_data(addr, int(index)))
+    return str(chain_manager.snapshot().head.get_storage_data(addr, int(index)))
 
 
 @app.get('/dump/<txblkhash>')
@@ -325,11 +343,13 @@ def dump(txblkhash):
     """
     /dump/<hash>        return state dump after transaction or block
     """
+    # reads from a snapshot, so block import can continue in the meantime
+    snapshot = chain_manager.snapshot()
     try:
-        blk = chain_manager.get(txblkhash.decode('hex'))
+        blk = snapshot.get(txblkhash.decode('hex'))
     except:
         try: # index
-            test_blk, tx = _get_block_before_tx(txblkhash)
+            test_blk, tx = _get_block_before_tx(txblkhash, snapshot)
         except (KeyError, TypeError):
             return bottle.abort(404, 'Unknown Transaction  %s' % txblkhash)
         processblock.apply_transaction(test_blk, tx)
@@ -344,12 +364,35 @@ def dump(txblkhash):
 @app.get('/accounts/<address>')
 def account(address=None):
     logger.debug('accounts/%s', address)
-    data = chain_manager.head.account_to_dict(address)
+    data = chain_manager.snapshot().head.account_to_dict(address)
     logger.debug(data)
     return data
 
 
 
+# ######## DB Stats ############
+
+@app.get('/dbstats/')
+def dbstats():
+    """
+    /dbstats/       return write statistics of the chain db
+    """
+    stats = chain_manager.blockchain.stats
+    if not stats:
+        return bottle.abort(404, 'DB stats not enabled, set [misc] db_stats = 1')
+    return dict(dbstats=stats.to_dict())
+
+
+@app.get('/cachestats/')
+def cachestats():
+    """
+    /cachestats/    return hit statistics of the block, code and sender caches
+    """
+    return dict(cachestats=pyethereum.blocks.block_cache.to_dict(),
+                codecache=processblock.code_cache.to_dict(),
+                sendercache=pyethereum.transactions.sender_cache.to_dict())
+
+
 # ######## Peers ###################
 def make_peers_response(peers):
     objs = [dict(ip=ip, port=port, node_id=node_id.encode('hex'))
@@ -2,13 +2,17 @@ import time
 import rlp
 import trie
 import db
+import dbkeys
+from db import DB
+from blockstore import BlockStore
 import utils
 import processblock
 import transactions
 import logging
 import copy
+import itertools
 import sys
-from repoze.lru import lru_cache
+from cache import LRUCache
 
 # logging.basicConfig(level=logging.DEBUG)
 logger = logging.getLogger()
@@ -33,6 +37,10 @@ RECORDING = 1
 NONE = 0
 VERIFYING = -1
 
+# validation levels of Block construction
+TRUSTED = 0   # loaded from the local db, it was validated at import
+VALIDATE = 1  # from the network or newly created, full checks
+
 GENESIS_INITIAL_ALLOC = \
     {"51ba59315b3a95761d0863b05ccc7a7f54703d99": 2 ** 200,  # (G)
      "e6716f9544a56c530d868e4bfbacb172315bdead": 2 ** 200,  # (J)
@@ -106,15 +114,151 @@ class TransientBlock(object):
         self.hash = utils.sha3(rlp.encode(self.header_args))
         self.transaction_list = transaction_list  # rlp encoded transactions
         self.uncles = uncles
+        self._transactions = None
         for i, (name, typ, default) in enumerate(block_structure):
             setattr(self, name, utils.decoders[typ](self.header_args[i]))
 
+    @property
+    def transactions(self):
+        "the decoded transactions, their senders are recovered lazily"
+        if self._transactions is None:
+            self._transactions = [transactions.Transaction.create(tx)
+                                  for tx, s, g in self.transaction_list]
+        return self._transactions
+
     def __repr__(self):
         return '<TransientBlock(#%d %s %s)>' %\
             (self.number, self.hash.encode('hex')[
              :4], self.prevhash.encode('hex')[:4])
 
 
+class BlockHeader(object):
+
+    """
+    Read only header of a stored block, together with the uncle headers
+    and the total difficulty of the chain up to the block (if known).
+    Walking the chain only needs headers, the full block and its state
+    are loaded when get_block is called.
+    """
+
+    def __init__(self, header_args, uncles, total_difficulty=None):
+        self.header_args = header_args
+        self.uncles = uncles
+        self.total_difficulty = total_difficulty
+        self.hash = utils.sha3(rlp.encode(header_args))
+        for i, (name, typ, default) in enumerate(block_structure):
+            setattr(self, name, utils.decoders[typ](header_args[i]))
+
+    @classmethod
+    def from_block(cls, blk, total_difficulty=None):
+        return cls(blk.list_header(), blk.uncles, total_difficulty)
+
+    @classmethod
+    def deserialize(cls, record):
+        header_args, uncles, total_difficulty = rlp.decode(record)
+        return cls(header_args, uncles, utils.decode_int(total_difficulty))
+
+    def serialize(self):
+        "the header record stored by the chain"
+        assert self.total_difficulty is not None
+        return rlp.encode([self.header_args, self.uncles,
+                           utils.encode_int(self.total_difficulty)])
+
+    def chain_difficulty(self):
+        if self.total_difficulty is None:
+            self.total_difficulty = calc_chain_difficulty(self)
+        return self.total_difficulty
+
+    def list_header(self):
+        return self.header_args[:]
+
+    def hex_hash(self):
+        return self.hash.encode('hex')
+
+    def is_genesis(self):
+        return self.prevhash == GENESIS_PREVHASH and \
+            self.nonce == GENESIS_NONCE
+
+    def get_parent_header(self):
+        return _get_parent_header(self)
+
+    def has_parent(self):
+        return _has_parent(self)
+
+    def get_block(self):
+        return get_block(self.hash)
+
+    def __eq__(self, other):
+        return isinstance(other, (Block, BlockHeader)) and self.hash == other.hash
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self.hash)
+
+    def __repr__(self):
+        return '<BlockHeader(#%d %s %s)>' %\
+            (self.number, self.hash.encode('hex')[
+             :4], self.prevhash.encode('hex')[:4])
+
+
+def _get_parent_header(blk):
+    if blk.number == 0:
+        raise UnknownParentException('Genesis block has no parent')
+    try:
+        return get_block_header(blk.prevhash)
+    except KeyError:
+        raise UnknownParentException(blk.prevhash.encode('hex'))
+
+
+def _stored_chain_difficulty(blockhash):
+    "returns the stored total difficulty of a block or None"
+    try:
+        header = get_block_header(blockhash)
+    except KeyError:
+        return None
+    if header.total_difficulty is not None:
+        return header.total_difficulty
+    try:  # chains stored without header records
+        return utils.decode_int(
+            DB(utils.get_db_path()).get(dbkeys.chain_difficulty(blockhash)))
+    except KeyError:
+        return None
+
+
+def calc_chain_difficulty(blk):
+    """
+    total difficulty of the chain up to blk.
+    Ancestors without stored total difficulty are collected first and
+    summed up oldest first, long chains don't hit the recursion limit.
+    """
+    td = _stored_chain_difficulty(blk.hash)
+    if td is not None:
+        return td
+    _idx, _typ, _ = block_structure_rev['difficulty']
+    chain = [blk]
+    while not chain[-1].is_genesis():
+        td = _stored_chain_difficulty(chain[-1].prevhash)
+        if td is not None:
+            break
+        chain.append(chain[-1].get_parent_header())
+    else:
+        td = 0
+    for b in chain:
+        td += b.difficulty
+        td += sum([utils.decoders[_typ](u[_idx]) for u in b.uncles])
+    return td
+
+
+def _has_parent(blk):
+    try:
+        _get_parent_header(blk)
+        return True
+    except UnknownParentException:
+        return False
+
+
 def check_header_pow(header):
     assert len(header[-1]) == 32
     rlp_Hn = rlp.encode(header[:-1])
@@ -124,6 +268,161 @@ def check_header_pow(header):
     return utils.big_endian_to_int(h) < 2 ** 256 / diff
 
 
+def check_header(header, uncles):
+    """
+    context free checks of a serialized header and its uncles, which need
+    neither state nor ancestors (PoW, uncles hash, field encodings, sizes).
+    returns None if they pass, the reason otherwise
+    """
+    if len(header) != len(block_structure):
+        return 'wrong number of header fields'
+    fields = {}
+    for i, (name, typ, default) in enumerate(block_structure):
+        try:
+            fields[name] = utils.decoders[typ](header[i])
+        except Exception:
+            return 'invalid %s' % name
+    if len(fields['extra_data']) > 1024:
+        return 'extra data exceeds 1024 bytes'
+    if fields['coinbase'] == '':
+        return 'empty coinbase'
+    if utils.sha3(rlp.encode(uncles)) != fields['uncles_hash']:
+        return 'uncles hash mismatch'
+    is_genesis = fields['prevhash'] == GENESIS_PREVHASH and \
+        fields['nonce'] == GENESIS_NONCE
+    # same conditions as Block.check_fields
+    if not is_genesis and fields['nonce'] and \
+            (len(fields['nonce']) != 32 or not check_header_pow(header)):
+        return 'invalid PoW'
+    for uncle in uncles:
+        if len(uncle) != len(block_structure) or len(uncle[-1]) != 32 or \
+                not check_header_pow(uncle):
+            return 'invalid uncle PoW'
+    return None
+
+
+class Account(object):
+
+    """
+    Decoded account of a block's state, cached by the block until its
+    state root changes. Changes are journaled by the block, accounts marked
+    dirty are written back by Block.commit_state, deleted ones are removed
+    from the state by it.
+    The code is loaded from the db of the block on first access and stored
+    in it, uncommitted like the state, when the account is encoded.
+    """
+    __slots__ = ['nonce', 'balance', 'storage', 'codehash', '_code',
+                 'storage_cache', '_storage_trie', 'dirty', 'deleted', 'db']
+
+    def __init__(self, db, nonce=0, balance=0, storage=trie.BLANK_ROOT, codehash=''):
+        self.db = db
+        self.nonce = nonce
+        self.balance = balance
+        self.storage = storage  # committed storage root
+        self.codehash = codehash
+        self._code = None
+        self.storage_cache = {}  # index -> value, uncommitted storage
+        self._storage_trie = None
+        self.dirty = False
+        self.deleted = False  # written again it exists again, blank
+
+    @classmethod
+    def decode(cls, db, rlpdata):
+        if not rlpdata:
+            return cls(db)
+        nonce, balance, storage, codehash = rlp.decode(rlpdata)
+        return cls(db, utils.decode_int(nonce), utils.decode_int(balance),
+                   utils.decode_root(storage), codehash)
+
+    def encode(self):
+        if self.codehash is None:
+            self.codehash = ''
+            if self._code:
+                self.codehash = utils.sha3(self._code)
+                self.db.put(self.codehash, self._code)
+        return rlp.encode([utils.encode_int(self.nonce),
+                           utils.encode_int(self.balance),
+                           utils.encode_root(self.storage),
+                           self.codehash])
+
+    def get_code(self):
+        if self._code is None:
+            self._code = self.db.get(self.codehash) if self.codehash else ''
+        return self._code
+
+    def set_code(self, code):
+        self._code = code
+        self.codehash = None
+
+    code = property(get_code, set_code)
+
+    @property
+    def storage_trie(self):
+        "trie of the committed storage"
+        if self._storage_trie is None:
+            self._storage_trie = trie.Trie(self.db, self.storage)
+        return self._storage_trie
+
+    def to_tuple(self):
+        return tuple(getattr(self, name) for name, typ, default in acct_structure)
+
+
+class Journal(object):
+
+    """
+    Undo log of the changes to the cached accounts of a block.
+    Entries are (account, attribute, storage index or None, previous value).
+    A checkpoint is a position in the log: reverting to it undoes the newer
+    changes, while a nested frame that succeeds simply keeps its entries,
+    so they are undone together with the enclosing frame.
+    Deleting an account is journaled as well, so no commit is needed while
+    a message runs.
+    """
+    __slots__ = ['entries']
+
+    def __init__(self):
+        self.entries = []
+
+    def set(self, acct, name, value):
+        if acct.deleted:
+            self.entries.append((acct, 'deleted', None, True))
+            acct.deleted = False
+        prev = getattr(acct, name)
+        if prev != value:
+            self.entries.append((acct, name, None, prev))
+            setattr(acct, name, value)
+
+    def set_storage(self, acct, index, value):
+        if acct.deleted:
+            self.entries.append((acct, 'deleted', None, True))
+            acct.deleted = False
+        prev = acct.storage_cache.get(index)
+        if prev != value:
+            self.entries.append((acct, None, index, prev))
+            acct.storage_cache[index] = value
+
+    def checkpoint(self):
+        return len(self.entries)
+
+    def clear(self):
+        "the changes are committed"
+        self.entries = []
+
+    def revert(self, checkpoint):
+        entries = self.entries
+        while len(entries) > checkpoint:
+            acct, name, index, prev = entries.pop()
+            if name is not None:
+                setattr(acct, name, prev)
+            elif prev is None:
+                del acct.storage_cache[index]
+            else:
+                acct.storage_cache[index] = prev
+
+    def __len__(self):
+        return len(self.entries)
+
+
 class Block(object):
 
     def __init__(self,
@@ -139,7 +438,9 @@ class Block(object):
                  gas_used=0, timestamp=0, extra_data='', nonce='',
                  transaction_list=[],
                  uncles=[],
-                 header=None):
+                 header=None,
+                 db=None,
+                 validation=VALIDATE):
 
         self.prevhash = prevhash
         self.uncles_hash = uncles_hash
@@ -155,31 +456,38 @@ class Block(object):
         self.uncles = uncles
         self.suicides = []
         self.postqueue = []
-        self.caches = {
-            'balance': {},
-            'nonce': {},
-            'code': {},
-            'all': {}
-        }
-        self.journal = []
-
-        self.transactions = trie.Trie(utils.get_db_path(), tx_list_root)
-        self.transaction_count = 0
-
-        self.state = trie.Trie(utils.get_db_path(), state_root)
+        self.accounts = {}  # binary address -> Account
+        self.journal = Journal()
+        self.db = db or DB(utils.get_db_path())
+
+        # [[tx_lst_serialized, state_root, gas_used_encoded],...]
+        # the trie holds the first _tx_trie_count of them, see _sync_tx_trie
+        self._transaction_list = []
+        self._tx_trie = trie.Trie(self.db, tx_list_root)
+        self._tx_trie_count = 0
+
+        self.state = trie.Trie(self.db, state_root)
         self.proof_mode = None
         self.proof_nodes = []
 
-        if transaction_list:
+        if transaction_list and validation == TRUSTED:
+            # the transaction trie was stored together with the block
+            self._transaction_list = list(transaction_list)
+            self._tx_trie_count = len(transaction_list)
+        elif transaction_list:
             # support init with transactions only if state is known
             assert self.state.root_hash_valid()
+            self._tx_trie = trie.Trie(self.db, trie.BLANK_ROOT)
             for tx_lst_serialized, state_root, gas_used_encoded \
                     in transaction_list:
                 self._add_transaction_to_list(
                     tx_lst_serialized, state_root, gas_used_encoded)
 
         # make sure we are all on the same db
-        assert self.state.db.db == self.transactions.db.db
+        assert self.state.db.db == self._tx_trie.db.db
+
+        if validation == TRUSTED:
+            return
 
         # use de/encoders to check type and validity
         for name, typ, d in block_structure:
@@ -190,7 +498,7 @@ class Block(object):
         if not self.state.root_hash_valid():
             raise Exception(
                 "State Merkle root not found in database! %r" % self)
-        if tx_list_root != self.transactions.root_hash:
+        if tx_list_root != self.tx_list_root:
             raise Exception("Transaction list root hash does not match!")
         if not self.transactions.root_hash_valid():
             raise Exception(
@@ -212,7 +520,7 @@ class Block(object):
         # Uncle can have a block from 2-7 blocks ago as its parent
         for i in [1, 2, 3, 4, 5, 6, 7]:
             if ancestor_chain[-1].number > 0:
-                ancestor_chain.append(ancestor_chain[-1].get_parent())
+                ancestor_chain.append(ancestor_chain[-1].get_parent_header())
         ineligible = []
         # Uncles of this block cannot be direct ancestors and cannot also
         # be uncles included 1-6 blocks ago
@@ -258,13 +566,20 @@ class Block(object):
         return kargs
 
     @classmethod
-    def deserialize(cls, rlpdata):
+    def deserialize(cls, rlpdata, validation=VALIDATE, txs=None):
+        """
+        txs: the transactions of the block, decoded before
+             (e.g. with the senders recovered in a batch)
+        """
         header_args, transaction_list, uncles = rlp.decode(rlpdata)
         kargs = cls.deserialize_header(header_args)
         kargs['header'] = header_args
         kargs['transaction_list'] = transaction_list
         kargs['uncles'] = uncles
 
+        if validation == TRUSTED:  # state and transactions are stored
+            return Block(validation=TRUSTED, **kargs)
+
         # if we don't have the state we need to replay transactions
         _db = db.DB(utils.get_db_path())
         if len(kargs['state_root']) == 32 and kargs['state_root'] in _db:
@@ -276,9 +591,9 @@ class Block(object):
                 parent = get_block(kargs['prevhash'])
             except KeyError:
                 raise UnknownParentException(kargs['prevhash'].encode('hex'))
-            return parent.deserialize_child(rlpdata)
+            return parent.deserialize_child(rlpdata, txs)
 
-    def deserialize_child(self, rlpdata):
+    def deserialize_child(self, rlpdata, txs=None):
         """
         deserialization w/ replaying transactions
         """
@@ -295,12 +610,19 @@ class Block(object):
                                        uncles=uncles)
 
         # replay transactions
-        for tx_lst_serialized, _state_root, _gas_used_encoded in \
-                transaction_list:
-            tx = transactions.Transaction.create(tx_lst_serialized)
+        if txs is None:
+            txs = [transactions.Transaction.create(tx_lst_serialized)
+                   for tx_lst_serialized, s, g in transaction_list]
+        assert len(txs) == len(transaction_list)
+        import parallel  # imports blocks
+        if parallel.pool is None or processblock.tracers.enabled:
+            applied = (processblock.apply_transaction(block, tx) for tx in txs)
+        else:
+            applied = parallel.replay(block, txs, parallel.pool)
+        for (tx_lst_serialized, _state_root, _gas_used_encoded), \
+                (success, output) in itertools.izip(transaction_list, applied):
 #            logger.debug('state:\n%s', utils.dump_state(block.state))
 #            logger.debug('applying %r', tx)
-            success, output = processblock.apply_transaction(block, tx)
             #block.add_transaction_to_list(tx) # < this is done by processblock
 #            logger.debug('state:\n%s', utils.dump_state(block.state))
             logger.debug('d %s %s', _gas_used_encoded, block.gas_used)
@@ -337,22 +659,16 @@ class Block(object):
     def hex_deserialize(cls, hexrlpdata):
         return cls.deserialize(hexrlpdata.decode('hex'))
 
-    def mk_blank_acct(self):
-        if not hasattr(self, '_blank_acct'):
-            codehash = ''
-            self.state.db.put(codehash, '')
-            self._blank_acct = [utils.encode_int(0),
-                                utils.encode_int(0),
-                                trie.BLANK_ROOT,
-                                codehash]
-        return self._blank_acct[:]
+    def _get_account(self, address):
+        "address must be binary, see utils.normalize_address"
+        acct = self.accounts.get(address)
+        if acct is None:
+            acct = Account.decode(self.db, self.state.get(address))
+            self.accounts[address] = acct
+        return acct
 
     def get_acct(self, address):
-        if len(address) == 40:
-            address = address.decode('hex')
-        acct = rlp.decode(self.state.get(address)) or self.mk_blank_acct()
-        return tuple(utils.decoders[t](acct[i])
-                     for i, (n, t, d) in enumerate(acct_structure))
+        return self._get_account(utils.normalize_address(address)).to_tuple()
 
     # _get_acct_item(bin or hex, int) -> bin
     def _get_acct_item(self, address, param):
@@ -360,9 +676,7 @@ class Block(object):
         :param address: account address, can be binary or hex string
         :param param: parameter to get
         '''
-        if param != 'storage' and address in self.caches[param]:
-            return self.caches[param][address]
-        return self.get_acct(address)[acct_structure_rev[param][0]]
+        return getattr(self._get_account(utils.normalize_address(address)), param)
 
     # _set_acct_item(bin or hex, int, bin)
     def _set_acct_item(self, address, param, value):
@@ -372,14 +686,9 @@ class Block(object):
         :param value: new value
         '''
 #        logger.debug('set acct %r %r %d', address, param, value)
-        self.set_and_journal(param, address, value)
-        self.set_and_journal('all', address, value)
-
-    def set_and_journal(self, cache, index, value):
-        prev = self.caches[cache].get(index, None)
-        if prev != value:
-            self.journal.append([cache, index, prev, value])
-            self.caches[cache][index] = value
+        acct = self._get_account(utils.normalize_address(address))
+        self.journal.set(acct, param, value)
+        self.journal.set(acct, 'dirty', True)
 
     # _delta_item(bin or hex, int, int) -> success/fail
     def _delta_item(self, address, param, value):
@@ -398,28 +707,42 @@ class Block(object):
                                  state_root, gas_used_encoded):
         # adds encoded data # FIXME: the constructor should get objects
         assert isinstance(tx_lst_serialized, list)
-        data = [tx_lst_serialized, state_root, gas_used_encoded]
-        self.transactions.update(
-            rlp.encode(utils.encode_int(self.transaction_count)),
-            rlp.encode(data))
-        self.transaction_count += 1
+        self._transaction_list.append(
+            [tx_lst_serialized, state_root, gas_used_encoded])
+
+    def _sync_tx_trie(self):
+        "adds the transactions which are not yet in the trie in one batch"
+        if self._tx_trie_count > len(self._transaction_list):  # reverted
+            self._tx_trie = trie.Trie(self.db, trie.BLANK_ROOT)
+            self._tx_trie_count = 0
+        for i in range(self._tx_trie_count, len(self._transaction_list)):
+            self._tx_trie.update(rlp.encode(utils.encode_int(i)),
+                                 rlp.encode(self._transaction_list[i]))
+        self._tx_trie_count = len(self._transaction_list)
+
+    @property
+    def transactions(self):
+        "the transaction trie"
+        self._sync_tx_trie()
+        return self._tx_trie
+
+    @property
+    def transaction_count(self):
+        return len(self._transaction_list)
 
     def add_transaction_to_list(self, tx):
-        tx_lst_serialized = rlp.decode(tx.serialize())
+        tx_lst_serialized = tx.list_serialize()
         self._add_transaction_to_list(tx_lst_serialized,
                                       self.state_root,
                                       utils.encode_int(self.gas_used))
 
     def _list_transactions(self):
         # returns [[tx_lst_serialized, state_root, gas_used_encoded],...]
-        txlist = []
-        for i in range(self.transaction_count):
-            txlist.append(self.get_transaction(i))
-        return txlist
+        return self._transaction_list[:]
 
     def get_transaction(self, num):
         # returns [tx_lst_serialized, state_root, gas_used_encoded]
-        return rlp.decode(self.transactions.get(rlp.encode(utils.encode_int(num))))
+        return self._transaction_list[num]
 
     def get_transactions(self):
         return [transactions.Transaction.create(tx) for
@@ -460,13 +783,13 @@ class Block(object):
 
     def get_storage(self, address):
         storage_root = self._get_acct_item(address, 'storage')
-        return trie.Trie(utils.get_db_path(), storage_root)
+        return trie.Trie(self.db, storage_root)
 
     def get_storage_data(self, address, index):
-        if 'storage:'+address in self.caches:
-            if index in self.caches['storage:'+address]:
-                return self.caches['storage:'+address][index]
-        t = self.get_storage(address)
+        acct = self._get_account(utils.normalize_address(address))
+        if index in acct.storage_cache:
+            return acct.storage_cache[index]
+        t = acct.storage_trie
         t.proof_mode = self.proof_mode
         t.proof_nodes = self.proof_nodes
         key = utils.zpad(utils.coerce_to_bytes(index), 32)
@@ -476,65 +799,76 @@ class Block(object):
         return utils.big_endian_to_int(val) if val else 0
 
     def set_storage_data(self, address, index, val):
-        if 'storage:'+address not in self.caches:
-            self.caches['storage:'+address] = {}
-            self.set_and_journal('all', address, True)
-        self.set_and_journal('storage:'+address, index, val)
+        acct = self._get_account(utils.normalize_address(address))
+        self.journal.set(acct, 'dirty', True)
+        self.journal.set_storage(acct, index, val)
 
     def commit_state(self):
+        """
+        writes the dirty accounts to the state trie. The accounts stay
+        cached, unless a proof is recorded or verified.
+        """
         if not len(self.journal):
             return
-        for address in self.caches['all']:
-            acct = rlp.decode(self.state.get(address.decode('hex'))) \
-                or self.mk_blank_acct()
-            for i, (key, typ, default) in enumerate(acct_structure):
-                if key == 'storage':
-                    t = trie.Trie(utils.get_db_path(), acct[i])
-                    t.proof_mode = self.proof_mode
-                    t.proof_nodes = self.proof_nodes
-                    for k, v in self.caches.get('storage:'+address, {}).iteritems():
-                        enckey = utils.zpad(utils.coerce_to_bytes(k), 32)
-                        val = rlp.encode(utils.int_to_big_endian(v))
-                        if v:
-                            t.update(enckey, val)
-                        else:
-                            t.delete(enckey)
-                    acct[i] = t.root_hash
-                    if self.proof_mode == RECORDING:
-                        self.proof_nodes.extend(t.proof_nodes)
-                else:
-                    if address in self.caches[key]:
-                        v = self.caches[key].get(address, default)
-                        acct[i] = utils.encoders[acct_structure[i][1]](v)
-            self.state.update(address.decode('hex'), rlp.encode(acct))
+        deleted = []
+        for address, acct in self.accounts.iteritems():
+            if not acct.dirty:
+                continue
+            acct.dirty = False
+            if acct.deleted:
+                self.state.delete(address)
+                deleted.append(address)
+                continue
+            if acct.storage_cache:
+                t = acct.storage_trie
+                t.proof_mode = self.proof_mode
+                t.proof_nodes = self.proof_nodes
+                for k, v in acct.storage_cache.iteritems():
+                    enckey = utils.zpad(utils.coerce_to_bytes(k), 32)
+                    val = rlp.encode(utils.int_to_big_endian(v))
+                    if v:
+                        t.update(enckey, val)
+                    else:
+                        t.delete(enckey)
+                acct.storage = t.root_hash
+                acct.storage_cache = {}
+                if self.proof_mode == RECORDING:
+                    self.proof_nodes.extend(t.proof_nodes)
+            self.state.update(address, acct.encode())
+        for address in deleted:
+            del self.accounts[address]
         if self.proof_mode == RECORDING:
             self.proof_nodes.extend(self.state.proof_nodes)
             self.state.proof_nodes = []
-        self.reset_cache()
+        self.journal.clear()
+        if self.proof_mode:
+            self.accounts = {}
 
     def del_account(self, address):
-        self.commit_state()
-        if len(address) == 40:
-            address = address.decode('hex')
-        self.state.delete(address)
+        "blanks the account, commit_state deletes it from the state"
+        acct = self._get_account(utils.normalize_address(address))
+        for name, value in (('nonce', 0), ('balance', 0), ('code', ''),
+                            ('storage', trie.BLANK_ROOT), ('storage_cache', {}),
+                            ('_storage_trie', None), ('dirty', True)):
+            self.journal.set(acct, name, value)
+        self.journal.set(acct, 'deleted', True)
 
     def account_to_dict(self, address, with_storage_root=False, with_storage=True):
         if with_storage_root:
             assert len(self.journal) == 0
         med_dict = {}
-        for i, val in enumerate(self.get_acct(address)):
-            name, typ, default = acct_structure[i]
-            key = acct_structure[i][0]
+        acct = self._get_account(utils.normalize_address(address))
+        for name, typ, default in acct_structure:
             if name == 'storage':
-                strie = trie.Trie(utils.get_db_path(), val)
+                strie = trie.Trie(self.db, acct.storage)
                 if with_storage_root:
                     med_dict['storage_root'] = strie.get_root_hash().encode('hex')
             else:
-                med_dict[key] = self.caches[key].get(address, utils.printers[typ](val))
+                med_dict[name] = utils.printers[typ](getattr(acct, name))
         if with_storage:
             med_dict['storage'] = {}
             d = strie.to_dict()
-            subcache = self.caches.get('storage:'+address, {})
+            subcache = acct.storage_cache
             subkeys = [utils.zpad(utils.coerce_to_bytes(kk), 32) for kk in subcache.keys()]
             for k in d.keys() + subkeys:
                 v = d.get(k, None)
@@ -548,46 +882,35 @@ class Block(object):
         return med_dict
 
     def reset_cache(self):
-        self.caches = {
-            'all': {},
-            'balance': {},
-            'nonce': {},
-            'code': {},
-        }
-        self.journal = []
+        self.accounts = {}
+        self.journal = Journal()
 
     # Revert computation
     def snapshot(self):
-        return {
-            'state': self.state.root_hash,
-            'gas': self.gas_used,
-            'txs': self.transactions,
-            'txcount': self.transaction_count,
-            'postqueue': copy.copy(self.postqueue),
-            'suicides': self.suicides,
-            'suicides_size': len(self.suicides),
-            'journal': self.journal,  # pointer to reference, so is not static
-            'journal_size': len(self.journal)
-        }
-
-    def revert(self, mysnapshot):
-        self.journal = mysnapshot['journal']
-        logger.debug('reverting')
-        while len(self.journal) > mysnapshot['journal_size']:
-            cache, index, prev, post = self.journal.pop()
-            logger.debug('%r %r %r %r', cache, index, prev, post)
-            if prev is not None:
-                self.caches[cache][index] = prev
-            else:
-                del self.caches[cache][index]
-        self.suicides = mysnapshot['suicides']
-        while len(self.suicides) > mysnapshot['suicides_size']:
-            self.suicides.pop()
-        self.state.root_hash = mysnapshot['state']
-        self.gas_used = mysnapshot['gas']
-        self.transactions = mysnapshot['txs']
-        self.transaction_count = mysnapshot['txcount']
-        self.postqueue = mysnapshot['postqueue']
+        """
+        constant time checkpoint of the block for revert.
+        The post queue and the suicides are only appended to while a
+        message runs, so their lengths are recorded instead of copies.
+        A snapshot which is not reverted needs no cleanup.
+        """
+        return (self.state.root_hash, self.gas_used, len(self._transaction_list),
+                self.postqueue, len(self.postqueue),
+                self.suicides, len(self.suicides), self.journal.checkpoint())
+
+    def revert(self, snapshot):
+        state_root, gas_used, txcount, postqueue, postqueue_size, \
+            suicides, suicides_size, checkpoint = snapshot
+        self.journal.revert(checkpoint)
+        if self.state.root_hash != state_root:
+            # reverted beyond a commit, the cached accounts are newer
+            self.reset_cache()
+        del suicides[suicides_size:]
+        self.suicides = suicides
+        del postqueue[postqueue_size:]
+        self.postqueue = postqueue
+        self.state.root_hash = state_root
+        self.gas_used = gas_used
+        del self._transaction_list[txcount:]
 
     def finalize(self):
         """
@@ -611,13 +934,14 @@ class Block(object):
         return self.state.root_hash
 
     def set_state_root(self, state_root_hash):
-        self.state = trie.Trie(utils.get_db_path(), state_root_hash)
+        self.state = trie.Trie(self.db, state_root_hash)
         self.reset_cache()
 
     state_root = property(get_state_root, set_state_root)
 
     def get_tx_list_root(self):
-        return self.transactions.root_hash
+        self._sync_tx_trie()
+        return self._tx_trie.root_hash
 
     tx_list_root = property(get_tx_list_root)
 
@@ -657,13 +981,11 @@ class Block(object):
         for name, typ, default in block_structure:
             b[name] = utils.printers[typ](getattr(self, name))
         txlist = []
-        for i in range(self.transaction_count):
-            tx_rlp = self.transactions.get(rlp.encode(utils.encode_int(i)))
-            tx, msr, gas = rlp.decode(tx_rlp)
+        for tx, msr, gas in self._transaction_list:
             if full_transactions:
                 txjson = transactions.Transaction.create(tx).to_dict()
             else:
-                txjson = utils.sha3(rlp.descend(tx_rlp, 0)).encode('hex')  # tx hash
+                txjson = utils.sha3(rlp.encode(tx)).encode('hex')  # tx hash
             txlist.append({
                 "tx": txjson,
                 "medstate": msr.encode('hex'),
@@ -702,29 +1024,17 @@ class Block(object):
         #assert parent.state.db.db == self.state.db.db
         return parent
 
+    def get_parent_header(self):
+        return _get_parent_header(self)
+
     def has_parent(self):
-        try:
-            self.get_parent()
-            return True
-        except UnknownParentException:
-            return False
+        return _has_parent(self)
 
     def chain_difficulty(self):
-        # calculate the summarized_difficulty
-        if self.is_genesis():
-            return self.difficulty
-        elif 'difficulty:'+self.hex_hash() in self.state.db:
-            return utils.decode_int(
-                self.state.db.get('difficulty:'+self.hex_hash()))
-        else:
-            _idx, _typ, _ = block_structure_rev['difficulty']
-            o = self.difficulty + self.get_parent().chain_difficulty()
-            o += sum([utils.decoders[_typ](u[_idx]) for u in self.uncles])
-            self.state.db.put('difficulty:'+self.hex_hash(), utils.encode_int(o))
-            return o
+        return calc_chain_difficulty(self)
 
     def __eq__(self, other):
-        return isinstance(other, (Block, CachedBlock)) and self.hash == other.hash
+        return isinstance(other, (Block, CachedBlock, BlockHeader)) and self.hash == other.hash
 
     def __ne__(self, other):
         return not self.__eq__(other)
@@ -742,8 +1052,8 @@ class Block(object):
 
     @classmethod
     def init_from_parent(cls, parent, coinbase, extra_data='',
-                         timestamp=int(time.time()), uncles=[]):
-        return Block(
+                         timestamp=int(time.time()), uncles=[], db=None):
+        return cls(
             prevhash=parent.hash,
             uncles_hash=utils.sha3(rlp.encode(uncles)),
             coinbase=coinbase,
@@ -758,18 +1068,38 @@ class Block(object):
             extra_data=extra_data,
             nonce='',
             transaction_list=[],
-            uncles=uncles)
+            uncles=uncles,
+            db=db or parent.db)
 
     def set_proof_mode(self, pm, pmnodes=None):
+        # cached accounts would be missing in the proof
+        self.commit_state()
+        self.reset_cache()
         self.proof_mode = pm
         self.state.proof_mode = pm
         self.proof_nodes = pmnodes or []
         self.state.proof_nodes = pmnodes or []
 
 
+    def at_snapshot(self, snapshot):
+        """
+        returns a read only copy of the block, which reads its state and
+        transactions from `snapshot` (see `db.DB.snapshot`)
+        """
+        blk = copy.copy(self)
+        blk.db = snapshot
+        blk.state = trie.Trie(snapshot, self.state.root_hash)
+        blk._tx_trie = trie.Trie(snapshot, self.tx_list_root)
+        blk.suicides = []
+        blk.postqueue = []
+        blk.reset_cache()
+        return CachedBlock.create_cached(blk)
+
+
 class CachedBlock(Block):
     # note: immutable refers to: do not manipulate!
     _hash_cached = None
+    _chain_difficulty_cached = None
 
     def _set_acct_item(self): raise Exception('NotImplemented')
     def _add_transaction_to_list(self): raise Exception('NotImplemented')
@@ -782,22 +1112,142 @@ class CachedBlock(Block):
             self._hash_cached = Block._hash(self)
         return self._hash_cached
 
+    def chain_difficulty(self):
+        if self._chain_difficulty_cached is None:
+            self._chain_difficulty_cached = Block.chain_difficulty(self)
+        return self._chain_difficulty_cached
+
     @classmethod
     def create_cached(cls, blk):
         blk.__class__ = CachedBlock
         return blk
 
-@lru_cache(500)
+def get_blockstore():
+    return BlockStore(utils.get_blockstore_path(), DB(utils.get_db_path()))
+
+
+def get_block_rlp(blockhash):
+    """
+    returns the serialized block, either as buffer on the blockstore
+    or as string for blocks stored in the db before the blockstore
+    """
+    store = get_blockstore()
+    if blockhash in store:
+        return store.get(blockhash)
+    return store.db.get(blockhash)
+
+
+class BlockCache(object):
+
+    """
+    Tiered cache of loaded blocks and headers.
+
+    pinned:  headers of the canonical chain up to max_pinned blocks below
+             the head and the head block itself, never evicted
+    headers: LRU of other headers, bounded by number
+    blocks:  LRU of deserialized blocks, bounded by the summed size of
+             their serialization
+    """
+
+    def __init__(self, max_bytes=32 * 1024 ** 2, max_headers=8192, max_pinned=256):
+        self.blocks = LRUCache(max_bytes)
+        self.headers = LRUCache(max_headers)
+        self.max_pinned = max_pinned
+        self.pinned = dict()  # hash -> header
+        self.pinned_chain = []  # headers, oldest first
+        self.head = None
+        self.pinned_hits = 0
+
+    def get_block(self, blockhash):
+        head = self.head
+        if head is not None and head.hash == blockhash:
+            self.pinned_hits += 1
+            return head
+        return self.blocks.get(blockhash)
+
+    def put_block(self, blk, size):
+        self.blocks.put(blk.hash, blk, size)
+
+    def get_header(self, blockhash):
+        header = self.pinned.get(blockhash)
+        if header is not None:
+            self.pinned_hits += 1
+            return header
+        return self.headers.get(blockhash)
+
+    def put_header(self, header):
+        if header.hash not in self.pinned:
+            self.headers.put(header.hash, header)
+
+    def pin_head(self, head):
+        "pins the head block and the headers of the canonical chain below it"
+        chain = self.pinned_chain
+        if chain and chain[-1].hash == head.prevhash:
+            chain = chain + [get_block_header(head.hash)]
+        else:  # new chain or reorg
+            chain = [get_block_header(head.hash)]
+            while len(chain) < self.max_pinned and chain[-1].has_parent():
+                chain.append(chain[-1].get_parent_header())
+            chain.reverse()
+        chain = chain[-self.max_pinned:]
+        self.pinned = dict((h.hash, h) for h in chain)
+        self.pinned_chain = chain
+        self.head = head
+
+    def clear(self):
+        self.blocks.clear()
+        self.headers.clear()
+        self.pinned, self.pinned_chain, self.head = dict(), [], None
+
+    def to_dict(self):
+        return dict(blocks=self.blocks.to_dict(), headers=self.headers.to_dict(),
+                    pinned=dict(entries=len(self.pinned), hits=self.pinned_hits))
+
+
+block_cache = BlockCache()
+
+
+def configure_cache(max_bytes, max_headers, max_pinned):
+    global block_cache
+    block_cache = BlockCache(max_bytes, max_headers, max_pinned)
+    return block_cache
+
+
 def get_block(blockhash):
     """
     Assumtion: blocks loaded from the db are not manipulated
                 -> can be cached including hash
     """
-    return CachedBlock.create_cached(Block.deserialize(db.DB(utils.get_db_path()).get(blockhash)))
+    blk = block_cache.get_block(blockhash)
+    if blk is None:
+        rlpdata = get_block_rlp(blockhash)
+        blk = Block.deserialize(str(rlpdata), validation=TRUSTED)
+        blk = CachedBlock.create_cached(blk)
+        blk._hash_cached = blockhash
+        block_cache.put_block(blk, len(rlpdata))
+    return blk
+
+
+def get_block_header(blockhash):
+    """
+    returns the BlockHeader of a stored block without loading its body,
+    raises KeyError for unknown blocks
+    """
+    header = block_cache.get_header(blockhash)
+    if header is None:
+        try:
+            header = BlockHeader.deserialize(
+                DB(utils.get_db_path()).get(dbkeys.header(blockhash)))
+        except KeyError:  # stored without header record
+            header_args, _, uncles = rlp.decode(str(get_block_rlp(blockhash)))
+            header = BlockHeader(header_args, uncles)
+        block_cache.put_header(header)
+    return header
 
 
 def has_block(blockhash):
-    return blockhash in db.DB(utils.get_db_path())
+    store = get_blockstore()
+    return blockhash in store or blockhash in store.db
 
 
 def genesis(start_alloc=GENESIS_INITIAL_ALLOC, difficulty=INITIAL_DIFFICULTY):
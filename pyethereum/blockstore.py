@@ -0,0 +1,109 @@
+"""
+Append only store for serialized blocks.
+
+Blocks never change once they are stored, so they don't need to go through
+the compactions of the chain db. They are appended to segment files instead,
+which are memory mapped for reading. The location (segment, offset, length)
+of a block is indexed by its hash in the chain db, the index is committed
+together with the chain. Data appended without a committed index (e.g. after
+a crash) is never referenced and only wastes space.
+"""
+import os
+import mmap
+import struct
+import threading
+import logging
+import dbkeys
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SIZE = 64 * 1024 * 1024
+SEGMENT_NAME = '%08d.seg'
+
+# path -> shared segment state, see BlockStore
+segments = {}
+
+
+class _Segments(object):
+
+    def __init__(self, path, segment_size):
+        if not os.path.exists(path):
+            os.makedirs(path)
+        self.path = path
+        self.segment_size = segment_size
+        self.lock = threading.Lock()
+        self.maps = dict()  # segment -> mmap
+        existing = sorted(int(f.split('.')[0]) for f in os.listdir(path)
+                          if f.endswith('.seg'))
+        self._open_for_append(existing[-1] if existing else 0)
+
+    def _filename(self, segment):
+        return os.path.join(self.path, SEGMENT_NAME % segment)
+
+    def _open_for_append(self, segment):
+        self.segment = segment
+        self.file = open(self._filename(segment), 'ab')
+        self.file.seek(0, os.SEEK_END)
+        self.size = self.file.tell()
+
+    def append(self, data):
+        with self.lock:
+            if self.size and self.size + len(data) > self.segment_size:
+                self.file.close()
+                self._open_for_append(self.segment + 1)
+                logger.debug('new block segment %d', self.segment)
+            location = (self.segment, self.size, len(data))
+            self.file.write(data)
+            self.file.flush()
+            self.size += len(data)
+            return location
+
+    def read(self, segment, offset, length):
+        "returns a buffer on the mapped segment"
+        with self.lock:
+            m = self.maps.get(segment)
+            if m is None or len(m) < offset + length:
+                # the segment grew since it was mapped.
+                # buffers on the old map keep it alive until they are released
+                with open(self._filename(segment), 'rb') as f:
+                    m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self.maps[segment] = m
+        return buffer(m, offset, length)
+
+
+class BlockStore(object):
+
+    """
+    Serialized blocks by hash, backed by the segments at path
+    and the location index in db.
+    """
+
+    def __init__(self, path, db, segment_size=SEGMENT_SIZE):
+        path = os.path.abspath(path)
+        if path not in segments:
+            logger.debug('Opening block store @%r', path)
+            segments[path] = _Segments(path, segment_size)
+        self.segments = segments[path]
+        self.db = db
+
+    def put(self, blockhash, data):
+        key = dbkeys.block_location(blockhash)
+        if key in self.db:
+            return
+        location = self.segments.append(data)
+        self.db.put(key, struct.pack('>IQI', *location))
+
+    def get(self, blockhash):
+        """
+        returns a read only buffer of the serialized block,
+        raises KeyError if the block is not in the store
+        """
+        location = self.db.get(dbkeys.block_location(blockhash))
+        return self.segments.read(*struct.unpack('>IQI', location))
+
+    def __contains__(self, blockhash):
+        return dbkeys.block_location(blockhash) in self.db
+
+    def __repr__(self):
+        return '<BlockStore %s segment:%d size:%d>' % \
+            (self.segments.path, self.segments.segment, self.segments.size)
@@ -0,0 +1,100 @@
+"""
+Size bounded LRU cache with hit statistics.
+
+Entries are put with a size (default 1) and the least recently used ones
+are evicted once the summed size exceeds max_size, so the same class
+bounds a cache by number of entries or by bytes.
+"""
+import threading
+from collections import OrderedDict
+
+
+class LRUCache(object):
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.size = 0
+        self.lock = threading.Lock()
+        self._data = OrderedDict()  # key -> (value, size), oldest first
+        self.hits = self.misses = self.evictions = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._data[key] = (value, size)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, size=1):
+        with self.lock:
+            if key in self._data:
+                self.size -= self._data.pop(key)[1]
+            if size > self.max_size:
+                return
+            self._data[key] = (value, size)
+            self.size += size
+            self._evict()
+
+    def resize(self, key, size):
+        "sets the size of an entry, e.g. of a value which grew"
+        with self.lock:
+            if key not in self._data:
+                return
+            value, old = self._data[key]
+            if size == old:
+                return
+            self.size -= old
+            if size > self.max_size:
+                del self._data[key]
+                self.evictions += 1
+                return
+            self._data[key] = (value, size)  # keeps its position
+            self.size += size
+            self._evict()
+
+    def _evict(self):
+        while self.size > self.max_size:
+            k, (v, s) = self._data.popitem(last=False)
+            self.size -= s
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self._data:
+                return default
+            value, size = self._data.pop(key)
+            self.size -= size
+            return value
+
+    def clear(self):
+        with self.lock:
+            self._data.clear()
+            self.size = 0
+
+    def keys(self):
+        "oldest first"
+        with self.lock:
+            return self._data.keys()
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __len__(self):
+        return len(self._data)
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.
+
+    def to_dict(self):
+        return dict(entries=len(self), size=self.size, max_size=self.max_size,
+                    hits=self.hits, misses=self.misses,
+                    evictions=self.evictions, hit_rate=self.hit_rate())
+
+    def __repr__(self):
+        return '<LRUCache entries=%d size=%d/%d hit_rate=%.2f>' % \
+            (len(self), self.size, self.max_size, self.hit_rate())
@@ -1,16 +1,22 @@
 import logging
 import time
 import os
+import itertools
+import multiprocessing
 from operator import attrgetter
 from dispatch import receiver
 from stoppable import StoppableLoopThread
 import signals
-from db import DB
+from db import DB, enable_stats as enable_db_stats, enable_async_commit
+from blockstore import BlockStore
 import utils
 import rlp
 import blocks
+import dbkeys
 import processblock
+import parallel
 from transactions import Transaction
+import transactions
 from miner import Miner
 from synchronizer import Synchronizer
 
@@ -22,6 +28,31 @@ logger = logging.getLogger(__name__)
 rlp_hash_hex = lambda data: utils.sha3(rlp.encode(data)).encode('hex')
 
 NUM_BLOCKS_PER_REQUEST = 256 # MAX_GET_CHAIN_REQUEST_BLOCKS
+PREVALIDATION_MIN_BATCH = 16 # smaller batches are checked in process
+
+_prevalidation_pool = None
+
+
+def configure_prevalidation_pool(processes):
+    """
+    sets up the pool checking received blocks, see ChainManager.prevalidate
+    and ChainManager.recover_senders
+    processes: 1 checks in process, 0 uses one worker per cpu
+    """
+    global _prevalidation_pool
+    if _prevalidation_pool is not None:
+        _prevalidation_pool.terminate()
+        _prevalidation_pool = None
+    if processes != 1:
+        try:
+            _prevalidation_pool = multiprocessing.Pool(processes or None)
+        except OSError as e:
+            logger.warn('prevalidation pool failed: %r', e)
+    return _prevalidation_pool
+
+
+def _check_header(args):
+    return blocks.check_header(*args)
 
 
 
@@ -35,6 +66,9 @@ class Index(object):
         - needed to mark the longest chain (path to top)
     transactions:
         - optional to resolve txhash to block:tx
+    ancestors:
+        - jump pointers to find the k-th ancestor or the common
+          ancestor of two blocks with O(log n) lookups
 
     """
     def __init__(self, db, index_transactions=True):
@@ -43,6 +77,7 @@ class Index(object):
 
     def add_block(self, blk):
         self.add_child(blk.prevhash, blk.hash)
+        self._add_ancestors(blk)
         if self._index_transactions:
             self._add_transactions(blk)
 
@@ -50,7 +85,7 @@ class Index(object):
     # block by number #########
 
     def _block_by_number_key(self, number):
-        return 'blocknumber:%d' % number
+        return dbkeys.block_number(number)
 
     def update_blocknumbers(self, blk):
         "start from head and update until the existing indices match the block"
@@ -58,7 +93,7 @@ class Index(object):
             self.db.put(self._block_by_number_key(blk.number), blk.hash)
             if blk.number == 0:
                 break
-            blk = blk.get_parent()
+            blk = blk.get_parent_header()
             if self.has_block_by_number(blk.number) and \
                     self.get_block_by_number(blk.number) == blk.hash:
                 break
@@ -70,6 +105,12 @@ class Index(object):
         "returns block hash"
         return self.db.get(self._block_by_number_key(number))
 
+    def get_blocks_by_number(self, number_from, number_to):
+        "returns [(number, block hash)] of the main branch, number_to included"
+        keys = self.db.range(self._block_by_number_key(number_from),
+                             self._block_by_number_key(number_to))
+        return [(dbkeys.decode_block_number(k), h) for k, h in keys]
+
 
     # transactions #############
 
@@ -77,16 +118,14 @@ class Index(object):
         "'tx_hash' -> 'rlp([blockhash,tx_number])"
         for i in range(blk.transaction_count):
             i_enc = utils.encode_int(i)
-            # work on rlp data to avoid unnecessary de/serialization
-            td = blk.transactions.get(rlp.encode(i_enc))
-            tx = rlp.descend(td, 0)
-            key = utils.sha3(tx)
+            tx_lst_serialized, _, _ = blk.get_transaction(i)
+            key = dbkeys.transaction(utils.sha3(rlp.encode(tx_lst_serialized)))
             value = rlp.encode([blk.hash, i_enc])
             self.db.put(key, value)
 
     def get_transaction(self, txhash):
         "return (tx, block)"
-        blockhash, tx_num_enc = rlp.decode(self.db.get(txhash))
+        blockhash, tx_num_enc = rlp.decode(self.db.get(dbkeys.transaction(txhash)))
         blk = blocks.get_block(blockhash)
         num = utils.decode_int(tx_num_enc)
         tx_data, msr, gas = blk.get_transaction(num)
@@ -95,7 +134,7 @@ class Index(object):
     # children ##############
 
     def _child_db_key(self, blk_hash):
-        return 'ci:' + blk_hash
+        return dbkeys.children(blk_hash)
 
     def add_child(self, parent_hash, child_hash):
         # only efficient for few children per block
@@ -110,6 +149,102 @@ class Index(object):
             return rlp.decode(self.db.get(key))
         return []
 
+    # ancestors ##############
+
+    def _add_ancestors(self, blk):
+        self._put_ancestors(blk.number, blk.hash, blk.prevhash)
+
+    def _put_ancestors(self, number, blk_hash, prevhash):
+        "stores the hashes of the ancestors at distance 1, 2, 4, .. 2**i"
+        jumps = []
+        if number > 0:
+            jumps.append(prevhash)
+            while 2 ** len(jumps) <= number:
+                # ancestor at 2**i is the ancestor at 2**(i-1) of the one at 2**(i-1)
+                jumps.append(self._get_jump(jumps[-1], len(jumps) - 1))
+        self.db.put(dbkeys.ancestors(blk_hash), ''.join(jumps))
+
+    def _backfill_ancestors(self, blk_hash):
+        """
+        indexes the ancestors of a block stored before the ancestor index
+        existed, and of the blocks below it which lack them, oldest first
+        """
+        missing = []  # (number, hash, prevhash), newest first
+        header = blocks.get_block_header(blk_hash)
+        while True:
+            missing.append((header.number, header.hash, header.prevhash))
+            if header.number == 0 or dbkeys.ancestors(header.prevhash) in self.db:
+                break
+            header = header.get_parent_header()
+        logger.debug('indexing the ancestors of %d blocks', len(missing))
+        for number, h, prevhash in reversed(missing):
+            self._put_ancestors(number, h, prevhash)
+
+    def _get_jump(self, blk_hash, i):
+        "returns the hash of the ancestor at distance 2**i"
+        try:
+            jumps = self.db.get(dbkeys.ancestors(blk_hash))
+        except KeyError:  # indexed before the ancestor index existed
+            self._backfill_ancestors(blk_hash)
+            jumps = self.db.get(dbkeys.ancestors(blk_hash))
+        assert len(jumps) > i * 32
+        return jumps[i * 32:(i + 1) * 32]
+
+    def get_ancestor(self, blk, distance):
+        "returns the hash of the ancestor of blk at distance"
+        assert 0 <= distance <= blk.number
+        blk_hash, i = blk.hash, 0
+        while distance:
+            if distance & 1:
+                blk_hash = self._get_jump(blk_hash, i)
+            distance >>= 1
+            i += 1
+        return blk_hash
+
+    def get_common_ancestor(self, a, b):
+        "returns the hash of the latest common ancestor of a and b or None"
+        if a.number < b.number:
+            a, b = b, a
+        a_hash, b_hash = self.get_ancestor(a, a.number - b.number), b.hash
+        number = b.number
+        if a_hash == b_hash:
+            return a_hash
+        # jump as far as the ancestors still differ
+        for i in reversed(range(number.bit_length())):
+            if 2 ** i <= number:
+                a_jump, b_jump = self._get_jump(a_hash, i), self._get_jump(b_hash, i)
+                if a_jump != b_jump:
+                    a_hash, b_hash = a_jump, b_jump
+                    number -= 2 ** i
+        if number == 0:  # different genesis
+            return None
+        return self._get_jump(a_hash, 0)
+
+
+class ChainSnapshot(object):
+
+    """
+    Read only view of the chain, pinned to the head at the time it was taken.
+    Reads through it are consistent and don't need the chain_manager.lock
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.index = Index(db)
+        self.head = self.get(db.get('HEAD'))
+
+    def get(self, blockhash):
+        return blocks.get_block(blockhash).at_snapshot(self.db)
+
+    def in_main_branch(self, block):
+        # entries above the head are left from a longer, lighter chain
+        if block.number > self.head.number:
+            return False
+        try:
+            return block.hash == self.index.get_block_by_number(block.number)
+        except KeyError:
+            return False
+
 
 class ChainManager(StoppableLoopThread):
 
@@ -122,7 +257,9 @@ class ChainManager(StoppableLoopThread):
     index = None
     miner = None
     blockchain = None
+    blockstore = None
     synchronizer = None
+    _head_difficulty = None
 
     def __init__(self):
         super(ChainManager, self).__init__()
@@ -130,7 +267,26 @@ class ChainManager(StoppableLoopThread):
     def configure(self, config, genesis=None):
         self.config = config
         logger.info('Opening chain @ %s', utils.get_db_path())
+        # forked before the threads of the db are started
+        configure_prevalidation_pool(config.getint('misc', 'prevalidation_processes'))
+        parallel.configure(config.getint('misc', 'parallel_replay_processes'))
+        if config.getint('misc', 'db_stats'):
+            enable_db_stats(utils.get_db_path())
+        if config.getint('misc', 'async_commit'):
+            enable_async_commit(utils.get_db_path(),
+                max_pending=config.getint('misc', 'async_commit_queue'),
+                sync_every=config.getint('misc', 'async_commit_sync_every'))
         db = self.blockchain = DB(utils.get_db_path())
+        self._head_difficulty = None
+        blocks.configure_cache(config.getint('misc', 'block_cache_size'),
+                               config.getint('misc', 'header_cache_size'),
+                               config.getint('misc', 'pinned_headers'))
+        if dbkeys.needs_migration(db):
+            dbkeys.migrate(db)
+        processblock.configure_code_cache(config.getint('misc', 'code_cache_size'))
+        transactions.configure_sender_cache(config.getint('misc', 'sender_cache_size'))
+        logger.debug('analysed %d programs', processblock.load_code_cache(db))
+        self.blockstore = BlockStore(utils.get_blockstore_path(), db)
         self.index = Index(db)
         if genesis:
             self._initialize_blockchain(genesis)
@@ -146,13 +302,28 @@ class ChainManager(StoppableLoopThread):
         ptr = self.blockchain.get('HEAD')
         return blocks.get_block(ptr)
 
-    def _update_head(self, block):
+    @property
+    def head_difficulty(self):
+        "total difficulty of the head, kept in memory for the fork choice"
+        if self._head_difficulty is None:
+            self._head_difficulty = self.head.chain_difficulty()
+        return self._head_difficulty
+
+    def _update_head(self, block, chain_difficulty=None):
+        if chain_difficulty is None:
+            chain_difficulty = block.chain_difficulty()
         if not block.is_genesis():
-            assert self.head.chain_difficulty() < block.chain_difficulty()
-            if block.get_parent() != self.head:
-                logger.debug('New Head %r is on a different branch. Old was:%r', block, self.head)
+            assert self.head_difficulty < chain_difficulty
+            if block.prevhash != self.head.hash:
+                fork = self.index.get_common_ancestor(block, self.head)
+                logger.debug('New Head %r is on a different branch. Old was:%r, '
+                             '%d blocks reverted', block, self.head,
+                             self.head.number - blocks.get_block_header(fork).number)
         self.blockchain.put('HEAD', block.hash)
+        self._head_difficulty = chain_difficulty
+        blocks.block_cache.pin_head(self.head)
         self.index.update_blocknumbers(self.head)
+        processblock.save_code_cache(self.blockchain)  # committed with the head
         self.new_miner()  # reset mining
 
     def get(self, blockhash):
@@ -160,16 +331,30 @@ class ChainManager(StoppableLoopThread):
         assert len(blockhash) == 32
         return blocks.get_block(blockhash)
 
+    def get_rlp(self, blockhash):
+        "returns the serialized block without deserializing it"
+        assert isinstance(blockhash, str)
+        assert len(blockhash) == 32
+        return blocks.get_block_rlp(blockhash)
+
     def has_block(self, blockhash):
         assert isinstance(blockhash, str)
         assert len(blockhash) == 32
-        return blockhash in self.blockchain
+        return blockhash in self.blockstore or blockhash in self.blockchain
 
     def __contains__(self, blockhash):
         return self.has_block(blockhash)
 
-    def _store_block(self, block):
-        self.blockchain.put(block.hash, block.serialize())
+    def snapshot(self):
+        "returns a ChainSnapshot of the current head"
+        return ChainSnapshot(self.blockchain.snapshot())
+
+    def _store_block(self, block, chain_difficulty=None):
+        if chain_difficulty is None:
+            chain_difficulty = block.chain_difficulty()
+        self.blockstore.put(block.hash, block.serialize())
+        header = blocks.BlockHeader.from_block(block, chain_difficulty)
+        self.blockchain.put(dbkeys.header(block.hash), header.serialize())
 
     def commit(self):
         self.blockchain.commit()
@@ -183,6 +368,12 @@ class ChainManager(StoppableLoopThread):
         self._update_head(genesis)
         assert genesis.hash in self
 
+    def post_loop(self):
+        self.blockchain.flush()
+        configure_prevalidation_pool(1)  # terminates the pool
+        parallel.configure(1)  # terminates the replay pool
+        super(ChainManager, self).post_loop()
+
     def loop_body(self):
         ts = time.time()
         pct_cpu = self.config.getint('misc', 'mining')
@@ -209,9 +400,9 @@ class ChainManager(StoppableLoopThread):
                 u = utils.sha3(rlp.encode(u))
                 if u in self:
 #                    logger.debug('ineligible uncle %r', u.encode('hex'))
-                    uncles.discard(self.get(u))
+                    uncles.discard(blocks.get_block_header(u))
             if blk.has_parent():
-                blk = blk.get_parent()
+                blk = blk.get_parent_header()
 #        logger.debug('%d uncles after filtering %r', len(uncles), uncles)
 
         miner = Miner(self.head, uncles, self.config.get('wallet', 'coinbase'))
@@ -231,6 +422,33 @@ class ChainManager(StoppableLoopThread):
                 else:
                     self.new_miner()
 
+    def prevalidate(self, transient_blocks):
+        """
+        context free checks of a batch of received blocks (see
+        blocks.check_header), done before any state is replayed.
+        Large batches are checked in a process pool.
+        returns (block, reason) for the first invalid block or None
+        """
+        tasks = [(t.header_args, t.uncles) for t in transient_blocks]
+        if len(tasks) >= PREVALIDATION_MIN_BATCH and _prevalidation_pool is not None:
+            results = _prevalidation_pool.imap(_check_header, tasks, chunksize=8)
+        else:
+            results = itertools.imap(_check_header, tasks)
+        for t_block, reason in itertools.izip(transient_blocks, results):
+            if reason:
+                return t_block, reason
+        return None
+
+    def recover_senders(self, txs):
+        """
+        recovers the senders of a batch of transactions before they are
+        applied. Large batches are recovered in the process pool.
+        """
+        pool = None
+        if len(txs) >= PREVALIDATION_MIN_BATCH:
+            pool = _prevalidation_pool
+        transactions.recover_senders(txs, pool)
+
     def receive_chain(self, transient_blocks, peer=None):
         with self.lock:
             old_head = self.head
@@ -238,6 +456,18 @@ class ChainManager(StoppableLoopThread):
             transient_blocks.sort(key=attrgetter('number'))
             assert transient_blocks[0].number <= transient_blocks[-1].number
 
+            # drop the batch before replaying anything if a header is invalid
+            invalid = self.prevalidate(transient_blocks)
+            if invalid:
+                logger.debug('%r failed prevalidation: %s, dropping %d blocks',
+                             invalid[0], invalid[1], len(transient_blocks))
+                self.synchronizer.stop_synchronization(peer)
+                return
+
+            # recover the senders of all transactions at once
+            self.recover_senders([tx for t_block in transient_blocks
+                                  for tx in t_block.transactions])
+
             # notify syncer
             self.synchronizer.received_blocks(peer, transient_blocks)
 
@@ -245,7 +475,8 @@ class ChainManager(StoppableLoopThread):
                 logger.debug('Deserializing %r', t_block)
                 #logger.debug(t_block.rlpdata.encode('hex'))
                 try:
-                    block = blocks.Block.deserialize(t_block.rlpdata)
+                    block = blocks.Block.deserialize(t_block.rlpdata,
+                                                     txs=t_block.transactions)
                 except processblock.InvalidTransaction as e:
                     # FIXME there might be another exception in
                     # blocks.deserializeChild when replaying transactions
@@ -321,18 +552,23 @@ class ChainManager(StoppableLoopThread):
             logger.debug("%r is older than head %r", block, self.head)
             # Q: Should we have any limitations on adding blocks?
 
+        # computed once, the parent's total difficulty is in its header record
+        chain_difficulty = block.chain_difficulty()
         self.index.add_block(block)
-        self._store_block(block)
+        self._store_block(block, chain_difficulty)
 
         # set to head if this makes the longest chain w/ most work for that number
-        #logger.debug('Head: %r @%s  New:%r @%d', self.head, self.head.chain_difficulty(), block, block.chain_difficulty())
-        if block.chain_difficulty() > self.head.chain_difficulty():
+        #logger.debug('Head: %r @%s  New:%r @%d', self.head, self.head_difficulty, block, chain_difficulty)
+        if chain_difficulty > self.head_difficulty:
             logger.debug('New Head %r', block)
-            self._update_head(block)
+            self._update_head(block, chain_difficulty)
         elif block.number > self.head.number:
             logger.warn('%r has higher blk number than head %r but lower chain_difficulty of %d vs %d',
-                                block, self.head, block.chain_difficulty(), self.head.chain_difficulty())
+                                block, self.head, chain_difficulty, self.head_difficulty)
         self.commit() # batch commits all changes that came with the new block
+        if self.blockchain.stats:
+            self.blockchain.stats.last_commit['block'] = block.hex_hash()
+            logger.debug('%r db commit: %r', block, self.blockchain.stats.last_commit)
 
         return True
 
@@ -341,14 +577,17 @@ class ChainManager(StoppableLoopThread):
         return [self.get(c) for c in self.index.get_children(block.hash)]
 
     def get_uncles(self, block):
+        "returns the BlockHeaders of the uncle candidates for a child of block"
         if not block.has_parent():
             return []
-        parent = block.get_parent()
+        parent = block.get_parent_header()
         o = []
         i = 0
         while parent.has_parent() and i < 6:
-            grandparent = parent.get_parent()
-            o.extend([u for u in self.get_children(grandparent) if u != parent])
+            grandparent = parent.get_parent_header()
+            o.extend([u for u in map(blocks.get_block_header,
+                                     self.index.get_children(grandparent.hash))
+                      if u != parent])
             parent = grandparent
             i += 1
         return o
@@ -386,6 +625,9 @@ class ChainManager(StoppableLoopThread):
         return blocks
 
     def in_main_branch(self, block):
+        # entries above the head are left from a longer, lighter chain
+        if block.number > self.head.number:
+            return False
         try:
             return block.hash == self.index.get_block_by_number(block.number)
         except KeyError:
@@ -394,8 +636,11 @@ class ChainManager(StoppableLoopThread):
     def get_descendants(self, block, count=1):
         logger.debug("get_descendants: %r ", block)
         assert block.hash in self
-        block_numbers = range(block.number+1, min(self.head.number, block.number+count))
-        return [self.get(self.index.get_block_by_number(n)) for n in block_numbers]
+        number_to = min(self.head.number, block.number + count) - 1
+        if number_to <= block.number:
+            return []
+        return [self.get(h) for n, h in
+                self.index.get_blocks_by_number(block.number + 1, number_to)]
 
 
 
@@ -413,13 +658,19 @@ def handle_get_block_hashes(sender, block_hash, count, peer, **kwargs):
     if not block_hash in chain_manager:
         logger.debug("unknown block: %r", block_hash.encode('hex'))
         peer.send_BlockHashes([])
-    last = chain_manager.get(block_hash)
-    while len(found) < max_hashes:
-        if last.has_parent():
-            last = last.get_parent()
-            found.append(last.hash)
-        else:
-            break
+        return
+    last = blocks.get_block_header(block_hash)
+    # walk down a side branch until the main branch is reached
+    while len(found) < max_hashes and last.has_parent() and \
+            not chain_manager.in_main_branch(last):
+        last = last.get_parent_header()
+        found.append(last.hash)
+    # the main branch is read from the block number index
+    if len(found) < max_hashes and last.number > 0 and \
+            chain_manager.in_main_branch(last):
+        number_from = max(0, last.number - (max_hashes - len(found)))
+        found.extend(h for n, h in reversed(chain_manager.index.get_blocks_by_number(
+            number_from, last.number - 1)))
     logger.debug("sending: found: %d block_hashes", len(found))
     with peer.lock:
         peer.send_BlockHashes(found)
@@ -430,7 +681,7 @@ def handle_get_blocks(sender, block_hashes, peer, **kwargs):
     found = []
     for bh in block_hashes[:MAX_GET_CHAIN_REQUEST_BLOCKS]:
         if bh in chain_manager:
-            found.append(chain_manager.get(bh))
+            found.append(chain_manager.get_rlp(bh))
         else:
             logger.debug("Unknown block %r requested", bh.encode('hex'))
     logger.debug("sending: found: %d blocks", len(found))
@@ -459,13 +710,14 @@ def peer_handshake(sender, peer, **kwargs):
     # reply with status if not yet sent
     if peer.has_ethereum_capabilities() and not peer.status_sent:
         logger.debug("%r handshake, sending status", peer)
-        peer.send_Status(chain_manager.head.hash, chain_manager.head.chain_difficulty(), blocks.genesis().hash)
+        peer.send_Status(chain_manager.head.hash, chain_manager.head_difficulty, blocks.genesis().hash)
 
 
 @receiver(signals.remote_transactions_received)
 def remote_transactions_received_handler(sender, transactions, **kwargs):
     "receives rlp.decoded serialized"
     txl = [Transaction.deserialize(rlp.encode(tx)) for tx in transactions]
+    chain_manager.recover_senders(txl)
     logger.debug('remote_transactions_received: %r', txl)
     for tx in txl:
         chain_manager.add_transaction(tx)
@@ -0,0 +1,228 @@
+"""
+Second execution tier of the VM: straight line segments of hot programs
+compiled to Python functions.
+
+A segment starts at some pc and runs over the following operations which
+only use the stack, static gas and read only state (arithmetic, PUSH, DUP,
+SWAP, environment, SLOAD, ...), including a final JUMP or JUMPI.
+Operations with memory, dynamic gas or side effects end a segment and are
+left to the interpreter (processblock.apply_op).
+
+Within a segment stack slots are locals. Items below them are popped from
+the VM stack on first use, the locals are pushed back at the end. The fees
+of a segment are static, so the gas is checked and charged once at its
+start. If the gas or the stack does not suffice, the segment returns False
+without any effect and the interpreter runs the operations one by one,
+producing the exact error behaviour.
+"""
+import utils
+
+TT255 = 2 ** 255
+TT256 = 2 ** 256
+
+
+def to_signed(i):
+    return i if i < TT255 else i - TT256
+
+
+def _sdiv(s0, s1):
+    s0, s1 = to_signed(s0), to_signed(s1)
+    return 0 if s1 == 0 else (s0 / s1) % TT256
+
+
+def _smod(s0, s1):
+    s0, s1 = to_signed(s0), to_signed(s1)
+    return 0 if s1 == 0 else (s0 % s1) % TT256
+
+
+def _byte(s0, s1):
+    return 0 if s0 >= 32 else (s1 / 256 ** (31 - s0)) % 256
+
+
+def _calldataload(data, s0):
+    if s0 >= len(data):
+        return 0
+    dat = data[s0: s0 + 32]
+    return utils.big_endian_to_int(dat + '\x00' * (32 - len(dat)))
+
+
+# name -> expression of the popped values {0}, {1}, .. (first popped first)
+EXPRESSIONS = {
+    'ADD': '({0} + {1}) % TT256',
+    'SUB': '({0} - {1}) % TT256',
+    'MUL': '({0} * {1}) % TT256',
+    'DIV': '0 if {1} == 0 else {0} / {1}',
+    'MOD': '0 if {1} == 0 else {0} % {1}',
+    'SDIV': '_sdiv({0}, {1})',
+    'SMOD': '_smod({0}, {1})',
+    'EXP': 'pow({0}, {1}, TT256)',
+    'NEG': '-{0} % TT256',
+    'LT': '1 if {0} < {1} else 0',
+    'GT': '1 if {0} > {1} else 0',
+    'SLT': '1 if to_signed({0}) < to_signed({1}) else 0',
+    'SGT': '1 if to_signed({0}) > to_signed({1}) else 0',
+    'EQ': '1 if {0} == {1} else 0',
+    'NOT': '0 if {0} else 1',
+    'AND': '{0} & {1}',
+    'OR': '{0} | {1}',
+    'XOR': '{0} ^ {1}',
+    'BYTE': '_byte({0}, {1})',
+    'ADDMOD': '({0} + {1}) % {2} if {2} else 0',
+    'MULMOD': '({0} * {1}) % {2} if {2} else 0',
+    'ADDRESS': 'utils.big_endian_to_int(msg.to)',
+    'BALANCE': 'block.get_balance(utils.int_to_addr({0}))',
+    'ORIGIN': 'utils.coerce_to_int(tx.sender)',
+    'CALLER': 'utils.big_endian_to_int(msg.sender)',
+    'CALLVALUE': 'msg.value',
+    'CALLDATALOAD': '_calldataload(msg.data, {0})',
+    'CALLDATASIZE': 'len(msg.data)',
+    'GASPRICE': 'tx.gasprice',
+    'PREVHASH': 'utils.big_endian_to_int(block.prevhash)',
+    'COINBASE': "utils.big_endian_to_int(block.coinbase.decode('hex'))",
+    'TIMESTAMP': 'block.timestamp',
+    'NUMBER': 'block.number',
+    'DIFFICULTY': 'block.difficulty',
+    'GASLIMIT': 'block.gas_limit',
+    'SLOAD': 'block.get_storage_data(msg.to, {0})',
+    'MSIZE': 'len(compustate.memory)',
+}
+
+# arguments popped, where it differs from the ins of the opcode
+# (NEG requires two stack items but pops one, like the interpreter)
+POPPED = {'NEG': 1}
+
+# estimated memory in bytes of a compiled segment (function, code object and
+# namespace) besides its source, and of an operation which is not compiled
+SEGMENT_SIZE = 1536
+NOT_COMPILED_SIZE = 64
+
+NAMESPACE = dict(TT256=TT256, utils=utils, to_signed=to_signed, _sdiv=_sdiv,
+                 _smod=_smod, _byte=_byte, _calldataload=_calldataload)
+
+
+def _is_debug_dup(program, pc, depth):
+    """
+    DUP followed by depth POPs prints the stack in processblock.debug_mode,
+    such are left to the interpreter
+    """
+    for i in range(depth):
+        if pc + 1 + i < len(program.ops) and program.ops[pc + 1 + i][0] != 'POP':
+            return False
+    return True
+
+
+class _Segment(object):
+
+    "code generation state"
+
+    def __init__(self):
+        self.lines = []
+        self.stack = []  # names of the locals, top last
+        self.popped = 0  # items taken from the VM stack
+        self.names = 0
+
+    def local(self, expr):
+        name = 's%d' % self.names
+        self.names += 1
+        self.lines.append('%s = %s' % (name, expr))
+        return name
+
+    def need(self, n):
+        "makes sure the top n items are locals"
+        while len(self.stack) < n:
+            self.stack.insert(0, self.local('stk.pop()'))
+            self.popped += 1
+
+    def pop(self):
+        self.need(1)
+        return self.stack.pop()
+
+
+def compile_segment(program, start):
+    """
+    returns the function (block, tx, msg, compustate) -> bool running the
+    segment at start, None if the operation at start can not be compiled
+    """
+    seg = _Segment()
+    fees = []
+    gas_ops = []  # (line, fees charged up to the GAS)
+    pc = start
+    ops = 0
+    jumped = False
+    while pc < len(program.ops):
+        name, ins, outs, memuses, fee, opcode = program.ops[pc]
+        if name in EXPRESSIONS:
+            seg.need(ins)
+            args = [seg.pop() for i in range(POPPED.get(name, ins))]
+            seg.stack.append(seg.local(EXPRESSIONS[name].format(*args)))
+        elif name[:4] == 'PUSH':
+            seg.stack.append(seg.local(repr(program.push_values[pc])))
+            pc += int(name[4:])
+        elif name[:3] == 'DUP' and not _is_debug_dup(program, pc, int(name[3:])):
+            depth = int(name[3:])
+            seg.need(depth)
+            seg.stack.append(seg.stack[-depth])
+        elif name[:4] == 'SWAP':
+            depth = int(name[4:])
+            seg.need(depth + 1)
+            seg.stack[-1], seg.stack[-depth - 1] = seg.stack[-depth - 1], seg.stack[-1]
+        elif name == 'POP':
+            seg.pop()
+        elif name == 'PC':
+            seg.stack.append(seg.local(repr(pc + 1)))
+        elif name == 'GAS':
+            gas_ops.append((len(seg.lines), sum(fees) + fee))
+            seg.stack.append(seg.local('compustate.gas + %s'))
+        elif name == 'JUMP':
+            target = seg.pop()
+            seg.lines.append('compustate.pc = %s' % target)
+            jumped = True
+        elif name == 'JUMPI':
+            s0, s1 = seg.pop(), seg.pop()
+            seg.lines.append('compustate.pc = %s if %s else %d' % (s0, s1, pc + 1))
+            jumped = True
+        else:
+            break
+        fees.append(fee)
+        ops += 1
+        pc += 1
+        if jumped:
+            break
+    if not ops:
+        return None
+    total = sum(fees)
+    for i, before in gas_ops:  # GAS sees the fees up to itself charged
+        seg.lines[i] = seg.lines[i] % (total - before)
+    if seg.stack:
+        seg.lines.append('stk.extend((%s,))' % ', '.join(seg.stack))
+    if not jumped:
+        seg.lines.append('compustate.pc = %d' % pc)
+    src = ['def segment(block, tx, msg, compustate):',
+           '    stk = compustate.stack',
+           '    if len(stk) < %d or compustate.gas < %d:' % (seg.popped, total),
+           '        return False',
+           '    compustate.gas -= %d' % total]
+    src.extend('    ' + line for line in seg.lines)
+    src.append('    return True')
+    namespace = dict(NAMESPACE)
+    exec compile('\n'.join(src), '<segment %d>' % start, 'exec') in namespace
+    segment = namespace['segment']
+    segment.ops = ops
+    segment.source = '\n'.join(src)
+    segment.size = SEGMENT_SIZE + 2 * len(segment.source)
+    return segment
+
+
+def get_segment(program, pc):
+    """
+    the compiled segment at pc, compiled on first use.
+    Adds its size to program.size, see processblock.get_program
+    """
+    if pc >= len(program.ops):
+        return None
+    try:
+        return program.segments[pc]
+    except KeyError:
+        segment = program.segments[pc] = compile_segment(program, pc)
+        program.size += segment.size if segment else NOT_COMPILED_SIZE
+        return segment
@@ -62,6 +62,40 @@ data_dir = {1}
 # percent cpu devoted to mining 0=off
 mining = 30
 
+# write db commits in a background thread 0=off
+async_commit = 0
+
+# max number of commits queued for the background thread
+async_commit_queue = 8
+
+# fsync every n-th background commit 0=never
+async_commit_sync_every = 0
+
+# collect write statistics of the chain db, served by the api at /dbstats/
+db_stats = 0
+
+# bytes of serialized blocks kept deserialized in the block cache
+block_cache_size = 33554432
+
+# number of block headers kept in the header cache
+header_cache_size = 8192
+
+# number of headers below the head which are never evicted from the cache
+pinned_headers = 256
+
+# processes checking PoW and headers of received blocks, 0=one per cpu 1=none
+prevalidation_processes = 0
+
+# estimated bytes of memory of the analysed contract code in the code cache
+code_cache_size = 16777216
+
+# number of recovered transaction senders kept in the sender cache
+sender_cache_size = 16384
+
+# processes replaying transactions of received blocks speculatively,
+# 0=one per cpu 1=serial replay
+parallel_replay_processes = 1
+
 
 # how verbose should the client be (1-3)
 verbosity = 3
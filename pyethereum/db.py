@@ -1,10 +1,190 @@
 import os
+import time
+import bisect
+import collections
+import heapq
+import Queue
 import leveldb
 import threading
 import logging
 logger = logging.getLogger(__name__)
 
 databases = {}
+stats = {}
+writers = {}
+
+
+class Histogram(object):
+
+    "latency histogram, buckets are upper bounds in seconds"
+
+    bounds = (.0001, .001, .01, .1, 1.)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.total = 0.
+
+    def add(self, elapsed):
+        self.counts[bisect.bisect(self.bounds, elapsed)] += 1
+        self.total += elapsed
+
+    def to_dict(self):
+        labels = ['<%gs' % b for b in self.bounds] + ['>=%gs' % self.bounds[-1]]
+        return dict(buckets=dict(zip(labels, self.counts)),
+                    count=sum(self.counts), total=self.total)
+
+
+class DBStats(object):
+
+    """
+    Write path instrumentation of a db, shared by all DB objects of a dbfile.
+    Counters are collected per commit, the last `max_commits` are kept.
+    """
+
+    def __init__(self, max_commits=256):
+        self.commits = collections.deque(maxlen=max_commits)
+        self.totals = self._counters()
+        self.current = self._counters()
+        self.get_latency = Histogram()
+        self.commit_latency = Histogram()
+
+    def _counters(self):
+        return dict(puts=0, duplicate_puts=0, gets_uncommitted=0,
+                    gets_disk=0, gets_missing=0, keys=0, bytes=0)
+
+    def record_commit(self, keys, size, elapsed):
+        self.current.update(keys=keys, bytes=size, latency=elapsed)
+        for k in self.totals:
+            self.totals[k] += self.current[k]
+        self.commit_latency.add(elapsed)
+        self.commits.append(self.current)
+        self.current = self._counters()
+
+    @property
+    def last_commit(self):
+        return self.commits[-1] if self.commits else None
+
+    def to_dict(self):
+        return dict(totals=self.totals,
+                    pending=self.current,
+                    commits=list(self.commits),
+                    get_latency=self.get_latency.to_dict(),
+                    commit_latency=self.commit_latency.to_dict())
+
+
+def _merge_range(pending, committed, key_from, key_to):
+    """
+    merges the (key, value) pairs of the pending dict in range
+    with the sorted committed ones, pending values take precedence
+    """
+    pending = sorted((k, (0, v)) for k, v in pending.iteritems()
+                     if key_from <= k <= key_to)
+    committed = ((k, (1, v)) for k, v in committed)
+    last = None
+    for k, (_, v) in heapq.merge(pending, committed):
+        if k != last:
+            yield k, v
+        last = k
+
+
+def enable_stats(dbfile):
+    "opt-in, affects DB objects created afterwards"
+    if dbfile not in stats:
+        stats[dbfile] = DBStats()
+    return stats[dbfile]
+
+
+class AsyncWriter(threading.Thread):
+
+    """
+    Writes sealed batches of a db in the background, in commit order.
+    Batches stay readable through `get` until they are written.
+
+    max_pending:    number of batches which can wait to be written, before
+                    `submit` blocks
+    sync_every:     fsync every n-th batch, 0=never
+
+    If a batch can not be written, it and all later batches stay pending
+    (and readable) and the writer is failed: `submit` and `flush` raise the
+    error.
+    """
+
+    def __init__(self, db, max_pending=8, sync_every=0):
+        super(AsyncWriter, self).__init__()
+        self.daemon = True
+        self.db = db
+        self.sync_every = sync_every
+        self.num_written = 0
+        self.pending = collections.deque()  # oldest first
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue(max_pending)
+        self.error = None
+
+    def submit(self, batch):
+        if self.error:
+            raise self.error
+        with self.lock:
+            self.pending.append(batch)
+        self.queue.put(batch)
+
+    def get(self, key):
+        "returns the latest pending value"
+        with self.lock:
+            for batch in reversed(self.pending):
+                if key in batch:
+                    return batch[key]
+        raise KeyError(key)
+
+    def pending_items(self):
+        "returns all pending data, later batches overriding earlier ones"
+        items = dict()
+        with self.lock:
+            for batch in self.pending:
+                items.update(batch)
+        return items
+
+    def run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if not self.error:  # later batches must not be written
+                    self._write(batch)
+            except Exception as e:
+                logger.error('%r: writing batch failed: %r', self.db, e)
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def _write(self, batch):
+        write_batch = leveldb.WriteBatch()
+        for k, v in batch.iteritems():
+            write_batch.Put(k, v)
+        self.num_written += 1
+        sync = bool(self.sync_every) and \
+            self.num_written % self.sync_every == 0
+        self.db.Write(write_batch, sync=sync)
+        with self.lock:
+            assert self.pending[0] is batch
+            self.pending.popleft()
+
+    def flush(self):
+        "blocks until all submitted batches are written"
+        self.queue.join()
+        if self.error:
+            raise self.error
+
+
+def enable_async_commit(dbfile, max_pending=8, sync_every=0):
+    """
+    commits of dbfile are written by a background thread
+    must be enabled before the first commit to the db
+    """
+    if dbfile not in writers:
+        leveldb_db = DB(dbfile).db
+        writer = AsyncWriter(leveldb_db, max_pending, sync_every)
+        writers[dbfile] = writer
+        writer.start()
+    return writers[dbfile]
 
 
 class DB(object):
@@ -15,30 +195,98 @@ class DB(object):
             logger.debug('Opening db #%d @%r', len(databases)+1, dbfile)
             databases[dbfile] = (leveldb.LevelDB(dbfile), dict(), threading.Lock())
         self.db, self.uncommitted, self.lock = databases[dbfile]
+        self.stats = stats.get(dbfile)
+        self._dbfile = dbfile
 #        logger.debug('%r initialized', self)
 
+    @property
+    def writer(self):
+        return writers.get(self._dbfile)
+
     def get(self, key):
 #        logger.debug('%r: get:%r uncommited:%r', self, key, key in self.uncommitted)
+        if self.stats:
+            return self._get_with_stats(key)
         if key in self.uncommitted:
             return self.uncommitted[key]
+        return self._get_committed(key)
+
+    def _get_committed(self, key):
+        writer = self.writer
+        if writer:
+            try:
+                return writer.get(key)
+            except KeyError:
+                pass
         return self.db.Get(key)
 
+    def _get_with_stats(self, key):
+        counters = self.stats.current
+        if key in self.uncommitted:
+            counters['gets_uncommitted'] += 1
+            return self.uncommitted[key]
+        st = time.time()
+        try:
+            value = self._get_committed(key)
+        except KeyError:
+            counters['gets_missing'] += 1
+            raise
+        finally:
+            self.stats.get_latency.add(time.time() - st)
+        counters['gets_disk'] += 1
+        return value
+
     def put(self, key, value):
 #       logger.debug('%r: put:%r:%r', self, key, value)
         with self.lock:
+            if self.stats:
+                self.stats.current['puts'] += 1
+                if key in self.uncommitted:
+                    self.stats.current['duplicate_puts'] += 1
             self.uncommitted[key] = value
 
+    def snapshot(self):
+        "returns a read only view, pinned to the current state of the db"
+        with self.lock:
+            uncommitted = dict()
+            if self.writer:
+                uncommitted.update(self.writer.pending_items())
+            uncommitted.update(self.uncommitted)
+            return DBSnapshot(self.db.CreateSnapshot(), uncommitted)
+
     def commit(self):
         logger.debug('%r: commit', self)
         with self.lock:
-            batch = leveldb.WriteBatch()
-            for k, v in self.uncommitted.iteritems():
-                batch.Put(k, v)
-            self.db.Write(batch, sync=False)
+            st = time.time()
+            writer = self.writer
+            if writer:
+                writer.submit(dict(self.uncommitted))
+            else:
+                batch = leveldb.WriteBatch()
+                for k, v in self.uncommitted.iteritems():
+                    batch.Put(k, v)
+                self.db.Write(batch, sync=False)
+            if self.stats:
+                size = sum(len(k) + len(v) for k, v in self.uncommitted.iteritems())
+                self.stats.record_commit(len(self.uncommitted), size, time.time() - st)
             self.uncommitted.clear()
 
+    def flush(self):
+        "blocks until background commits are written"
+        if self.writer:
+            self.writer.flush()
+
+    def range(self, key_from, key_to):
+        "yields the sorted (key, value) pairs with key_from <= key <= key_to"
+        self.flush()
+        with self.lock:
+            pending = dict(self.uncommitted)
+        committed = self.db.RangeIter(key_from=key_from, key_to=key_to)
+        return _merge_range(pending, committed, key_from, key_to)
+
     def delete(self, key):
 #        logger.debug('%r: delete %r', self, key)
+        self.flush()
         with self.lock:
             if key in self.uncommitted:
                 del self.uncommitted[key]
@@ -64,8 +312,116 @@ class DB(object):
         return '<DB at %d uncommitted=%d>' % (id(self.db), len(self.uncommitted))
 
 
+class DBSnapshot(object):
+
+    """
+    Consistent view of a DB at the time the snapshot was taken.
+    Puts (e.g. trie nodes written while computing a root hash) are kept in a
+    private overlay and never reach the underlying db.
+    """
+
+    def __init__(self, snapshot, uncommitted):
+        self.db = snapshot
+        self.uncommitted = uncommitted
+        self.overlay = dict()
+        self.stats = None
+
+    def get(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        if key in self.uncommitted:
+            return self.uncommitted[key]
+        return self.db.Get(key)
+
+    def put(self, key, value):
+        self.overlay[key] = value
+
+    def commit(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def range(self, key_from, key_to):
+        pending = dict(self.uncommitted)
+        pending.update(self.overlay)
+        committed = self.db.RangeIter(key_from=key_from, key_to=key_to)
+        return _merge_range(pending, committed, key_from, key_to)
+
+    def delete(self, key):
+        raise Exception('snapshots are read only')
+
+    def snapshot(self):
+        return self
+
+    def _has_key(self, key):
+        try:
+            self.get(key)
+            return True
+        except KeyError:
+            return False
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.db == other.db
+
+    def __repr__(self):
+        return '<DBSnapshot at %d uncommitted=%d>' % (id(self.db), len(self.uncommitted))
+
+
+class OverlayDB(object):
+
+    """
+    Private in-memory overlay of a db. Reads fall through to the db, puts are
+    kept in the overlay and discarded with it, commit does nothing.
+    """
+
+    stats = None
+
+    def __init__(self, db):
+        self.db = db
+        self.overlay = dict()
+
+    def get(self, key):
+        if key in self.overlay:
+            return self.overlay[key]
+        return self.db.get(key)
+
+    def put(self, key, value):
+        self.overlay[key] = value
+
+    def commit(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def delete(self, key):
+        raise Exception('overlays are not written')
+
+    def _has_key(self, key):
+        try:
+            self.get(key)
+            return True
+        except KeyError:
+            return False
+
+    def __contains__(self, key):
+        return self._has_key(key)
+
+    def __eq__(self, other):
+        return isinstance(other, self.__class__) and self.db == other.db
+
+    def __repr__(self):
+        return '<OverlayDB of %r overlay=%d>' % (self.db, len(self.overlay))
+
+
 class EphemDB(object):
 
+    stats = None
+
     def __init__(self):
         self.db = {}
 
@@ -81,6 +437,14 @@ class EphemDB(object):
     def commit():
         pass
 
+    def flush(self):
+        pass
+
+    def snapshot(self):
+        snapshot = EphemDB()
+        snapshot.db = dict(self.db)
+        return snapshot
+
     def _has_key(self, key):
         return key in self.db
 
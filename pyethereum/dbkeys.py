@@ -0,0 +1,163 @@
+"""
+Keys of the auxiliary indexes stored next to the state in the chain db.
+
+Every key starts with a one byte prefix, numbers are fixed width big endian
+and hashes are stored raw. Keys of an index sort like their numbers, so
+range scans (e.g. by block number) are possible.
+Trie nodes (and blocks of chains created before the blockstore) are stored
+under their 32 byte hash, prefixed keys never have that length.
+"""
+import struct
+import logging
+import rlp
+import utils
+
+logger = logging.getLogger(__name__)
+
+META = '\x00'
+BLOCK_NUMBER = '\x01'
+CHAIN_DIFFICULTY = '\x02'
+CHILDREN = '\x03'
+TRANSACTION = '\x04'
+ACCOUNT_TX = '\x05'
+BLOCK_LOCATION = '\x06'
+HEADER = '\x07'
+ANCESTORS = '\x08'
+
+SCHEMA_VERSION = 1
+SCHEMA_KEY = META + 'schema'
+# hashes of the most recently executed code, see processblock.save_code_cache
+HOT_CODE_KEY = META + 'hotcode'
+
+# legacy ascii prefixes, see migrate
+LEGACY_BLOCK_NUMBER = 'blocknumber:'
+LEGACY_CHAIN_DIFFICULTY = 'difficulty:'
+LEGACY_CHILDREN = 'ci:'
+LEGACY_ACCOUNT_TX = 'tx'  # in the indexdb, followed by the hex account
+
+
+def block_number(number):
+    return BLOCK_NUMBER + struct.pack('>Q', number)
+
+
+def decode_block_number(key):
+    assert key[0] == BLOCK_NUMBER
+    return struct.unpack('>Q', key[1:])[0]
+
+
+def chain_difficulty(blockhash):
+    return CHAIN_DIFFICULTY + blockhash
+
+
+def children(blockhash):
+    return CHILDREN + blockhash
+
+
+def transaction(txhash):
+    return TRANSACTION + txhash
+
+
+def block_location(blockhash):
+    "location of the block in the blockstore"
+    return BLOCK_LOCATION + blockhash
+
+
+def header(blockhash):
+    "header record of the block, see blocks.BlockHeader"
+    return HEADER + blockhash
+
+
+def ancestors(blockhash):
+    "hashes of the ancestors at distance 1, 2, 4, .. of the block"
+    return ANCESTORS + blockhash
+
+
+def _legacy_range(db, prefix):
+    db.flush()
+    key_to = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+    for k, v in db.db.RangeIter(key_from=prefix, key_to=key_to):
+        if k.startswith(prefix):
+            yield k, v
+
+
+def needs_migration(db):
+    return SCHEMA_KEY not in db
+
+
+class _Mover(object):
+
+    "moves keys of db, commits every batch_size keys"
+
+    def __init__(self, db, batch_size):
+        self.db, self.batch_size = db, batch_size
+        self.moved = 0
+        self.obsolete = []
+
+    def move(self, old, new, value):
+        self.db.put(new, value)
+        self.obsolete.append(old)
+        if len(self.obsolete) >= self.batch_size:
+            self.commit()
+
+    def commit(self):
+        # new keys are committed before the old ones are deleted
+        self.db.commit()
+        for k in self.obsolete:
+            self.db.delete(k)
+        self.moved += len(self.obsolete)
+        del self.obsolete[:]
+        logger.info('migrated %d keys', self.moved)
+
+    def finish(self):
+        self.commit()
+        self.db.put(SCHEMA_KEY, str(SCHEMA_VERSION))
+        self.db.commit()
+        logger.info('migrated %d keys, db schema version %d',
+                    self.moved, SCHEMA_VERSION)
+        return self.moved
+
+
+def migrate(db, batch_size=1000):
+    """
+    Moves the auxiliary indexes of db from the legacy ascii keys
+    ('blocknumber:%d', 'difficulty:'+hex hash, 'ci:'+hash, raw tx hashes)
+    to the compact keys. Works in place and commits every batch_size keys,
+    an interrupted migration can simply be restarted.
+    """
+    mover = _Mover(db, batch_size)
+    move = mover.move
+    for k, v in list(_legacy_range(db, LEGACY_BLOCK_NUMBER)):
+        move(k, block_number(int(k[len(LEGACY_BLOCK_NUMBER):])), v)
+    for k, v in list(_legacy_range(db, LEGACY_CHAIN_DIFFICULTY)):
+        move(k, chain_difficulty(k[len(LEGACY_CHAIN_DIFFICULTY):].decode('hex')), v)
+    block_hashes = set()
+    for k, v in list(_legacy_range(db, LEGACY_CHILDREN)):
+        block_hashes.add(k[len(LEGACY_CHILDREN):])
+        block_hashes.update(rlp.decode(v))
+        move(k, children(k[len(LEGACY_CHILDREN):]), v)
+    # transactions were indexed by their raw hash,
+    # the keys can only be found through the blocks
+    for blockhash in block_hashes:
+        if blockhash not in db:
+            continue
+        header, transaction_list, uncles = rlp.decode(db.get(blockhash))
+        for tx_lst_serialized, _, _ in transaction_list:
+            txhash = utils.sha3(rlp.encode(tx_lst_serialized))
+            if txhash in db:
+                move(txhash, transaction(txhash), db.get(txhash))
+    return mover.finish()
+
+
+def migrate_index(db, batch_size=1000):
+    """
+    Moves the account transactions of the indexdb from the legacy keys
+    ('tx'+hex account+valnum) to ACCOUNT_TX+binary account+valnum.
+    See migrate.
+    """
+    mover = _Mover(db, batch_size)
+    for k, v in list(_legacy_range(db, LEGACY_ACCOUNT_TX)):
+        account = k[len(LEGACY_ACCOUNT_TX):-4]
+        if len(account) != 40:
+            continue
+        mover.move(k, ACCOUNT_TX + account.decode('hex') + k[-4:], v)
+    return mover.finish()
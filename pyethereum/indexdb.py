@@ -1,5 +1,6 @@
 import struct
 import db
+import dbkeys
 from utils import get_index_path
 
 
@@ -29,6 +30,7 @@ class Index(object):
 
     def get(self, key, offset=0):
         assert not self.db.uncommitted
+        self.db.flush()
         key_from = self._key(key, offset)
         for k, v in self.db.db.RangeIter(include_value=True,
                                          key_from=key_from):
@@ -42,9 +44,12 @@ class Index(object):
 
     def keys(self, key_from=''):
         assert not self.db.uncommitted
+        self.db.flush()
         zero = struct.pack('>I', 0)
         for key in self.db.db.RangeIter(include_value=False,
                                         key_from=self.namespace + key_from):
+            if not key.startswith(self.namespace):
+                break
             if key.endswith(zero):
                 yield key[len(self.namespace):-4]
 
@@ -59,22 +64,25 @@ class Index(object):
 
 class AccountTxIndex(Index):
 
-    "acct|txnonce > tx"
+    "acct|txnonce > tx, accounts are stored binary"
 
     def __init__(self, i_know_what_im_doing=False):
-        super(AccountTxIndex, self).__init__('tx', i_know_what_im_doing)
+        super(AccountTxIndex, self).__init__(dbkeys.ACCOUNT_TX, i_know_what_im_doing)
+        if dbkeys.needs_migration(self.db):
+            dbkeys.migrate_index(self.db)
 
     def add_transaction(self, account, nonce, transaction_hash):
-        self.add(account, nonce, transaction_hash)
+        self.add(account.decode('hex'), nonce, transaction_hash)
 
     def get_transactions(self, account, offset=0):
-        return self.get(account, offset)
+        return self.get(account.decode('hex'), offset)
 
     def delete_transactions(self, account, offset=0):
-        self.delete(account, offset)
+        self.delete(account.decode('hex'), offset)
 
-    def get_accounts(self, account_from=None):
-        return self.keys(key_from=account_from)
+    def get_accounts(self, account_from=''):
+        for account in self.keys(key_from=(account_from or '').decode('hex')):
+            yield account.encode('hex')
 
     def num_transactions(self, account, start=0):
-        return self.num_values(account)
+        return self.num_values(account.decode('hex'))
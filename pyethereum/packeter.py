@@ -234,10 +234,16 @@ class Packeter(object):
         return self.dump_packet(data)
 
     def dump_Blocks(self, blocks):
-        blocks_as_lists = [rlp.decode(b.serialize()) for b in blocks]
-        # FIXME, can we have a method to append rlp encoded data
-        data = [self.cmd_map_by_name['Blocks']] + blocks_as_lists
-        return self.dump_packet(data)
+        """
+        blocks are Block instances or their serialization (str or buffer),
+        serialized blocks are appended to the packet as they are
+        """
+        cmd = rlp.encode(recursive_int_to_big_endian(self.cmd_map_by_name['Blocks']))
+        payload = bytearray(cmd)
+        for b in blocks:
+            payload.extend(b if isinstance(b, (str, buffer)) else b.serialize())
+        payload = rlp.encode_length(len(payload), 192) + str(payload)
+        return ienc4(self.SYNCHRONIZATION_TOKEN) + ienc4(len(payload)) + payload
 
 
     def dump_GetBlockHashes(self, block_hash, max_blocks):
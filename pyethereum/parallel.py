@@ -0,0 +1,358 @@
+"""
+Optimistic parallel replay of the transactions of a block.
+
+Every transaction is executed speculatively against the state of the parent
+block, in a RecordingBlock which records the account fields and storage
+slots the transaction read and wrote. The results are committed in order:
+a transaction which read nothing written by the transactions committed
+before it in the block saw the state the serial replay would have given it,
+so its writes are applied to the block without executing it again. Any
+other transaction is executed again against the current state of the block.
+Either way the intermediate state roots are the ones of the serial replay.
+
+Balance increases, and decreases covered by the increases of the same
+transaction, are recorded as deltas instead of reads and writes. Deltas
+commute, so the fees which every transaction pays to the coinbase do not
+make all transactions conflict.
+
+Speculation runs in the workers of a ReplayPool, which is forked once by
+configure. Every execution puts into a private OverlayDB, so neither a
+worker nor a speculation in process ever writes to the db.
+"""
+import itertools
+import multiprocessing
+from multiprocessing.queues import SimpleQueue
+import threading
+import logging
+import blocks
+import processblock
+import utils
+from cache import LRUCache
+from db import OverlayDB
+
+logger = logging.getLogger(__name__)
+
+PARALLEL_MIN_TXS = 8  # smaller blocks are replayed serially
+WORKER_CACHE_SIZE = 32 * 1024 ** 2  # bytes of db values cached by a worker
+
+stats = dict(blocks=0, transactions=0, reexecuted=0)
+
+pool = None  # ReplayPool used for received blocks, see configure
+
+
+class TxResult(object):
+
+    """
+    Effects of a transaction executed in a RecordingBlock.
+    fields: (address, name) -> value, slots: (address, index) -> value,
+    deltas: address -> balance increase, touched: addresses marked dirty,
+    deleted: suicided addresses, reads: (address, name or index)
+    """
+
+    def __init__(self, success, output, gas_used, reads, fields, slots,
+                 deltas, touched, deleted):
+        self.success, self.output, self.gas_used = success, output, gas_used
+        self.reads, self.fields, self.slots = reads, fields, slots
+        self.deltas, self.touched, self.deleted = deltas, touched, deleted
+
+    def written(self):
+        "the keys a later transaction must not have read"
+        keys = set(self.fields)
+        for address, index in self.slots:
+            keys.add((address, index))
+            keys.add((address, 'storage'))
+        return keys
+
+
+class RecordingBlock(blocks.Block):
+
+    """
+    Block recording the reads and writes of the transactions applied to it
+    """
+
+    def __init__(self, *args, **kargs):
+        blocks.Block.__init__(self, *args, **kargs)
+        self.reads = set()
+        self.absolute = set()  # balances not changed by deltas only
+        self.start_balances = {}  # address -> balance before the deltas
+        self.written_fields = set()
+        self.slots = {}
+        self.touched = set()
+        self.deleted = set()
+
+    def _get_acct_item(self, address, param):
+        address = utils.normalize_address(address)
+        self.reads.add((address, param))
+        return blocks.Block._get_acct_item(self, address, param)
+
+    def _set_acct_item(self, address, param, value):
+        address = utils.normalize_address(address)
+        self.absolute.add((address, param))
+        blocks.Block._set_acct_item(self, address, param, value)
+
+    def get_acct(self, address):
+        address = utils.normalize_address(address)
+        for name, typ, default in blocks.acct_structure:
+            self.reads.add((address, name))
+        return blocks.Block.get_acct(self, address)
+
+    def get_storage_data(self, address, index):
+        address = utils.normalize_address(address)
+        self.reads.add((address, index))
+        return blocks.Block.get_storage_data(self, address, index)
+
+    def delta_balance(self, address, value):
+        address = utils.normalize_address(address)
+        key = (address, 'balance')
+        if key not in self.reads and key not in self.absolute:
+            acct = self._get_account(address)
+            start = self.start_balances.setdefault(address, acct.balance)
+            if acct.balance - start + value >= 0:  # can not fail
+                self.journal.set(acct, 'balance', acct.balance + value)
+                self.journal.set(acct, 'dirty', True)
+                return True
+        return blocks.Block.delta_balance(self, address, value)
+
+    def commit_state(self):
+        addresses = dict((id(acct), address)
+                         for address, acct in self.accounts.iteritems())
+        for acct, name, index, prev in self.journal.entries:
+            address = addresses[id(acct)]
+            self.touched.add(address)
+            if name is None:
+                # 0 if the account was deleted since
+                self.slots[(address, index)] = acct.storage_cache.get(index, 0)
+            elif name != 'dirty':
+                self.written_fields.add((address, name))
+        blocks.Block.commit_state(self)
+
+    def del_account(self, address):
+        address = utils.normalize_address(address)
+        self.deleted.add(address)
+        blocks.Block.del_account(self, address)
+
+    def result(self, success, output, gas_used):
+        fields, deltas = {}, {}
+        for address, name in self.written_fields:
+            if address in self.deleted:
+                continue
+            acct = self.accounts[address]
+            if name == 'balance' and (address, name) not in self.absolute:
+                deltas[address] = acct.balance - self.start_balances[address]
+            else:
+                fields[(address, name)] = getattr(acct, name)
+        return TxResult(success, output, gas_used, self.reads, fields,
+                        self.slots, deltas, self.touched, self.deleted)
+
+
+def header_fields(block):
+    "the header fields a transaction can see, to build a RecordingBlock"
+    fields = dict((name, getattr(block, name))
+                  for name, typ, default in blocks.block_structure
+                  if name not in ('state_root', 'tx_list_root', 'gas_used', 'nonce'))
+    fields['uncles'] = block.uncles
+    return fields
+
+
+def execute(fields, tx, db, state_root, gas_used):
+    """
+    applies tx in a RecordingBlock with the header fields, at the given
+    state, writing to a private overlay of db.
+    Raises like processblock.apply_transaction.
+    """
+    rblock = RecordingBlock(state_root=state_root, gas_used=gas_used,
+                            db=OverlayDB(db), validation=blocks.TRUSTED,
+                            **fields)
+    success, output = processblock.apply_transaction(rblock, tx)
+    return rblock.result(success, output, rblock.gas_used - gas_used)
+
+
+def speculate(fields, tx, db, state_root):
+    "executes tx first in the block, None if it fails there"
+    try:
+        return execute(fields, tx, db, state_root, 0)
+    except Exception:
+        return None  # not valid on the parent state, executed again
+
+
+def commit(block, tx, result):
+    "applies the effects of tx like processblock.apply_transaction"
+    for address in result.touched:
+        block.journal.set(block._get_account(address), 'dirty', True)
+    for (address, name), value in result.fields.iteritems():
+        block._set_acct_item(address, name, value)
+    for (address, index), value in result.slots.iteritems():
+        block.set_storage_data(address, index, value)
+    for address, delta in result.deltas.iteritems():
+        assert block.delta_balance(address, delta)
+    block.gas_used += result.gas_used
+    block.commit_state()
+    for address in result.deleted:
+        block.del_account(address)
+    block.add_transaction_to_list(tx)
+    return result.success, result.output
+
+
+_channel = None  # (requests, reader, index) in a worker of a ReplayPool
+_values = None  # LRUCache of the db values fetched by a worker
+
+
+def _init_worker(requests, readers, counter):
+    global _channel, _values
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if index < len(readers):  # a respawned worker has none, fails to speculate
+        _channel = (requests, readers[index], index)
+    _values = LRUCache(WORKER_CACHE_SIZE)
+
+
+class _RemoteDB(object):
+
+    """
+    Read only db of the workers, the values are fetched from the replaying
+    process. Only trie nodes and code are read by transactions, their keys
+    are hashes of the values, so cached values never get stale.
+    """
+
+    def get(self, key):
+        value = _values.get(key)
+        if value is None:
+            if _channel is None:
+                raise KeyError(key)
+            requests, reader, index = _channel
+            requests.put((index, key))
+            value = reader.recv()
+            if value is None:
+                raise KeyError(key)
+            _values.put(key, value, size=len(value))
+        return value
+
+_remote_db = _RemoteDB()
+
+
+def _speculate(task):
+    fields, state_root, tx = task
+    return speculate(fields, tx, _remote_db, state_root)
+
+
+class ReplayPool(object):
+
+    """
+    Long lived workers speculating the transactions of replayed blocks.
+    They are forked once and do not share the db of the replaying process:
+    a thread serves them the values of `db`, a snapshot pinned for the
+    replay, each worker has its own pipe for the responses.
+    """
+
+    def __init__(self, processes=0):
+        processes = processes or multiprocessing.cpu_count()
+        self.requests = SimpleQueue()
+        self.pipes = [multiprocessing.Pipe(duplex=False) for i in range(processes)]
+        counter = multiprocessing.Value('i', 0)
+        self.pool = multiprocessing.Pool(
+            processes, _init_worker,
+            (self.requests, [reader for reader, writer in self.pipes], counter))
+        self.db = None  # served to the workers while replaying
+        self.lock = threading.Lock()  # one replay at a time
+        self.server = threading.Thread(target=self._serve)
+        self.server.daemon = True
+        self.server.start()
+
+    def _serve(self):
+        while True:
+            request = self.requests.get()
+            if request is None:  # terminated
+                return
+            index, key = request
+            db = self.db
+            try:
+                value = db.get(key) if db is not None else None
+            except KeyError:
+                value = None
+            except Exception as e:  # the worker must get an answer
+                logger.warn('serving %r failed: %r', key, e)
+                value = None
+            self.pipes[index][1].send(value)
+
+    def speculate(self, fields, state_root, txs):
+        "iterates the results of the transactions executed first in the block"
+        tasks = [(fields, state_root, tx) for tx in txs]
+        return self.pool.imap(_speculate, tasks, chunksize=4)
+
+    def terminate(self):
+        self.pool.terminate()
+        self.requests.put(None)
+
+
+def configure(processes):
+    """
+    sets up the pool replaying the transactions of received blocks.
+    processes: 1 replays serially, 0 uses one worker per cpu
+    """
+    global pool
+    if pool is not None:
+        pool.terminate()
+        pool = None
+    if processes != 1:
+        try:
+            pool = ReplayPool(processes)
+        except OSError as e:
+            logger.warn('replay pool failed: %r', e)
+    return pool
+
+
+def replay(block, txs, replay_pool=None):
+    """
+    applies txs in order to block, an empty block on the state of its parent.
+    Yields (success, output) of each transaction after it is applied.
+    replay_pool: ReplayPool speculating, None speculates in process
+    """
+    if len(txs) < PARALLEL_MIN_TXS:
+        for tx in txs:
+            yield processblock.apply_transaction(block, tx)
+        return
+    assert block.gas_used == 0 and not block.transaction_count
+    fields = header_fields(block)
+    state_root = block.state.root_hash
+    if replay_pool is not None and not replay_pool.lock.acquire(False):
+        replay_pool = None  # used by another replay
+    stats['blocks'] += 1
+    try:
+        if replay_pool is not None:
+            replay_pool.db = block.db.snapshot()
+            results = replay_pool.speculate(fields, state_root, txs)
+        else:
+            results = (speculate(fields, tx, block.db, state_root) for tx in txs)
+        written, deltas, deleted = set(), set(), set()
+        reexecuted = 0
+        for tx, result in itertools.izip(txs, results):
+            if result is None or _conflicts(result, written, deltas, deleted) \
+                    or block.gas_used + tx.startgas > block.gas_limit:
+                result = execute(fields, tx, block.db, block.state.root_hash,
+                                 block.gas_used)
+                reexecuted += 1
+                stats['reexecuted'] += 1
+            written.update(result.written())
+            deltas.update(result.deltas)
+            deleted.update(result.deleted)
+            stats['transactions'] += 1
+            applied = commit(block, tx, result)
+            if block.transaction_count == len(txs):
+                break  # the caller stops after the last one, clean up before
+            yield applied
+    finally:
+        if replay_pool is not None:
+            replay_pool.db = None
+            replay_pool.lock.release()
+    logger.debug('replayed %d transactions, %d executed again', len(txs), reexecuted)
+    yield applied
+
+
+def _conflicts(result, written, deltas, deleted):
+    for key in result.reads:
+        address, name = key
+        if key in written or address in deleted or \
+                (name == 'balance' and address in deltas):
+            return True
+    return False
@@ -1,5 +1,10 @@
 import rlp
 from opcodes import opcodes
+from program import Program
+import compiler
+from tracing import tracers, pblogger
+from cache import LRUCache
+import dbkeys
 
 import utils
 import time
@@ -8,41 +13,63 @@ import transactions
 import trie
 import sys
 import logging
-import json
 import time
 logger = logging.getLogger(__name__)
 
 
 
-class PBLogger(object):
-    log_apply_op = False    # general flag for logging inside apply_op
-    log_op = False          # log op, gas, stack before each op
-    log_pre_state = False   # dump storage at account before execution
-    log_post_state = False  # dump storage at account after execution
-    log_block = False       # dump block after TX was applied
-    log_memory = False      # dump memory before each op
-    log_stack = False       # dump stack before each op
-    log_storage = False     # dump storage before each op
-    log_json = False        # generate machine readable output
 
-    def __init__(self):
-        self.listeners = [] # register callbacks here
+# sha3(code) -> Program, sized by the estimated memory of the Program
+code_cache = LRUCache(16 * 1024 ** 2)
+HOT_CODE_PERSISTED = 256
 
-    def log(self, name, **kargs):
-        # call callbacks
-        for l in self.listeners:
-            l(name, kargs)
-        if self.log_json:
-            logger.debug(json.dumps({name:kargs}))
-        else:
-            order = dict(pc=-2, op=-1, stackargs=1, data=2, code=3)
-            items = sorted(kargs.items(), key=lambda x: order.get(x[0], 0))
-            msg = ", ".join("%s=%s" % (k,v) for k,v in items)
-            logger.debug("%s: %s", name.ljust(15), msg)
+# second execution tier, see compiler
+compile_hot_code = True
+compile_threshold = 8  # messages a program runs interpreted before compiling
+differential_mode = False  # run every transaction in both tiers and compare
+
+# invariant checks and debug hints of the VM, which the spec does not
+# require: the stack items are checked to be ints after every operation and
+# a DUP followed by as many POPs prints the duplicated items
+debug_mode = False
+
+
+def configure_code_cache(max_size):
+    global code_cache
+    code_cache = LRUCache(max_size)
+    return code_cache
+
+
+def get_program(code):
+    codehash = utils.sha3(code)
+    program = code_cache.get(codehash)
+    if program is None:
+        program = Program(code)
+        code_cache.put(codehash, program, size=max(program.size, 1))
+    elif program.segments:  # grows with the compiled segments
+        code_cache.resize(codehash, program.size)
+    return program
 
-pblogger = PBLogger()
 
-code_cache = {}
+def save_code_cache(db, count=HOT_CODE_PERSISTED):
+    "puts the hashes of the most recently executed code, the caller commits"
+    db.put(dbkeys.HOT_CODE_KEY, rlp.encode(code_cache.keys()[-count:]))
+
+
+def load_code_cache(db):
+    "analyses the code saved by save_code_cache, returns the number of programs"
+    if dbkeys.HOT_CODE_KEY not in db:
+        return 0
+    loaded = 0
+    for codehash in rlp.decode(db.get(dbkeys.HOT_CODE_KEY)):
+        try:
+            code = db.get(codehash)  # see utils.encode_hash
+        except KeyError:  # init code of contracts is not stored
+            continue
+        program = Program(code)
+        code_cache.put(codehash, program, size=max(program.size, 1))
+        loaded += 1
+    return loaded
 
 
 GDEFAULT = 1
@@ -78,8 +105,7 @@ def verify(block, parent):
     must_equal('difficulty', block2.difficulty, block.difficulty)
     must_equal('gas limit', block2.gas_limit, block.gas_limit)
     for i in range(block.transaction_count):
-        tx, s, g = rlp.decode(
-            block.transactions.get(rlp.encode(utils.encode_int(i))))
+        tx, s, g = block.get_transaction(i)
         tx = transactions.Transaction.create(tx)
         if not tx.startgas + block2.gas_used <= block.gas_limit:
             raise VerificationFailed('gas_limit', tx.startgas + block2.gas_used, '<=', block.gas_limit)
@@ -102,7 +128,7 @@ class Message(object):
         self.data = data
 
     def __repr__(self):
-        return '<Message(to:%s...)>' % self.to[:8]
+        return '<Message(to:%s...)>' % self.to[:4].encode('hex')
 
 
 class InvalidTransaction(Exception):
@@ -126,8 +152,36 @@ class BlockGasLimitReached(InvalidTransaction):
 class GasPriceTooLow(InvalidTransaction):
     pass
 
+class TierMismatch(Exception):
+    pass
+
 
 def apply_transaction(block, tx):
+    if not differential_mode:
+        return _apply_transaction(block, tx)
+    global compile_hot_code, compile_threshold
+    hot_code, threshold = compile_hot_code, compile_threshold
+    block.commit_state()  # the revert must not drop uncommitted changes
+    snapshot = block.snapshot()
+    try:
+        compile_hot_code = False
+        interpreted = _apply_transaction(block, tx)
+        interpreted += (block.state.root_hash, block.gas_used)
+        block.revert(snapshot)
+        compile_hot_code, compile_threshold = True, 0
+        compiled = _apply_transaction(block, tx)
+        compiled += (block.state.root_hash, block.gas_used)
+    finally:
+        compile_hot_code, compile_threshold = hot_code, threshold
+    if interpreted != compiled:
+        if tracers.enabled:
+            tracers.trace('TIER MISMATCH', tx=tx, interpreted=interpreted,
+                          compiled=compiled)
+        raise TierMismatch(tx, interpreted, compiled)
+    return compiled[:2]
+
+
+def _apply_transaction(block, tx):
 
     def rp(actual, target):
         return '%r, actual:%r target:%r' % (tx, actual, target)
@@ -136,9 +190,13 @@ def apply_transaction(block, tx):
     if not tx.sender:
         raise UnsignedTransaction(tx)
 
+    # addresses are binary from here on
+    sender = utils.normalize_address(tx.sender)
+    coinbase = utils.normalize_address(block.coinbase)
+
     # (2) the transaction nonce is valid (equivalent to the
     #     sender account's current nonce);
-    acctnonce = block.get_nonce(tx.sender)
+    acctnonce = block.get_nonce(sender)
     if acctnonce != tx.nonce:
         raise InvalidNonce(rp(tx.nonce, acctnonce))
 
@@ -151,9 +209,9 @@ def apply_transaction(block, tx):
     # (4) the sender account balance contains at least the
     # cost, v0, required in up-front payment.
     total_cost = tx.value + tx.gasprice * tx.startgas
-    if block.get_balance(tx.sender) < total_cost:
+    if block.get_balance(sender) < total_cost:
         raise InsufficientBalance(
-            rp(block.get_balance(tx.sender), total_cost))
+            rp(block.get_balance(sender), total_cost))
 
     # check offered gas price is enough
     if tx.gasprice < block.min_gas_price:
@@ -164,17 +222,19 @@ def apply_transaction(block, tx):
         raise BlockGasLimitReached(rp(block.gas_used + tx.startgas, block.gas_limit))
 
 
-    pblogger.log('TX NEW', tx=tx.hex_hash(), tx_dict=tx.to_dict())
+    if tracers.enabled:
+        tracers.trace('TX NEW', tx=tx)
     # start transacting #################
-    block.increment_nonce(tx.sender)
+    block.increment_nonce(sender)
 
     # buy startgas
-    success = block.transfer_value(tx.sender, block.coinbase,
+    success = block.transfer_value(sender, coinbase,
                                    tx.gasprice * tx.startgas)
     assert success
 
     message_gas = tx.startgas - intrinsic_gas_used
-    message = Message(tx.sender, tx.to, tx.value, message_gas, tx.data)
+    to = utils.normalize_address(tx.to) if tx.to else CREATE_CONTRACT_ADDRESS
+    message = Message(sender, to, tx.value, message_gas, tx.data)
 
     block.postqueue = [ message ]
     primary_result = None
@@ -194,22 +254,25 @@ def apply_transaction(block, tx):
 
     assert gas_remained >= 0
 
-    pblogger.log("TX APPLIED", result=result, gas_remained=gas_remained,
-                                data=''.join(map(chr, data)).encode('hex'))
-    if pblogger.log_block:
-        pblogger.log('BLOCK', block=block.to_dict(with_state=True, full_transactions=True))
+    if tracers.enabled:
+        tracers.trace('TX APPLIED', result=result, gas_remained=gas_remained,
+                      data=data)
+        tracers.trace('BLOCK', block=block)
 
 
     if not result:  # 0 = OOG failure in both cases
-        pblogger.log('TX FAILED', reason='out of gas', startgas=tx.startgas, gas_remained=gas_remained)
+        if tracers.enabled:
+            tracers.trace('TX FAILED', reason='out of gas', startgas=tx.startgas,
+                          gas_remained=gas_remained)
         block.gas_used += tx.startgas
         output = OUT_OF_GAS
     else:
-        pblogger.log('TX SUCCESS')
+        if tracers.enabled:
+            tracers.trace('TX SUCCESS')
         gas_used = tx.startgas - gas_remained
         # sell remaining gas
         block.transfer_value(
-            block.coinbase, tx.sender, tx.gasprice * gas_remained)
+            coinbase, sender, tx.gasprice * gas_remained)
         block.gas_used += gas_used
         if tx.to:
             output = ''.join(map(chr, data))
@@ -247,7 +310,7 @@ def verify_transaction_spv_proof(block, tx, proof):
 class Compustate():
 
     def __init__(self, **kwargs):
-        self.memory = []
+        self.memory = bytearray()
         self.stack = []
         self.pc = 0
         self.gas = 0
@@ -265,10 +328,9 @@ def decode_datalist(arr):
 
 
 def apply_msg(block, tx, msg, code):
-    pblogger.log("MSG APPLY", tx=tx.hex_hash(), sender=msg.sender, to=msg.to,
-                                  gas=msg.gas, value=msg.value, data=msg.data.encode('hex'))
-    if pblogger.log_pre_state:
-        pblogger.log('MSG PRE STATE', account=msg.to, state=block.account_to_dict(msg.to))
+    if tracers.enabled:
+        tracers.trace('MSG APPLY', tx=tx, msg=msg)
+        tracers.trace('MSG PRE STATE', block=block, account=msg.to)
     # Transfer value, instaquit if not enough
     o = block.transfer_value(msg.sender, msg.to, msg.value)
     if not o:
@@ -276,23 +338,25 @@ def apply_msg(block, tx, msg, code):
     snapshot = block.snapshot()
     compustate = Compustate(gas=msg.gas)
     t, ops = time.time(), 0
-    if code in code_cache:
-        processed_code = code_cache[code]
-    else:
-        processed_code = [opcodes.get(ord(c), ['INVALID', 0, 0, [], 0]) +
-                          [ord(c)] for c in code]
-        code_cache[code] = processed_code
+    program = get_program(code)
+    program.executions += 1
+    hot = compile_hot_code and program.executions > compile_threshold \
+        and not tracers.trace_ops
     # Main loop
     while 1:
-        o = apply_op(block, tx, msg, processed_code, compustate)
+        if hot:
+            segment = compiler.get_segment(program, compustate.pc)
+            if segment is not None and segment(block, tx, msg, compustate):
+                ops += segment.ops
+                continue
+        o = apply_op(block, tx, msg, program, compustate)
         ops += 1
         if o is not None:
-            pblogger.log('MSG APPLIED', result=o, gas_remained=compustate.gas,
-                        sender=msg.sender, to=msg.to, ops=ops,
-                        time_per_op=(time.time() - t) / ops)
-            if pblogger.log_post_state:
-                    pblogger.log('MSG POST STATE', account=msg.to,
-                        state=block.account_to_dict(msg.to))
+            if tracers.enabled:
+                tracers.trace('MSG APPLIED', result=o, gas_remained=compustate.gas,
+                              sender=msg.sender, to=msg.to, ops=ops,
+                              time_per_op=(time.time() - t) / ops)
+                tracers.trace('MSG POST STATE', block=block, account=msg.to)
 
             if o == OUT_OF_GAS:
                 block.revert(snapshot)
@@ -306,18 +370,18 @@ def apply_msg_send(block, tx, msg):
 
 
 def create_contract(block, tx, msg):
-    sender = msg.sender.decode('hex') if len(msg.sender) == 40 else msg.sender
-    if tx.sender != msg.sender:
+    is_origin = utils.normalize_address(tx.sender) == msg.sender
+    if not is_origin:
         block.increment_nonce(msg.sender)
     nonce = utils.encode_int(block.get_nonce(msg.sender) - 1)
-    msg.to = utils.sha3(rlp.encode([sender, nonce]))[12:].encode('hex')
+    msg.to = utils.sha3(rlp.encode([msg.sender, nonce]))[12:]
     assert not block.get_code(msg.to)
     res, gas, dat = apply_msg(block, tx, msg, msg.data)
     if res:
         block.set_code(msg.to, ''.join(map(chr, dat)))
-        return utils.coerce_to_int(msg.to), gas, dat
+        return utils.big_endian_to_int(msg.to), gas, dat
     else:
-        if tx.sender != msg.sender:
+        if not is_origin:
             block.decrement_nonce(msg.sender)
         block.del_account(msg.to)
         return res, gas, dat
@@ -337,15 +401,17 @@ def ceil32(x):
 
 
 def out_of_gas_exception(expense, fee, compustate, op):
-    pblogger.log('OUT OF GAS', expense=expense, needed=fee, available=compustate.gas,
-                 op=op, stack=list(reversed(compustate.stack)))
+    if tracers.enabled:
+        tracers.trace('OUT OF GAS', expense=expense, needed=fee,
+                      available=compustate.gas, op=op,
+                      stack=list(reversed(compustate.stack)))
     return OUT_OF_GAS
 
 
 def mem_extend(mem, compustate, op, newsize):
     if len(mem) < ceil32(newsize):
         m_extend = ceil32(newsize) - len(mem)
-        mem.extend([0] * m_extend)
+        mem.extend(bytearray(m_extend))
         memfee = GMEMORY * (m_extend / 32)
         compustate.gas -= memfee
         if compustate.gas < 0:
@@ -354,236 +420,362 @@ def mem_extend(mem, compustate, op, newsize):
     return True
 
 
+def _padded(data, start, size):
+    "size bytes of data from start, zero padded"
+    dat = data[start: start + size]
+    return dat + '\x00' * (size - len(dat))
+
+
 def to_signed(i):
     return i if i < TT255 else i - TT256
 
 # Does not include paying opfee
-def apply_op(block, tx, msg, processed_code, compustate):
-    if compustate.pc >= len(processed_code):
+def apply_op(block, tx, msg, program, compustate):
+    if compustate.pc >= len(program.ops):
         return []
-    op, in_args, out_args, mem_grabs, fee, opcode = processed_code[compustate.pc]
+    op, in_args, out_args, mem_grabs, fee, opcode = program.ops[compustate.pc]
     # empty stack error
     if in_args > len(compustate.stack):
-        pblogger.log('INSUFFICIENT STACK ERROR', op=op, needed=in_args,
-                     available=len(compustate.stack))
+        if tracers.enabled:
+            tracers.trace('INSUFFICIENT STACK ERROR', op=op, needed=in_args,
+                          available=len(compustate.stack))
         return []
 
     # out of gas error
     if fee > compustate.gas:
         return out_of_gas_exception('base_gas', fee, compustate, op)
 
-    if pblogger.log_apply_op:
-        if pblogger.log_stack:
-            pblogger.log('STK', stk=list(reversed(compustate.stack)))
-
-        if pblogger.log_memory:
-            for i in range(0, len(compustate.memory), 16):
-                memblk = compustate.memory[i:i+16]
-                memline = ' '.join([chr(x).encode('hex') for x in memblk])
-                pblogger.log('MEM', mem=memline)
-
-        if pblogger.log_storage:
-            pblogger.log('STORAGE', storage=block.account_to_dict(msg.to)['storage'])
-
-        if pblogger.log_op:
-            log_args = dict(pc=compustate.pc,
-                            op=op,
-                            stackargs=compustate.stack[-1:-in_args-1:-1],
-                            gas=compustate.gas)
-            if op[:4] == 'PUSH':
-                ind = compustate.pc + 1
-                log_args['value'] = \
-                    utils.bytearray_to_int([x[-1] for x in processed_code[ind: ind + int(op[4:])]])
-            elif op == 'CALLDATACOPY':
-                log_args['data'] = msg.data.encode('hex')
-            pblogger.log('OP', **log_args)
+    if tracers.trace_ops:
+        tracers.trace('OP', block=block, msg=msg, program=program,
+                      compustate=compustate)
 
     # Apply operation
     compustate.gas -= fee
     compustate.pc += 1
+    handler = op_handlers[opcode]
+    if handler is not None:
+        o = handler(block, tx, msg, program, compustate)
+        if o is not None:
+            return o
+    if debug_mode:
+        for a in compustate.stack:
+            assert isinstance(a, (int, long))
+
+
+# Operation handlers
+#
+# op_handlers maps every opcode byte to a handler
+# (block, tx, msg, program, compustate), which is called after the
+# fee is paid and pc is advanced. A handler returning something other than
+# None ends the execution with that result (see apply_msg).
+
+def _op_stop(block, tx, msg, program, compustate):
+    return []
+
+
+def _op_add(block, tx, msg, program, compustate):
     stk = compustate.stack
-    mem = compustate.memory
-    if op == 'STOP' or op == 'INVALID':
-        return []
-    elif op == 'ADD':
-        stk.append((stk.pop() + stk.pop()) % TT256)
-    elif op == 'SUB':
-        stk.append((stk.pop() - stk.pop()) % TT256)
-    elif op == 'MUL':
-        stk.append((stk.pop() * stk.pop()) % TT256)
-    elif op == 'DIV':
-        s0, s1 = stk.pop(), stk.pop()
-        stk.append(0 if s1 == 0 else s0 / s1)
-    elif op == 'MOD':
-        s0, s1 = stk.pop(), stk.pop()
-        stk.append(0 if s1 == 0 else s0 % s1)
-    elif op == 'SDIV':
-        s0, s1 = to_signed(stk.pop()), to_signed(stk.pop())
-        stk.append(0 if s1 == 0 else (s0 / s1) % TT256)
-    elif op == 'SMOD':
-        s0, s1 = to_signed(stk.pop()), to_signed(stk.pop())
-        stk.append(0 if s1 == 0 else (s0 % s1) % TT256)
-    elif op == 'EXP':
-        stk.append(pow(stk.pop(), stk.pop(), TT256))
-    elif op == 'NEG':
-        stk.append(-stk.pop() % TT256)
-    elif op == 'LT':
-        stk.append(1 if stk.pop() < stk.pop() else 0)
-    elif op == 'GT':
-        stk.append(1 if stk.pop() > stk.pop() else 0)
-    elif op == 'SLT':
-        s0, s1 = to_signed(stk.pop()), to_signed(stk.pop())
-        stk.append(1 if s0 < s1 else 0)
-    elif op == 'SGT':
-        s0, s1 = to_signed(stk.pop()), to_signed(stk.pop())
-        stk.append(1 if s0 > s1 else 0)
-    elif op == 'EQ':
-        stk.append(1 if stk.pop() == stk.pop() else 0)
-    elif op == 'NOT':
-        stk.append(0 if stk.pop() else 1)
-    elif op == 'AND':
-        stk.append(stk.pop() & stk.pop())
-    elif op == 'OR':
-        stk.append(stk.pop() | stk.pop())
-    elif op == 'XOR':
-        stk.append(stk.pop() ^ stk.pop())
-    elif op == 'BYTE':
-        s0, s1 = stk.pop(), stk.pop()
-        if s0 >= 32:
-            stk.append(0)
-        else:
-            stk.append((s1 / 256 ** (31 - s0)) % 256)
-    elif op == 'ADDMOD':
-        s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
-        stk.append((s0 + s1) % s2 if s2 else 0)
-    elif op == 'MULMOD':
-        s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
-        stk.append((s0 * s1) % s2 if s2 else 0)
-    elif op == 'SHA3':
-        s0, s1 = stk.pop(), stk.pop()
-        if not mem_extend(mem, compustate, op, s0 + s1):
-            return OUT_OF_GAS
-        data = ''.join(map(chr, mem[s0: s0 + s1]))
-        stk.append(utils.big_endian_to_int(utils.sha3(data)))
-    elif op == 'ADDRESS':
-        stk.append(utils.coerce_to_int(msg.to))
-    elif op == 'BALANCE':
-        stk.append(block.get_balance(utils.coerce_addr_to_hex(stk.pop())))
-    elif op == 'ORIGIN':
-        stk.append(utils.coerce_to_int(tx.sender))
-    elif op == 'CALLER':
-        stk.append(utils.coerce_to_int(msg.sender))
-    elif op == 'CALLVALUE':
-        stk.append(msg.value)
-    elif op == 'CALLDATALOAD':
-        s0 = stk.pop()
-        if s0 >= len(msg.data):
-            stk.append(0)
-        else:
-            dat = msg.data[s0: s0 + 32]
-            stk.append(utils.big_endian_to_int(dat + '\x00' * (32 - len(dat))))
-    elif op == 'CALLDATASIZE':
-        stk.append(len(msg.data))
-    elif op == 'CALLDATACOPY':
-        s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
-        if not mem_extend(mem, compustate, op, s0 + s2):
-            return OUT_OF_GAS
-        for i in range(s2):
-            if s1 + i < len(msg.data):
-                mem[s0 + i] = ord(msg.data[s1 + i])
-            else:
-                mem[s0 + i] = 0
-    elif op == 'GASPRICE':
-        stk.append(tx.gasprice)
-    elif op == 'CODECOPY':
-        s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
-        if not mem_extend(mem, compustate, op, s0 + s2):
-            return OUT_OF_GAS
-        for i in range(s2):
-            if s1 + i < len(processed_code):
-                mem[s0 + i] = processed_code[s1 + i][-1]
-            else:
-                mem[s0 + i] = 0
-    elif op == 'EXTCODESIZE':
-        stk.append(len(block.get_code(stk.pop()) or ''))
-    elif op == 'EXTCODECOPY':
-        addr, s1, s2, s3 = stk.pop(), stk.pop(), stk.pop(), stk.pop()
-        extcode = block.get_code(addr) or ''
-        if not mem_extend(mem, compustate, op, s1 + s3):
-            return OUT_OF_GAS
-        for i in range(s3):
-            if s2 + i < len(extcode):
-                mem[s1 + i] = ord(extcode[s2 + i])
-            else:
-                mem[s1 + i] = 0
-    elif op == 'PREVHASH':
-        stk.append(utils.big_endian_to_int(block.prevhash))
-    elif op == 'COINBASE':
-        stk.append(utils.big_endian_to_int(block.coinbase.decode('hex')))
-    elif op == 'TIMESTAMP':
-        stk.append(block.timestamp)
-    elif op == 'NUMBER':
-        stk.append(block.number)
-    elif op == 'DIFFICULTY':
-        stk.append(block.difficulty)
-    elif op == 'GASLIMIT':
-        stk.append(block.gas_limit)
-    elif op == 'POP':
-        stk.pop()
-    elif op == 'MLOAD':
-        s0 = stk.pop()
-        if not mem_extend(mem, compustate, op, s0 + 32):
-            return OUT_OF_GAS
-        data = ''.join(map(chr, mem[s0: s0 + 32]))
-        stk.append(utils.big_endian_to_int(data))
-    elif op == 'MSTORE':
-        s0, s1 = stk.pop(), stk.pop()
-        if not mem_extend(mem, compustate, op, s0 + 32):
-            return OUT_OF_GAS
-        v = s1
-        for i in range(31, -1, -1):
-            mem[s0 + i] = v % 256
-            v /= 256
-    elif op == 'MSTORE8':
-        s0, s1 = stk.pop(), stk.pop()
-        if not mem_extend(mem, compustate, op, s0 + 1):
-            return OUT_OF_GAS
-        mem[s0] = s1 % 256
-    elif op == 'SLOAD':
-        stk.append(block.get_storage_data(msg.to, stk.pop()))
-    elif op == 'SSTORE':
-        s0, s1 = stk.pop(), stk.pop()
-        pre_occupied = GSTORAGE if block.get_storage_data(msg.to, s0) else 0
-        post_occupied = GSTORAGE if s1 else 0
-        gascost = GSTORAGE + post_occupied - pre_occupied
-        if compustate.gas < gascost:
-            out_of_gas_exception('sstore trie expansion', gascost, compustate, op)
-        compustate.gas -= gascost
-        block.set_storage_data(msg.to, s0, s1)
-    elif op == 'JUMP':
-        compustate.pc = stk.pop()
-    elif op == 'JUMPI':
-        s0, s1 = stk.pop(), stk.pop()
-        if s1:
-            compustate.pc = s0
-    elif op == 'PC':
-        stk.append(compustate.pc)
-    elif op == 'MSIZE':
-        stk.append(len(mem))
-    elif op == 'GAS':
-        stk.append(compustate.gas)  # AFTER subtracting cost 1
-    elif op[:4] == 'PUSH':
-        pushnum = int(op[4:])
-        dat = [x[-1] for x in processed_code[compustate.pc: compustate.pc + pushnum]]
+    stk.append((stk.pop() + stk.pop()) % TT256)
+
+
+def _op_sub(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append((stk.pop() - stk.pop()) % TT256)
+
+
+def _op_mul(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append((stk.pop() * stk.pop()) % TT256)
+
+
+def _op_div(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = stk.pop(), stk.pop()
+    stk.append(0 if s1 == 0 else s0 / s1)
+
+
+def _op_mod(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = stk.pop(), stk.pop()
+    stk.append(0 if s1 == 0 else s0 % s1)
+
+
+def _op_sdiv(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = to_signed(stk.pop()), to_signed(stk.pop())
+    stk.append(0 if s1 == 0 else (s0 / s1) % TT256)
+
+
+def _op_smod(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = to_signed(stk.pop()), to_signed(stk.pop())
+    stk.append(0 if s1 == 0 else (s0 % s1) % TT256)
+
+
+def _op_exp(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(pow(stk.pop(), stk.pop(), TT256))
+
+
+def _op_neg(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(-stk.pop() % TT256)
+
+
+def _op_lt(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(1 if stk.pop() < stk.pop() else 0)
+
+
+def _op_gt(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(1 if stk.pop() > stk.pop() else 0)
+
+
+def _op_slt(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = to_signed(stk.pop()), to_signed(stk.pop())
+    stk.append(1 if s0 < s1 else 0)
+
+
+def _op_sgt(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = to_signed(stk.pop()), to_signed(stk.pop())
+    stk.append(1 if s0 > s1 else 0)
+
+
+def _op_eq(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(1 if stk.pop() == stk.pop() else 0)
+
+
+def _op_not(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(0 if stk.pop() else 1)
+
+
+def _op_and(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(stk.pop() & stk.pop())
+
+
+def _op_or(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(stk.pop() | stk.pop())
+
+
+def _op_xor(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(stk.pop() ^ stk.pop())
+
+
+def _op_byte(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = stk.pop(), stk.pop()
+    if s0 >= 32:
+        stk.append(0)
+    else:
+        stk.append((s1 / 256 ** (31 - s0)) % 256)
+
+
+def _op_addmod(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
+    stk.append((s0 + s1) % s2 if s2 else 0)
+
+
+def _op_mulmod(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
+    stk.append((s0 * s1) % s2 if s2 else 0)
+
+
+def _op_sha3(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(mem, compustate, 'SHA3', s0 + s1):
+        return OUT_OF_GAS
+    data = str(mem[s0: s0 + s1])
+    stk.append(utils.big_endian_to_int(utils.sha3(data)))
+
+
+def _op_address(block, tx, msg, program, compustate):
+    compustate.stack.append(utils.big_endian_to_int(msg.to))
+
+
+def _op_balance(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(block.get_balance(utils.int_to_addr(stk.pop())))
+
+
+def _op_origin(block, tx, msg, program, compustate):
+    compustate.stack.append(utils.coerce_to_int(tx.sender))
+
+
+def _op_caller(block, tx, msg, program, compustate):
+    compustate.stack.append(utils.big_endian_to_int(msg.sender))
+
+
+def _op_callvalue(block, tx, msg, program, compustate):
+    compustate.stack.append(msg.value)
+
+
+def _op_calldataload(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0 = stk.pop()
+    if s0 >= len(msg.data):
+        stk.append(0)
+    else:
+        dat = msg.data[s0: s0 + 32]
+        stk.append(utils.big_endian_to_int(dat + '\x00' * (32 - len(dat))))
+
+
+def _op_calldatasize(block, tx, msg, program, compustate):
+    compustate.stack.append(len(msg.data))
+
+
+def _op_calldatacopy(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(mem, compustate, 'CALLDATACOPY', s0 + s2):
+        return OUT_OF_GAS
+    mem[s0: s0 + s2] = _padded(msg.data, s1, s2)
+
+
+def _op_gasprice(block, tx, msg, program, compustate):
+    compustate.stack.append(tx.gasprice)
+
+
+def _op_codecopy(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    s0, s1, s2 = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(mem, compustate, 'CODECOPY', s0 + s2):
+        return OUT_OF_GAS
+    mem[s0: s0 + s2] = _padded(program.code, s1, s2)
+
+
+def _op_extcodesize(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(len(block.get_code(utils.int_to_addr(stk.pop())) or ''))
+
+
+def _op_extcodecopy(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    addr, s1, s2, s3 = stk.pop(), stk.pop(), stk.pop(), stk.pop()
+    extcode = block.get_code(utils.int_to_addr(addr)) or ''
+    if not mem_extend(mem, compustate, 'EXTCODECOPY', s1 + s3):
+        return OUT_OF_GAS
+    mem[s1: s1 + s3] = _padded(extcode, s2, s3)
+
+
+def _op_prevhash(block, tx, msg, program, compustate):
+    compustate.stack.append(utils.big_endian_to_int(block.prevhash))
+
+
+def _op_coinbase(block, tx, msg, program, compustate):
+    compustate.stack.append(utils.big_endian_to_int(block.coinbase.decode('hex')))
+
+
+def _op_timestamp(block, tx, msg, program, compustate):
+    compustate.stack.append(block.timestamp)
+
+
+def _op_number(block, tx, msg, program, compustate):
+    compustate.stack.append(block.number)
+
+
+def _op_difficulty(block, tx, msg, program, compustate):
+    compustate.stack.append(block.difficulty)
+
+
+def _op_gaslimit(block, tx, msg, program, compustate):
+    compustate.stack.append(block.gas_limit)
+
+
+def _op_pop(block, tx, msg, program, compustate):
+    compustate.stack.pop()
+
+
+def _op_mload(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    s0 = stk.pop()
+    if not mem_extend(mem, compustate, 'MLOAD', s0 + 32):
+        return OUT_OF_GAS
+    stk.append(utils.big_endian_to_int(str(mem[s0: s0 + 32])))
+
+
+def _op_mstore(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(mem, compustate, 'MSTORE', s0 + 32):
+        return OUT_OF_GAS
+    mem[s0: s0 + 32] = utils.zpad(utils.int_to_big_endian(s1), 32)
+
+
+def _op_mstore8(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(mem, compustate, 'MSTORE8', s0 + 1):
+        return OUT_OF_GAS
+    mem[s0] = s1 % 256
+
+
+def _op_sload(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    stk.append(block.get_storage_data(msg.to, stk.pop()))
+
+
+def _op_sstore(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = stk.pop(), stk.pop()
+    pre_occupied = GSTORAGE if block.get_storage_data(msg.to, s0) else 0
+    post_occupied = GSTORAGE if s1 else 0
+    gascost = GSTORAGE + post_occupied - pre_occupied
+    if compustate.gas < gascost:
+        out_of_gas_exception('sstore trie expansion', gascost, compustate, 'SSTORE')
+    compustate.gas -= gascost
+    block.set_storage_data(msg.to, s0, s1)
+
+
+def _op_jump(block, tx, msg, program, compustate):
+    compustate.pc = compustate.stack.pop()
+
+
+def _op_jumpi(block, tx, msg, program, compustate):
+    stk = compustate.stack
+    s0, s1 = stk.pop(), stk.pop()
+    if s1:
+        compustate.pc = s0
+
+
+def _op_pc(block, tx, msg, program, compustate):
+    compustate.stack.append(compustate.pc)
+
+
+def _op_msize(block, tx, msg, program, compustate):
+    compustate.stack.append(len(compustate.memory))
+
+
+def _op_gas(block, tx, msg, program, compustate):
+    compustate.stack.append(compustate.gas)  # AFTER subtracting cost 1
+
+
+def _mk_op_push(pushnum):
+    def _op_push(block, tx, msg, program, compustate):
+        # pc is already past the PUSH
+        compustate.stack.append(program.push_values[compustate.pc - 1])
         compustate.pc += pushnum
-        stk.append(utils.bytearray_to_int(dat))
-    elif op[:3] == 'DUP':
-        depth = int(op[3:])
+    return _op_push
+
+
+def _mk_op_dup(depth):
+    def _op_dup(block, tx, msg, program, compustate):
+        stk = compustate.stack
         # DUP POP POP Debug hint
-        is_debug = 1
-        for i in range(depth):
-            if compustate.pc + i < len(processed_code) and \
-                    processed_code[compustate.pc + i][0] != 'POP':
+        is_debug = debug_mode
+        for i in range(depth if is_debug else 0):
+            if compustate.pc + i < len(program.ops) and \
+                    program.ops[compustate.pc + i][0] != 'POP':
                 is_debug = 0
                 break
         if is_debug:
@@ -593,96 +785,139 @@ def apply_op(block, tx, msg, processed_code, compustate):
             stk.append(stackargs[-1])
         else:
             stk.append(stk[-depth])
-    elif op[:4] == 'SWAP':
-        depth = int(op[4:])
+    return _op_dup
+
+
+def _mk_op_swap(depth):
+    def _op_swap(block, tx, msg, program, compustate):
+        stk = compustate.stack
         temp = stk[-depth-1]
         stk[-depth-1] = stk[-1]
         stk[-1] = temp
-    elif op == 'CREATE':
-        value, mstart, msz = stk.pop(), stk.pop(), stk.pop()
-        if not mem_extend(mem, compustate, op, mstart + msz):
-            return OUT_OF_GAS
-        data = ''.join(map(chr, mem[mstart: mstart + msz]))
-        pblogger.log('SUB CONTRACT NEW', sender=msg.to, value=value, data=data.encode('hex'))
-        create_msg = Message(msg.to, '', value, compustate.gas, data)
-        addr, gas, code = create_contract(block, tx, create_msg)
-        pblogger.log('SUB CONTRACT OUT', address=addr, code=code)
-        if addr:
-            stk.append(addr)
-            compustate.gas = gas
-        else:
-            stk.append(0)
-            compustate.gas = 0
-    elif op == 'CALL':
-        gas, to, value, meminstart, meminsz, memoutstart, memoutsz = \
-            stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
-        new_memsize = max(meminstart + meminsz, memoutstart + memoutsz)
-        if not mem_extend(mem, compustate, op, new_memsize):
-            return OUT_OF_GAS
-        if compustate.gas < gas:
-            return out_of_gas_exception('subcall gas', gas, compustate, op)
-        compustate.gas -= gas
-        to = utils.encode_int(to)
-        to = (('\x00' * (32 - len(to))) + to)[12:].encode('hex')
-        data = ''.join(map(chr, mem[meminstart: meminstart + meminsz]))
-        pblogger.log('SUB CALL NEW', sender=msg.to, to=to, value=value, gas=gas, data=data.encode('hex'))
-        call_msg = Message(msg.to, to, value, gas, data)
-        result, gas, data = apply_msg_send(block, tx, call_msg)
-        pblogger.log('SUB CALL OUT', result=result, data=data, length=len(data), expected=memoutsz)
-        if result == 0:
-            stk.append(0)
-        else:
-            stk.append(1)
-            compustate.gas += gas
-            for i in range(min(len(data), memoutsz)):
-                mem[memoutstart + i] = data[i]
-    elif op == 'RETURN':
-        s0, s1 = stk.pop(), stk.pop()
-        if not mem_extend(mem, compustate, op, s0 + s1):
-            return OUT_OF_GAS
-        return mem[s0: s0 + s1]
-    elif op == 'POST':
-        gas, to, value, meminstart, meminsz = \
-            stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
-        if not mem_extend(mem, compustate, op, meminstart + meminsz):
-            return OUT_OF_GAS
-        if compustate.gas < gas:
-            return out_of_gas_exception('subcall gas', gas, compustate, op)
-        compustate.gas -= gas
-        to = utils.encode_int(to)
-        to = (('\x00' * (32 - len(to))) + to)[12:].encode('hex')
-        data = ''.join(map(chr, mem[meminstart: meminstart + meminsz]))
-        pblogger.log('POST NEW', sender=msg.to, to=to, value=value, gas=gas, data=data.encode('hex'))
-        post_msg = Message(msg.to, to, value, gas, data)
-        block.postqueue.append(post_msg)
-    elif op == 'CALL_STATELESS':
-        gas, to, value, meminstart, meminsz, memoutstart, memoutsz = \
-            stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
-        new_memsize = max(meminstart + meminsz, memoutstart + memoutsz)
-        if not mem_extend(mem, compustate, op, new_memsize):
-            return OUT_OF_GAS
-        if compustate.gas < gas:
-            return out_of_gas_exception('subcall gas', gas, compustate, op)
-        compustate.gas -= gas
-        to = utils.encode_int(to)
-        to = (('\x00' * (32 - len(to))) + to)[12:].encode('hex')
-        data = ''.join(map(chr, mem[meminstart: meminstart + meminsz]))
-        pblogger.log('SUB CALL NEW', sender=msg.to, to=to, value=value, gas=gas, data=data.encode('hex'))
-        call_msg = Message(msg.to, msg.to, value, gas, data)
-        result, gas, data = apply_msg(block, tx, call_msg, block.get_code(to))
-        pblogger.log('SUB CALL OUT', result=result, data=data, length=len(data), expected=memoutsz)
-        if result == 0:
-            stk.append(0)
+    return _op_swap
+
+
+def _op_create(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    value, mstart, msz = stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(mem, compustate, 'CREATE', mstart + msz):
+        return OUT_OF_GAS
+    data = str(mem[mstart: mstart + msz])
+    create_msg = Message(msg.to, '', value, compustate.gas, data)
+    if tracers.enabled:
+        tracers.trace('SUB CONTRACT NEW', msg=create_msg)
+    addr, gas, code = create_contract(block, tx, create_msg)
+    if tracers.enabled:
+        tracers.trace('SUB CONTRACT OUT', address=addr, code=code)
+    if addr:
+        stk.append(addr)
+        compustate.gas = gas
+    else:
+        stk.append(0)
+        compustate.gas = 0
+
+
+def _op_call(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    gas, to, value, meminstart, meminsz, memoutstart, memoutsz = \
+        stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
+    new_memsize = max(meminstart + meminsz, memoutstart + memoutsz)
+    if not mem_extend(mem, compustate, 'CALL', new_memsize):
+        return OUT_OF_GAS
+    if compustate.gas < gas:
+        return out_of_gas_exception('subcall gas', gas, compustate, 'CALL')
+    compustate.gas -= gas
+    to = utils.int_to_addr(to)
+    data = str(mem[meminstart: meminstart + meminsz])
+    call_msg = Message(msg.to, to, value, gas, data)
+    if tracers.enabled:
+        tracers.trace('SUB CALL NEW', msg=call_msg)
+    result, gas, data = apply_msg_send(block, tx, call_msg)
+    if tracers.enabled:
+        tracers.trace('SUB CALL OUT', result=result, data=data, length=len(data),
+                      expected=memoutsz)
+    if result == 0:
+        stk.append(0)
+    else:
+        stk.append(1)
+        compustate.gas += gas
+        n = min(len(data), memoutsz)
+        mem[memoutstart: memoutstart + n] = bytearray(data[:n])
+
+
+def _op_return(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    s0, s1 = stk.pop(), stk.pop()
+    if not mem_extend(mem, compustate, 'RETURN', s0 + s1):
+        return OUT_OF_GAS
+    return list(mem[s0: s0 + s1])
+
+
+def _op_post(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    gas, to, value, meminstart, meminsz = \
+        stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
+    if not mem_extend(mem, compustate, 'POST', meminstart + meminsz):
+        return OUT_OF_GAS
+    if compustate.gas < gas:
+        return out_of_gas_exception('subcall gas', gas, compustate, 'POST')
+    compustate.gas -= gas
+    to = utils.int_to_addr(to)
+    data = str(mem[meminstart: meminstart + meminsz])
+    post_msg = Message(msg.to, to, value, gas, data)
+    if tracers.enabled:
+        tracers.trace('POST NEW', msg=post_msg)
+    block.postqueue.append(post_msg)
+
+
+def _op_call_stateless(block, tx, msg, program, compustate):
+    stk, mem = compustate.stack, compustate.memory
+    gas, to, value, meminstart, meminsz, memoutstart, memoutsz = \
+        stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop(), stk.pop()
+    new_memsize = max(meminstart + meminsz, memoutstart + memoutsz)
+    if not mem_extend(mem, compustate, 'CALL_STATELESS', new_memsize):
+        return OUT_OF_GAS
+    if compustate.gas < gas:
+        return out_of_gas_exception('subcall gas', gas, compustate, 'CALL_STATELESS')
+    compustate.gas -= gas
+    to = utils.int_to_addr(to)
+    data = str(mem[meminstart: meminstart + meminsz])
+    call_msg = Message(msg.to, msg.to, value, gas, data)
+    if tracers.enabled:
+        tracers.trace('SUB CALL NEW', msg=call_msg, code_from=to)
+    result, gas, data = apply_msg(block, tx, call_msg, block.get_code(to))
+    if tracers.enabled:
+        tracers.trace('SUB CALL OUT', result=result, data=data, length=len(data),
+                      expected=memoutsz)
+    if result == 0:
+        stk.append(0)
+    else:
+        stk.append(1)
+        compustate.gas += gas
+        n = min(len(data), memoutsz)
+        mem[memoutstart: memoutstart + n] = bytearray(data[:n])
+
+
+def _op_suicide(block, tx, msg, program, compustate):
+    to = utils.int_to_addr(compustate.stack.pop())
+    block.transfer_value(msg.to, to, block.get_balance(msg.to))
+    block.suicides.append(msg.to)
+    return []
+
+
+def _mk_op_handlers():
+    # bytes which are no opcode are INVALID and stop the execution.
+    # Opcodes without a handler (CODESIZE) only charge their fee.
+    handlers = [_op_stop] * 256
+    for opcode, (name, ins, outs, memuses, fee) in opcodes.items():
+        if name.startswith('PUSH'):
+            handlers[opcode] = _mk_op_push(int(name[4:]))
+        elif name.startswith('DUP'):
+            handlers[opcode] = _mk_op_dup(int(name[3:]))
+        elif name.startswith('SWAP'):
+            handlers[opcode] = _mk_op_swap(int(name[4:]))
         else:
-            stk.append(1)
-            compustate.gas += gas
-            for i in range(min(len(data), memoutsz)):
-                mem[memoutstart + i] = data[i]
-    elif op == 'SUICIDE':
-        to = utils.encode_int(stk.pop())
-        to = (('\x00' * (32 - len(to))) + to)[12:].encode('hex')
-        block.transfer_value(msg.to, to, block.get_balance(msg.to))
-        block.suicides.append(msg.to)
-        return []
-    for a in stk:
-        assert isinstance(a, (int, long))
+            handlers[opcode] = globals().get('_op_' + name.lower())
+    return handlers
+
+op_handlers = _mk_op_handlers()
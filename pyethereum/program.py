@@ -0,0 +1,57 @@
+"""
+Contract code analysed once before it is executed.
+
+The interpreter (processblock.apply_op) works on the decoded opcodes of a
+Program instead of the raw code. PUSH immediates are decoded to integers
+up front. There is no JUMPDEST, a jump may land on any byte, so every
+byte is decoded, including the ones inside PUSH data.
+"""
+from opcodes import opcodes
+import utils
+
+INVALID = ['INVALID', 0, 0, [], 0]
+
+# decoded opcode of every byte value, shared by all programs
+DECODED = [tuple(opcodes.get(i, INVALID)) + (i,) for i in range(256)]
+
+# estimated memory of the analysis in bytes (CPython 2, 64 bit): the ops and
+# push_values slots of every code byte and the decoded immediates
+SIZE_PER_BYTE = 24
+SIZE_PER_PUSH = 32
+
+
+class Program(object):
+
+    """
+    ops[i]: (name, ins, outs, memuses, fee, opcode) of the byte at i
+    push_values[i]: the immediate of a PUSH at i, None for other bytes
+    executions: number of messages which ran the program
+    segments: pc -> compiled segment or None, see compiler
+    size: estimated memory in bytes, including the compiled segments
+    """
+    __slots__ = ['code', 'ops', 'push_values', 'executions', 'segments', 'size']
+
+    def __init__(self, code):
+        self.code = code
+        self.executions = 0
+        self.segments = {}
+        self.ops = []
+        self.push_values = []
+        for i, c in enumerate(code):
+            decoded = DECODED[ord(c)]
+            self.ops.append(decoded)
+            name = decoded[0]
+            if name[:4] == 'PUSH':
+                n = int(name[4:])
+                # immediates running over the end of the code are shorter
+                self.push_values.append(int(utils.big_endian_to_int(code[i + 1: i + 1 + n])))
+            else:
+                self.push_values.append(None)
+        pushes = len(self.push_values) - self.push_values.count(None)
+        self.size = len(code) + SIZE_PER_BYTE * len(code) + SIZE_PER_PUSH * pushes
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __repr__(self):
+        return '<Program(%d bytes)>' % len(self.code)
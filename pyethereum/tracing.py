@@ -0,0 +1,155 @@
+"""
+Tracing of transaction and VM execution.
+
+The VM reports events to the tracers registered with `tracers`, e.g.
+
+    if tracers.enabled:
+        tracers.trace('MSG APPLY', tx=tx, msg=msg)
+
+Without tracers an instrumentation point costs the attribute check only,
+the event data is not even built. Events carry the live objects (tx, msg,
+block, compustate, ...), a tracer formats what it needs. The events of
+every single operation ('OP', with block, msg, program and compustate) are
+only sent while a tracer sets trace_ops.
+
+PBLogger, the default tracer, writes the events to the debug log.
+"""
+import json
+import logging
+logger = logging.getLogger('pyethereum.processblock')
+
+
+class Tracer(object):
+
+    trace_ops = False  # receive the 'OP' event before every operation
+
+    def trace(self, name, data):
+        pass
+
+
+class Tracers(object):
+
+    def __init__(self):
+        self.tracers = []
+        self.enabled = False  # any tracer registered
+        self.trace_ops = False  # any tracer wants the 'OP' events
+
+    def register(self, tracer):
+        if tracer not in self.tracers:
+            self.tracers.append(tracer)
+        self.update()
+
+    def unregister(self, tracer):
+        if tracer in self.tracers:
+            self.tracers.remove(tracer)
+        self.update()
+
+    def update(self):
+        "to be called after the trace_ops of a registered tracer changed"
+        self.enabled = bool(self.tracers)
+        self.trace_ops = any(t.trace_ops for t in self.tracers)
+
+    def trace(self, name, **data):
+        for tracer in self.tracers:
+            tracer.trace(name, data)
+
+tracers = Tracers()
+
+
+def _hex(data):
+    if isinstance(data, list):
+        data = ''.join(map(chr, data))
+    return str(data).encode('hex')
+
+
+class PBLogger(Tracer):
+
+    log_op = False          # log op, gas, stack before each op
+    log_pre_state = False   # dump storage at account before execution
+    log_post_state = False  # dump storage at account after execution
+    log_block = False       # dump block after TX was applied
+    log_memory = False      # dump memory before each op
+    log_stack = False       # dump stack before each op
+    log_storage = False     # dump storage before each op
+    log_json = False        # generate machine readable output
+    _log_apply_op = False
+
+    @property
+    def log_apply_op(self):
+        "general flag for logging inside apply_op"
+        return self._log_apply_op
+
+    @log_apply_op.setter
+    def log_apply_op(self, value):
+        self._log_apply_op = value
+        tracers.update()
+
+    trace_ops = log_apply_op
+
+    def trace(self, name, data):
+        for name, kargs in self.format(name, data):
+            self.emit(name, kargs)
+
+    def format(self, name, data):
+        "the (name, printable values) entries of an event"
+        if name == 'OP':
+            return self._format_op(**data)
+        if name == 'BLOCK':
+            if not self.log_block:
+                return []
+            data = dict(block=data['block'].to_dict(with_state=True,
+                                                    full_transactions=True))
+        elif name in ('MSG PRE STATE', 'MSG POST STATE'):
+            if not (self.log_pre_state if name == 'MSG PRE STATE' else self.log_post_state):
+                return []
+            data = dict(account=data['account'].encode('hex'),
+                        state=data['block'].account_to_dict(data['account']))
+        kargs = {}
+        for k, v in data.items():
+            if k == 'tx':
+                kargs['tx'] = v.hex_hash()
+                if name == 'TX NEW':
+                    kargs['tx_dict'] = v.to_dict()
+            elif k == 'msg':
+                kargs.update(sender=v.sender.encode('hex'), to=v.to.encode('hex'),
+                             value=v.value, gas=v.gas, data=v.data.encode('hex'))
+            elif k in ('sender', 'to', 'data', 'code_from'):
+                kargs[k] = _hex(v)
+            else:
+                kargs[k] = v
+        return [(name, kargs)]
+
+    def _format_op(self, block, msg, program, compustate):
+        entries = []
+        if self.log_stack:
+            entries.append(('STK', dict(stk=list(reversed(compustate.stack)))))
+        if self.log_memory:
+            for i in range(0, len(compustate.memory), 16):
+                memblk = compustate.memory[i:i+16]
+                memline = ' '.join([chr(x).encode('hex') for x in memblk])
+                entries.append(('MEM', dict(mem=memline)))
+        if self.log_storage:
+            entries.append(('STORAGE', dict(storage=block.account_to_dict(msg.to)['storage'])))
+        if self.log_op:
+            op, in_args = program.ops[compustate.pc][:2]
+            log_args = dict(pc=compustate.pc,
+                            op=op,
+                            stackargs=compustate.stack[-1:-in_args-1:-1],
+                            gas=compustate.gas)
+            if op[:4] == 'PUSH':
+                log_args['value'] = program.push_values[compustate.pc]
+            elif op == 'CALLDATACOPY':
+                log_args['data'] = msg.data.encode('hex')
+            entries.append(('OP', log_args))
+        return entries
+
+    def emit(self, name, kargs):
+        if self.log_json:
+            logger.debug(json.dumps({name:kargs}))
+        else:
+            order = dict(pc=-2, op=-1, stackargs=1, data=2, code=3)
+            items = sorted(kargs.items(), key=lambda x: order.get(x[0], 0))
+            msg = ", ".join("%s=%s" % (k,v) for k,v in items)
+            logger.debug("%s: %s", name.ljust(15), msg)
+
+pblogger = PBLogger()
@@ -2,6 +2,16 @@ import rlp
 from bitcoin import encode_pubkey
 from bitcoin import ecdsa_raw_sign, ecdsa_raw_recover
 import utils
+from cache import LRUCache
+
+# (signing hash, v, r, s) -> recovered sender, shared by all transactions
+sender_cache = LRUCache(16384)
+
+
+def configure_sender_cache(max_size):
+    global sender_cache
+    sender_cache = LRUCache(max_size)
+    return sender_cache
 
 tx_structure = [
     ["nonce", "int", 0],
@@ -46,17 +56,26 @@ class Transaction(object):
         self.value = value
         self.data = data
         self.v, self.r, self.s = v, r, s
+        self._sender = None  # recovered on first access
 
-        # Determine sender
-        if self.r and self.s:
-            rawhash = utils.sha3(self.serialize(False))
-            pub = encode_pubkey(
-                ecdsa_raw_recover(rawhash, (self.v, self.r, self.s)),
-                'bin')
-            self.sender = utils.sha3(pub[1:])[-20:].encode('hex')
-        # does not include signature
-        else:
-            self.sender = 0
+    @property
+    def sender(self):
+        "hex address of the signer, 0 if the transaction is not signed"
+        if self._sender is None:
+            args = self.recovery_args()
+            sender = sender_cache.get(args)
+            if sender is None:
+                sender = recover_sender(args)
+                sender_cache.put(args, sender)
+            self._sender = sender
+        return self._sender
+
+    @sender.setter
+    def sender(self, value):
+        self._sender = value
+
+    def recovery_args(self):
+        return utils.sha3(self.serialize(False)), self.v, self.r, self.s
 
     @classmethod
     def deserialize(cls, rlpdata):
@@ -86,13 +105,17 @@ class Transaction(object):
         rawhash = utils.sha3(self.serialize(False))
         self.v, self.r, self.s = ecdsa_raw_sign(rawhash, key)
         self.sender = utils.privtoaddr(key)
+        sender_cache.put((rawhash, self.v, self.r, self.s), self.sender)
         return self
 
-    def serialize(self, signed=True):
+    def list_serialize(self, signed=True):
         o = []
         for i, (name, typ, default) in enumerate(tx_structure):
             o.append(utils.encoders[typ](getattr(self, name)))
-        return rlp.encode(o if signed else o[:-3])
+        return o if signed else o[:-3]
+
+    def serialize(self, signed=True):
+        return rlp.encode(self.list_serialize(signed))
 
     def hex_serialize(self, signed=True):
         return self.serialize(signed).encode('hex')
@@ -121,6 +144,47 @@ class Transaction(object):
         return '<Transaction(%s)>' % self.hex_hash()[:4]
 
 
+def recover_sender(args):
+    "(rawhash, v, r, s) -> hex address of the signer or 0"
+    rawhash, v, r, s = args
+    if not (r and s):  # does not include signature
+        return 0
+    pub = encode_pubkey(ecdsa_raw_recover(rawhash, (v, r, s)), 'bin')
+    return utils.sha3(pub[1:])[-20:].encode('hex')
+
+
+def _try_recover_sender(args):
+    try:
+        return recover_sender(args)
+    except Exception:
+        return None  # raised again on access of tx.sender
+
+
+def recover_senders(txs, pool=None):
+    """
+    recovers the senders of a batch of transactions at once, in the
+    multiprocessing pool if given. Transactions whose sender is known or
+    cached are skipped.
+    """
+    pending = {}  # args -> transactions, duplicates are recovered once
+    for tx in txs:
+        if tx._sender is None:
+            args = tx.recovery_args()
+            tx._sender = sender_cache.get(args)
+            if tx._sender is None:
+                pending.setdefault(args, []).append(tx)
+    tasks = pending.keys()
+    if pool is not None and tasks:
+        senders = pool.map(_try_recover_sender, tasks, chunksize=8)
+    else:
+        senders = map(_try_recover_sender, tasks)
+    for args, sender in zip(tasks, senders):
+        for tx in pending[args]:
+            tx._sender = sender
+        if sender is not None:
+            sender_cache.put(args, sender)
+
+
 def contract(nonce, gasprice, startgas, endowment, code, v=0, r=0, s=0):
     ''' a contract is a special transaction without the `to` arguments
     '''
@@ -66,6 +66,20 @@ def coerce_addr_to_hex(x):
         return zpad(x, 20)[-20:].encode('hex')
 
 
+def normalize_address(x):
+    '''returns the 20 byte binary form of a binary or hex address'''
+    if len(x) == 20:
+        return x
+    if len(x) == 40:
+        return x.decode('hex')
+    raise Exception("Address must be 20 bytes or 40 hex chars long")
+
+
+def int_to_addr(x):
+    '''returns the address in the lower 20 bytes of an integer'''
+    return zpad(int_to_big_endian(x), 20)[-20:]
+
+
 def coerce_to_int(x):
     if isinstance(x, (int, long)):
         return x
@@ -297,6 +311,10 @@ def get_db_path():
     return os.path.join(data_dir.path, 'statedb')
 
 
+def get_blockstore_path():
+    return os.path.join(data_dir.path, 'blocks')
+
+
 def get_index_path():
     return os.path.join(data_dir.path, 'indexdb')
 
@@ -0,0 +1,80 @@
+import pyethereum.blocks as blocks
+import pyethereum.blockstore as blockstore
+import pyethereum.transactions as transactions
+import pyethereum.miner as miner
+import pyethereum.utils as utils
+import pyethereum.rlp as rlp
+from pyethereum.db import DB as DB
+from pyethereum.packeter import packeter
+from tests.utils import set_db
+
+import logging
+logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+logger = logging.getLogger()
+
+
+def accounts():
+    k = utils.sha3('cow')
+    v = utils.privtoaddr(k)
+    k2 = utils.sha3('horse')
+    v2 = utils.privtoaddr(k2)
+    return k, v, k2, v2
+
+
+def mkquickgenesis(initial_alloc={}):
+    "set INITIAL_DIFFICULTY to a value that is quickly minable"
+    return blocks.genesis(initial_alloc, difficulty=2 ** 16)
+
+
+def mine_next_block(parent, transactions=[]):
+    m = miner.Miner(parent, uncles=[], coinbase=parent.coinbase)
+    for tx in transactions:
+        m.add_transaction(tx)
+    blk = m.mine(steps=1000 ** 2)
+    assert blk is not False, "Mining failed. Use mkquickgenesis!"
+    return blk
+
+
+def get_transaction(nonce=0):
+    k, v, k2, v2 = accounts()
+    return transactions.Transaction(
+        nonce, 0, startgas=10000,
+        to=v2, value=utils.denoms.finney * 10, data='').sign(k)
+
+
+def db_store(blk):
+    utils.db_put(blk.hash, blk.serialize())
+    assert blocks.get_block(blk.hash) == blk
+
+
+def test_blockstore():
+    k, v, k2, v2 = accounts()
+    set_db()
+    db = DB(utils.get_db_path())
+    store = blockstore.BlockStore(utils.get_blockstore_path(), db,
+                                  segment_size=1000)
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    # blocks stored in the db before the blockstore are still found
+    db_store(blk)
+    chain = [blk]
+    for i in range(3):
+        chain.append(mine_next_block(chain[-1],
+                                     transactions=[get_transaction(nonce=i)]))
+        store.put(chain[-1].hash, chain[-1].serialize())
+    db.commit()
+    assert store.segments.segment > 0  # rolled over
+    for b in chain[1:]:
+        assert b.hash in store
+        assert str(store.get(b.hash)) == b.serialize()
+        assert blocks.has_block(b.hash)
+        assert blocks.get_block(b.hash) == b
+    assert blk.hash not in store
+    assert blocks.get_block(blk.hash) == blk
+    # reopen
+    del blockstore.segments[store.segments.path]
+    store = blockstore.BlockStore(utils.get_blockstore_path(), db)
+    assert str(store.get(chain[-1].hash)) == chain[-1].serialize()
+    # serialized blocks are sent as they are
+    assert packeter.dump_Blocks([store.get(b.hash) for b in chain[1:]]) == \
+        packeter.dump_packet([packeter.cmd_map_by_name['Blocks']] +
+                             [rlp.decode(b.serialize()) for b in chain[1:]])
@@ -0,0 +1,28 @@
+from pyethereum.cache import LRUCache
+
+
+def test_lru_cache():
+    c = LRUCache(10)
+    c.put('a', 1, size=4)
+    c.put('b', 2, size=4)
+    assert c.get('a') == 1  # b is oldest now
+    c.put('c', 3, size=4)
+    assert 'b' not in c and c.get('b') is None
+    assert c.size == 8 and c.evictions == 1
+    c.put('d', 4, size=11)  # too large
+    assert 'd' not in c
+    assert c.to_dict()['hits'] == 1 and c.to_dict()['misses'] == 1
+
+
+def test_lru_cache_resize():
+    c = LRUCache(10)
+    c.put('a', 1, size=4)
+    c.put('b', 2, size=4)
+    c.resize('b', 5)  # keeps its position, evicts the older entries
+    assert c.size == 9 and c.keys() == ['a', 'b']
+    c.resize('b', 7)
+    assert c.keys() == ['b'] and c.size == 7 and c.evictions == 1
+    c.resize('b', 11)  # too large
+    assert len(c) == 0 and c.size == 0
+    c.resize('x', 1)  # not cached
+    assert len(c) == 0
@@ -8,6 +8,8 @@ import pyethereum.rlp as rlp
 import pyethereum.trie as trie
 import pyethereum.miner as miner
 import pyethereum.utils as utils
+import pyethereum.dbkeys as dbkeys
+import pyethereum.tracing as tracing
 from pyethereum.db import DB as DB
 from pyethereum.config import get_default_config
 from tests.utils import set_db
@@ -30,6 +32,14 @@ pblogger.log_op = True           # log op, gas, stack before each op
 pblogger.log_json = False        # generate machine readable output
 
 
+@pytest.fixture(autouse=True)
+def trace(monkeypatch):
+    "traces to the debug log while a test of this module runs"
+    monkeypatch.setattr(tracing, 'tracers', tracing.Tracers())
+    monkeypatch.setattr(processblock, 'tracers', tracing.tracers)
+    tracing.tracers.register(pblogger)
+
+
 @pytest.fixture(scope="module")
 def genesis_fixture():
     """
@@ -116,6 +126,31 @@ def test_db():
     assert a != DB(utils.get_db_path())
 
 
+def test_block_at_snapshot():
+    k, v, k2, v2 = accounts()
+    set_db()
+    blk = blocks.genesis({v: utils.denoms.ether * 1})
+    blk.commit_state()
+    snapshot = blk.db.snapshot()
+    pinned = blk.at_snapshot(snapshot)
+    blk.delta_balance(v, utils.denoms.ether)
+    blk.commit_state()
+    blk.db.commit()
+    assert pinned.state.db == snapshot
+    assert pinned.get_balance(v) == utils.denoms.ether * 1
+    assert blk.get_balance(v) == utils.denoms.ether * 2
+    # contract code is stored in the snapshot too, see apiserver.get_trace
+    db = DB(utils.get_db_path())
+    db.commit()
+    child = blocks.Block.init_from_parent(pinned, v, db=snapshot)
+    child.set_code(v2, 'code')
+    child.commit_state()
+    child.reset_cache()
+    assert child.get_code(v2) == 'code'
+    assert utils.sha3('code') in snapshot and not db.uncommitted
+    assert utils.sha3('code') not in db
+
+
 def test_transfer():
     k, v, k2, v2 = accounts()
     blk = blocks.genesis({v: utils.denoms.ether * 1})
@@ -323,6 +358,59 @@ def test_block_serialization_same_db():
         blocks.Block.deserialize(blk2.serialize()).hex_hash()
 
 
+def test_block_trusted_deserialization():
+    k, v, k2, v2 = accounts()
+    set_db()
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    db_store(blk)
+    blk2 = mine_next_block(blk, transactions=[get_transaction()])
+    trusted = blocks.Block.deserialize(blk2.serialize(), validation=blocks.TRUSTED)
+    assert trusted == blk2
+    assert trusted.transaction_count == 1
+    assert trusted.get_transactions() == blk2.get_transactions()
+    assert trusted.get_balance(v2) == utils.denoms.finney * 10
+    # no checks at all
+    header = blk2.list_header()
+    header[-1] = 'invalid nonce'.ljust(32)
+    data = rlp.encode([header, [], []])
+    blocks.Block.deserialize(data, validation=blocks.TRUSTED)
+    with pytest.raises(Exception):
+        blocks.Block.deserialize(data)
+
+
+def test_block_transaction_list():
+    k, v, k2, v2 = accounts()
+    set_db()
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    db_store(blk)
+    blk2 = blocks.Block.init_from_parent(blk, v)
+    txs = [get_transaction(nonce=i) for i in range(5)]
+    for tx in txs[:3]:
+        success, output = processblock.apply_transaction(blk2, tx)
+        assert success
+    # the trie is built when the root is needed
+    assert blk2._tx_trie_count == 0
+    root = blk2.tx_list_root
+    assert blk2._tx_trie_count == 3
+    snapshot = blk2.snapshot()
+    for tx in txs[3:]:
+        blk2.add_transaction_to_list(tx)
+    assert blk2.transaction_count == 5
+    blk2.revert(snapshot)
+    assert blk2.transaction_count == 3
+    assert blk2.tx_list_root == root
+    t = trie.Trie(blk2.db, trie.BLANK_ROOT)
+    for i, tx in enumerate(txs[:3]):
+        t.update(rlp.encode(utils.encode_int(i)),
+                 rlp.encode(blk2.get_transaction(i)))
+    assert t.root_hash == root
+    assert blk2.get_transactions() == txs[:3]
+    blk2.finalize()
+    blk3 = blocks.Block.deserialize(blk2.serialize())
+    assert blk3.tx_list_root == root
+    assert blk3.get_transactions() == txs[:3]
+
+
 def test_block_serialization_other_db():
     k, v, k2, v2 = accounts()
     # mine two blocks
@@ -396,6 +484,119 @@ def test_transaction():
     assert blk.get_balance(v2) == utils.denoms.finney * 10
 
 
+def test_db_keys_migration():
+    k, v, k2, v2 = accounts()
+    set_db()
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    db_store(blk)
+    tx = get_transaction()
+    blk2 = mine_next_block(blk, transactions=[tx])
+    db_store(blk2)
+    db = DB(utils.get_db_path())
+    db.put('ci:' + blk.hash, rlp.encode([blk2.hash]))
+    db.put('blocknumber:1', blk2.hash)
+    db.put('difficulty:' + blk2.hex_hash(), utils.encode_int(42))
+    db.put(tx.hash, rlp.encode([blk2.hash, '']))
+    db.commit()
+    assert dbkeys.needs_migration(db)
+    assert dbkeys.migrate(db, batch_size=2) == 4
+    assert not dbkeys.needs_migration(db)
+    for key in ('ci:' + blk.hash, 'blocknumber:1', tx.hash,
+                'difficulty:' + blk2.hex_hash()):
+        assert key not in db
+    assert db.get(dbkeys.children(blk.hash)) == rlp.encode([blk2.hash])
+    assert db.get(dbkeys.block_number(1)) == blk2.hash
+    assert db.get(dbkeys.chain_difficulty(blk2.hash)) == utils.encode_int(42)
+    assert db.get(dbkeys.transaction(tx.hash)) == rlp.encode([blk2.hash, ''])
+
+
+def test_blocks_by_number_range():
+    import pyethereum.chainmanager as chainmanager
+    set_db()
+    db = DB(utils.get_db_path())
+    index = chainmanager.Index(db)
+    for n in (2, 10, 300):
+        db.put(dbkeys.block_number(n), utils.sha3(str(n)))
+    db.commit()
+    db.put(dbkeys.block_number(9), utils.sha3('9'))
+    assert index.get_blocks_by_number(2, 299) == \
+        [(n, utils.sha3(str(n))) for n in (2, 9, 10)]
+
+
+def test_chain_difficulty_without_recursion():
+    set_db()
+    db = DB(utils.get_db_path())
+    idx = dict((name, i) for i, (name, typ, d) in enumerate(blocks.block_structure))
+    header = blocks.genesis().list_header()
+    db.put(utils.sha3(rlp.encode(header)), rlp.encode([header, [], []]))
+    for number in range(1, 3000):
+        header = header[:]
+        header[idx['prevhash']] = utils.sha3(rlp.encode(header))
+        header[idx['number']] = utils.encode_int(number)
+        header[idx['difficulty']] = utils.encode_int(number)
+        db.put(utils.sha3(rlp.encode(header)), rlp.encode([header, [], []]))
+    db.commit()
+    top = blocks.get_block_header(utils.sha3(rlp.encode(header)))
+    assert top.chain_difficulty() == \
+        blocks.INITIAL_DIFFICULTY + sum(range(1, 3000))
+
+
+def test_ancestor_index():
+    import collections
+    import pyethereum.chainmanager as chainmanager
+    set_db()
+    index = chainmanager.Index(DB(utils.get_db_path()), index_transactions=False)
+    FakeBlock = collections.namedtuple('FakeBlock', 'number hash prevhash')
+
+    def mkchain(parent, length, branch):
+        chain = [parent]
+        for i in range(length):
+            p = chain[-1]
+            blk = FakeBlock(p.number + 1, utils.sha3(branch + str(p.number + 1)), p.hash)
+            index.add_block(blk)
+            chain.append(blk)
+        return chain
+
+    genesis = FakeBlock(0, utils.sha3('genesis'), blocks.GENESIS_PREVHASH)
+    index.add_block(genesis)
+    main = mkchain(genesis, 100, 'main')
+    side = mkchain(main[60], 15, 'side')
+    for distance in (0, 1, 2, 3, 37, 64, 99, 100):
+        assert index.get_ancestor(main[100], distance) == main[100 - distance].hash
+    assert index.get_ancestor(side[15], 15) == main[60].hash
+    assert index.get_ancestor(side[15], 20) == main[55].hash
+    assert index.get_common_ancestor(main[100], side[15]) == main[60].hash
+    assert index.get_common_ancestor(side[3], main[61]) == main[60].hash
+    assert index.get_common_ancestor(main[80], main[20]) == main[20].hash
+    assert index.get_common_ancestor(main[1], side[1]) == main[1].hash
+
+
+def test_ancestor_index_backfill(monkeypatch):
+    import pyethereum.chainmanager as chainmanager
+    set_db()
+    db = DB(utils.get_db_path())
+    idx = dict((name, i) for i, (name, typ, d) in enumerate(blocks.block_structure))
+    # blocks stored before the ancestor index existed
+    header = blocks.genesis().list_header()
+    hashes = [utils.sha3(rlp.encode(header))]
+    db.put(hashes[-1], rlp.encode([header, [], []]))
+    for number in range(1, 300):
+        header = header[:]
+        header[idx['prevhash']] = hashes[-1]
+        header[idx['number']] = utils.encode_int(number)
+        hashes.append(utils.sha3(rlp.encode(header)))
+        db.put(hashes[-1], rlp.encode([header, [], []]))
+    db.commit()
+    index = chainmanager.Index(db, index_transactions=False)
+    top = blocks.get_block_header(hashes[-1])
+    assert index.get_ancestor(top, 299) == hashes[0]
+    # indexed by the first lookup, later ones do not walk the headers
+    assert all(dbkeys.ancestors(h) in db for h in hashes)
+    monkeypatch.setattr(blocks.BlockHeader, 'get_parent_header', None)
+    for distance in (1, 100, 257):
+        assert index.get_ancestor(top, distance) == hashes[299 - distance]
+
+
 def test_transaction_serialization():
     k, v, k2, v2 = accounts()
     tx = get_transaction()
@@ -531,6 +732,235 @@ def test_reward_unlces():
     assert cm.head.get_balance(uncle_coinbase) == blocks.UNCLE_REWARD
 
 
+def test_block_headers():
+    set_db()
+    blk0 = mkquickgenesis()
+    cm = get_chainmanager(genesis=blk0)
+    blk1 = mine_next_block(blk0)
+    cm.add_block(blk1)
+    uncle = mine_next_block(blk0, coinbase='2' * 40)
+    cm.add_block(uncle)
+    assert cm.get_uncles(cm.head) == []
+    blk2 = mine_next_block(blk1)
+    cm.add_block(blk2)
+    assert cm.get_uncles(blk2) == [uncle]
+    blk3 = mine_next_block(blk2, uncles=[uncle])
+    cm.add_block(blk3)
+    assert dbkeys.header(blk3.hash) in cm.blockchain
+    header = blocks.get_block_header(blk3.hash)
+    assert header == blk3 and blk3 == header
+    assert header.number == 3
+    assert header.uncles == [uncle.list_header()]
+    assert header.get_parent_header() == blk2
+    assert header.get_parent_header().get_parent_header().has_parent()
+    assert header.get_block() == blk3
+    assert header.total_difficulty == cm.head_difficulty == \
+        sum(b.difficulty for b in (blk0, blk1, blk2, blk3, uncle))
+    with pytest.raises(blocks.UnknownParentException):
+        blocks.get_block_header(blk0.hash).get_parent_header()
+    # blocks stored without header record
+    blk4 = mine_next_block(blk3)
+    db_store(blk4)
+    assert blocks.get_block_header(blk4.hash) == blk4
+
+
+def test_block_cache():
+    set_db()
+    blk0 = mkquickgenesis()
+    cm = get_chainmanager(genesis=blk0)
+    cache = blocks.configure_cache(max_bytes=1, max_headers=1, max_pinned=2)
+    blk1 = mine_next_block(blk0)
+    cm.add_block(blk1)
+    blk2 = mine_next_block(blk1)
+    cm.add_block(blk2)
+    assert [h.hash for h in cache.pinned_chain] == [blk1.hash, blk2.hash]
+    # evicted from the LRUs but pinned
+    assert len(cache.blocks) == 0
+    hits = cache.pinned_hits
+    assert cm.head is cm.head
+    assert blocks.get_block_header(blk1.hash) == blk1
+    assert cache.pinned_hits == hits + 3
+    assert cache.to_dict()['pinned']['entries'] == 2
+    blocks.configure_cache(32 * 1024 ** 2, 8192, 256)
+
+
+def test_prevalidate_received_blocks():
+    import pyethereum.chainmanager as chainmanager
+    set_db()
+    blk = mkquickgenesis()
+    db_store(blk)
+    remote_blocks = []
+    for i in range(3):
+        blk = mine_next_block(blk)
+        db_store(blk)
+        remote_blocks.append(blk)
+    set_db()
+    cm = get_chainmanager(genesis=mkquickgenesis())
+    transient_blocks = [blocks.TransientBlock(b.serialize()) for b in remote_blocks]
+    assert blocks.check_header(remote_blocks[0].list_header(), []) is None
+    min_batch = chainmanager.PREVALIDATION_MIN_BATCH
+    chainmanager.PREVALIDATION_MIN_BATCH = 2
+    try:
+        for processes in (1, 2):
+            chainmanager.configure_prevalidation_pool(processes)
+            assert cm.prevalidate(transient_blocks) is None
+            bad = blocks.TransientBlock(remote_blocks[1].serialize())
+            bad.header_args[-1] = utils.sha3(bad.header_args[-1])
+            invalid = cm.prevalidate(transient_blocks[:1] + [bad] + transient_blocks[2:])
+            assert invalid == (bad, 'invalid PoW')
+    finally:
+        chainmanager.PREVALIDATION_MIN_BATCH = min_batch
+        chainmanager.configure_prevalidation_pool(1)
+    # the whole batch is dropped
+    cm.receive_chain([transient_blocks[0], bad, transient_blocks[2]])
+    assert remote_blocks[0].hash not in cm
+
+
+def test_account_cache():
+    k, v, k2, v2 = accounts()
+    set_db()
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    root = blk.state_root
+    acct = blk._get_account(v.decode('hex'))
+    assert not acct.dirty and blk.get_balance(v) == utils.denoms.ether
+    snapshot = blk.snapshot()
+    blk.delta_balance(v, -1)
+    blk.set_storage_data(v2, 1, 42)
+    assert acct.dirty and blk._get_account(v2.decode('hex')).dirty
+    blk.revert(snapshot)
+    assert not acct.dirty and blk.get_balance(v) == utils.denoms.ether
+    assert blk.get_storage_data(v2, 1) == 0
+    assert blk.state_root == root and not blk.journal
+    # only dirty accounts are written, the accounts stay cached
+    blk.delta_balance(v, -1)
+    blk.commit_state()
+    assert blk.state_root != root and not acct.dirty
+    assert blk._get_account(v.decode('hex')) is acct
+    # reverting beyond a commit drops the cache
+    blk.revert(snapshot)
+    assert blk.state_root == root and v.decode('hex') not in blk.accounts
+    assert blk.get_balance(v) == utils.denoms.ether
+
+
+def test_binary_addresses():
+    k, v, k2, v2 = accounts()
+    assert utils.normalize_address(v) == v.decode('hex')
+    assert utils.normalize_address(v.decode('hex')) == v.decode('hex')
+    with pytest.raises(Exception):
+        utils.normalize_address(v[:-1])
+    assert utils.int_to_addr(utils.big_endian_to_int(v.decode('hex'))) == v.decode('hex')
+    assert utils.int_to_addr(2 ** 160 + 1) == '\x00' * 19 + '\x01'
+    set_db()
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    blk.delta_balance(v.decode('hex'), 1)
+    assert blk.get_balance(v) == utils.denoms.ether + 1
+    assert len(blk.accounts) == 1
+    tx = get_transaction(nonce=0)
+    success, output = processblock.apply_transaction(blk, tx)
+    assert success
+    assert all(len(a) == 20 for a in blk.accounts)
+
+
+def test_journal_checkpoints():
+    k, v, k2, v2 = accounts()
+    set_db()
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    root = blk.state_root
+    outer = blk.snapshot()
+    blk.set_storage_data(v, 1, 1)
+    inner = blk.snapshot()
+    blk.set_storage_data(v, 1, 2)
+    blk.set_storage_data(v, 2, 3)
+    blk.delta_balance(v, -1)
+    assert len(blk.journal) == 5
+    blk.revert(inner)  # discard the nested frame
+    assert blk.get_storage_data(v, 1) == 1
+    assert blk.get_storage_data(v, 2) == 0
+    assert blk.get_balance(v) == utils.denoms.ether
+    inner = blk.snapshot()
+    blk.set_storage_data(v, 2, 3)
+    # the nested frame is kept and reverted with the outer one
+    blk.revert(outer)
+    assert len(blk.journal) == 0
+    assert blk.get_storage_data(v, 1) == blk.get_storage_data(v, 2) == 0
+    assert blk.state_root == root
+
+
+def test_revert_deleted_account():
+    k, v, k2, v2 = accounts()
+    set_db()
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    root = blk.state_root
+    blk.increment_nonce(v)  # uncommitted, like the purchase of the gas
+    snapshot = blk.snapshot()
+    blk.set_storage_data(v, 1, 1)
+    blk.transfer_value(v, v2, 1)
+    blk.del_account(v2)  # like a failing CREATE
+    assert blk.get_balance(v2) == 0
+    blk.revert(snapshot)
+    assert blk.get_nonce(v) == 1
+    assert blk.get_storage_data(v, 1) == 0
+    assert blk.get_balance(v) == utils.denoms.ether
+    # deleted accounts are removed from the state by the commit
+    blk.transfer_value(v, v2, 1)
+    blk.del_account(v2)
+    blk.commit_state()
+    assert blk.state.get(v2.decode('hex')) == ''
+    assert v2.decode('hex') not in blk.accounts
+    blk.decrement_nonce(v)
+    blk.delta_balance(v, 1)
+    assert blk.state_root == root
+
+
+def test_receive_chain_recovers_senders():
+    k, v, k2, v2 = accounts()
+    tx = get_transaction()
+    # received blocks are replayed with the senders recovered in a batch
+    set_db()
+    blk = mkquickgenesis({v: utils.denoms.ether * 1})
+    db_store(blk)
+    remote = mine_next_block(blk, transactions=[tx])
+    db_store(remote)
+    set_db()
+    cm = get_chainmanager(genesis=mkquickgenesis({v: utils.denoms.ether * 1}))
+    t_block = blocks.TransientBlock(remote.serialize())
+    cm.receive_chain([t_block])
+    assert t_block.transactions[0]._sender == v
+    assert remote.hash in cm
+
+
+def test_block_hashes_after_shorter_reorg(monkeypatch):
+    import threading
+    import pyethereum.chainmanager as chainmanager
+    set_db()
+    blk0 = mkquickgenesis()
+    cm = get_chainmanager(genesis=blk0)
+    chain_a = [blk0]
+    for i in range(3):
+        chain_a.append(mine_next_block(chain_a[-1]))
+        cm.add_block(chain_a[-1])
+    chain_b = [blk0]
+    for i in range(2):
+        chain_b.append(mine_next_block(chain_b[-1], coinbase='2' * 40))
+        cm.add_block(chain_b[-1])
+    assert cm.head == chain_a[-1]
+    # a shorter, heavier chain becomes the head
+    cm._update_head(chain_b[-1], cm.head_difficulty + 1)
+    assert cm.index.get_block_by_number(3) == chain_a[3].hash  # left over
+    assert not cm.in_main_branch(chain_a[3])
+    assert not cm.snapshot().in_main_branch(chain_a[3])
+    assert cm.in_main_branch(chain_b[2])
+
+    class Peer(object):
+        lock = threading.Lock()
+
+        def send_BlockHashes(self, hashes):
+            self.hashes = hashes
+    peer = Peer()
+    monkeypatch.setattr(chainmanager, 'chain_manager', cm)
+    chainmanager.handle_get_block_hashes(None, chain_a[3].hash, 10, peer)
+    assert peer.hashes == [b.hash for b in reversed(chain_a[:3])]
+
 # TODO ##########################################
 #
 # test for remote block with invalid transaction
@@ -1,6 +1,7 @@
 import os
 import pytest
 from pyethereum import tester
+from pyethereum import tracing
 import serpent
 import logging
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
@@ -18,6 +19,14 @@ pblogger.log_op = True           # log op, gas, stack before each op
 pblogger.log_apply_op = True     # log op, gas, stack before each op
 pblogger.log_json = False        # generate machine readable output
 
+
+@pytest.fixture(autouse=True)
+def trace(monkeypatch):
+    "traces to the debug log while a test of this module runs"
+    monkeypatch.setattr(tracing, 'tracers', tracing.Tracers())
+    monkeypatch.setattr(tester.pb, 'tracers', tracing.tracers)
+    tracing.tracers.register(pblogger)
+
 gasprice = 0
 startgas = 10000
 
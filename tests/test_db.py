@@ -0,0 +1,91 @@
+import pytest
+import pyethereum.db
+import pyethereum.utils as utils
+from pyethereum.db import DB as DB
+from tests.utils import set_db
+
+import logging
+logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+logger = logging.getLogger()
+
+
+def test_db_snapshot():
+    set_db()
+    db = DB(utils.get_db_path())
+    db.put('a', '1')
+    db.commit()
+    db.put('b', '1')
+    snapshot = db.snapshot()
+    db.put('a', '2')
+    db.put('b', '2')
+    db.put('c', '2')
+    db.commit()
+    assert snapshot.get('a') == '1'
+    assert snapshot.get('b') == '1'
+    assert 'c' not in snapshot
+    snapshot.put('c', '3')
+    assert snapshot.get('c') == '3'
+    assert db.get('c') == '2'
+
+
+def test_db_stats():
+    set_db()
+    stats = pyethereum.db.enable_stats(utils.get_db_path())
+    db = DB(utils.get_db_path())
+    db.put('a', '1')
+    db.put('a', '2')
+    db.put('b', '1')
+    db.get('a')
+    db.commit()
+    db.get('a')
+    with pytest.raises(KeyError):
+        db.get('c')
+    db.commit()
+    first, second = stats.commits
+    assert first['keys'] == 2
+    assert first['bytes'] == 4
+    assert first['puts'] == 3
+    assert first['duplicate_puts'] == 1
+    assert first['gets_uncommitted'] == 1
+    assert second['gets_disk'] == 1
+    assert second['gets_missing'] == 1
+    assert stats.totals['keys'] == 2
+    assert stats.to_dict()['commit_latency']['count'] == 2
+
+
+def test_db_async_commit():
+    set_db()
+    writer = pyethereum.db.enable_async_commit(utils.get_db_path(), sync_every=2)
+    db = DB(utils.get_db_path())
+    for i in range(20):
+        db.put('k%d' % i, str(i))
+        db.put('last', str(i))
+        db.commit()
+        assert db.get('k%d' % i) == str(i)
+        assert db.get('last') == str(i)
+    snapshot = db.snapshot()
+    db.flush()
+    assert not writer.pending
+    assert db.db.Get('last') == '19'
+    assert snapshot.get('k19') == '19'
+
+
+def test_db_async_commit_failure():
+    class FailingDB(object):
+        def Write(self, batch, sync=False):
+            raise IOError('disk full')
+    set_db()
+    db = DB(utils.get_db_path())
+    writer = pyethereum.db.AsyncWriter(FailingDB(), max_pending=1)
+    writer.start()
+    pyethereum.db.writers[utils.get_db_path()] = writer
+    db.put('a', '1')
+    db.commit()
+    with pytest.raises(IOError):
+        db.flush()
+    assert db.get('a') == '1'  # still pending
+    db.put('b', '1')
+    with pytest.raises(IOError):
+        db.commit()
+    assert db.uncommitted == {'b': '1'}
+    assert len(writer.pending) == 1
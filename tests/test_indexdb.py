@@ -1,9 +1,11 @@
 import sys
 import os
+import struct
 import pytest
 import pyethereum.indexdb
 import pyethereum.utils
 import pyethereum.db
+import pyethereum.dbkeys
 from tests.utils import set_db
 import logging
 logging.basicConfig(level=logging.DEBUG, format='%(message)s')
@@ -33,6 +35,20 @@ def test_appending():
     assert idx.num_values(key) == 2
     assert list(idx.get(key)) == vals
 
+
+def test_legacy_keys_migration():
+    set_db()
+    db = pyethereum.db.DB(pyethereum.utils.get_index_path())
+    acct = act(42)
+    for nonce in range(3):
+        db.put('tx' + acct + struct.pack('>I', nonce), mktx(42, nonce))
+    db.commit()
+    idx = pyethereum.indexdb.AccountTxIndex(i_know_what_im_doing=True)
+    assert not pyethereum.dbkeys.needs_migration(db)
+    assert list(idx.get_transactions(acct)) == [mktx(42, n) for n in range(3)]
+    assert list(idx.get_accounts()) == [acct]
+    assert 'tx' + acct + struct.pack('>I', 0) not in db
+
 @pytest.mark.xfail # db deleting broken
 def test_adding(idx):
     acct = act(10000)
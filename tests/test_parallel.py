@@ -0,0 +1,129 @@
+import os
+import multiprocessing
+import pyethereum.processblock as processblock
+import pyethereum.parallel as parallel
+import pyethereum.blocks as blocks
+import pyethereum.transactions as transactions
+import pyethereum.miner as miner
+import pyethereum.utils as utils
+import pyethereum.rlp as rlp
+from pyethereum.db import DB as DB
+from tests.utils import set_db
+
+import logging
+logging.basicConfig(level=logging.DEBUG, format='%(message)s')
+logger = logging.getLogger()
+
+
+def mkquickgenesis(initial_alloc={}):
+    "set INITIAL_DIFFICULTY to a value that is quickly minable"
+    return blocks.genesis(initial_alloc, difficulty=2 ** 16)
+
+
+def mine_next_block(parent, transactions=[]):
+    m = miner.Miner(parent, uncles=[], coinbase=parent.coinbase)
+    for tx in transactions:
+        m.add_transaction(tx)
+    blk = m.mine(steps=1000 ** 2)
+    assert blk is not False, "Mining failed. Use mkquickgenesis!"
+    return blk
+
+
+def db_store(blk):
+    utils.db_put(blk.hash, blk.serialize())
+    assert blocks.get_block(blk.hash) == blk
+
+
+def replay(genesis, remote, replay_pool):
+    "the (state root, gas used) after each transaction of remote replayed"
+    blk = blocks.Block.init_from_parent(genesis, remote.coinbase,
+                                        extra_data=remote.extra_data,
+                                        timestamp=remote.timestamp,
+                                        uncles=remote.uncles)
+    roots = []
+    for success, output in parallel.replay(blk, remote.get_transactions(),
+                                           replay_pool):
+        roots.append((blk.state.root_hash, utils.encode_int(blk.gas_used)))
+    return blk, roots
+
+
+def test_parallel_replay(monkeypatch):
+    keys = [utils.sha3('parallel%d' % i) for i in range(10)]
+    addrs = [utils.privtoaddr(k) for i, k in enumerate(keys)]
+    set_db()
+    genesis = mkquickgenesis(dict((a, utils.denoms.ether) for a in addrs))
+    db_store(genesis)
+
+    def transfer(k, nonce, to):
+        return transactions.Transaction(nonce, 1, 10000, to,
+                                        utils.denoms.finney, '').sign(k)
+    # independent transfers
+    txs = [transfer(k, 0, utils.sha3(k)[:20].encode('hex')) for k in keys[:8]]
+    txs.append(transfer(keys[0], 1, addrs[9]))  # same sender, conflicts
+    txs.append(transfer(keys[9], 0, addrs[1]))  # reads a changed balance
+    # contract creation storing 42 at 0
+    code = ''.join(map(chr, [0x60, 42, 0x60, 0, 0x57]))
+    txs.append(transactions.contract(1, 1, 10000, 0, code).sign(keys[1]))
+    remote = mine_next_block(genesis, transactions=txs)
+    assert remote.transaction_count == len(txs)
+    expected = [(r, g) for tx, r, g in remote._list_transactions()]
+    replay_pool = parallel.ReplayPool(2)
+    try:
+        for p in (None, replay_pool):  # in process and in workers
+            stats = dict(parallel.stats)
+            blk, roots = replay(genesis, remote, p)
+            assert roots == expected
+            assert parallel.stats['transactions'] == stats['transactions'] + len(txs)
+            reexecuted = parallel.stats['reexecuted'] - stats['reexecuted']
+            assert 0 < reexecuted < len(txs) / 2
+        # used by deserialize_child, which checks every state root
+        monkeypatch.setattr(parallel, 'pool', replay_pool)
+        monkeypatch.setattr(processblock, 'tracers', processblock.tracers.__class__())
+        blk = genesis.deserialize_child(remote.serialize())
+        assert blk.state.root_hash == remote.state.root_hash
+        assert parallel.stats['blocks'] == stats['blocks'] + 2
+    finally:
+        replay_pool.terminate()
+
+
+def test_replay_workers_do_not_write(monkeypatch):
+    from pyethereum.opcodes import reverse_opcodes as op
+    keys = [utils.sha3('create%d' % i) for i in range(10)]
+    set_db()
+    genesis = mkquickgenesis(dict((utils.privtoaddr(k), utils.denoms.ether)
+                                  for k in keys))
+    db_store(genesis)
+    # init code returning the 32 byte word 42 as code
+    init = ''.join(map(chr, [op['PUSH1'], 42, op['PUSH1'], 0, op['MSTORE'],
+                             op['PUSH1'], 32, op['PUSH1'], 0, op['RETURN']]))
+    txs = [transactions.contract(0, 1, 10000, 0, init).sign(k) for k in keys]
+    remote = mine_next_block(genesis, transactions=txs)
+    assert remote.transaction_count == len(txs)
+    expected = [(r, g) for tx, r, g in remote._list_transactions()]
+    # count puts and commits of forked processes
+    writes = multiprocessing.Value('i', 0)
+    pid = os.getpid()
+
+    def counted(method):
+        def wrapper(self, *args):
+            if os.getpid() != pid:
+                with writes.get_lock():
+                    writes.value += 1
+            return method(self, *args)
+        return wrapper
+    monkeypatch.setattr(DB, 'put', counted(DB.put))
+    monkeypatch.setattr(DB, 'commit', counted(DB.commit))
+    replay_pool = parallel.ReplayPool(2)
+    try:
+        stats = dict(parallel.stats)
+        blk, roots = replay(genesis, remote, replay_pool)
+    finally:
+        replay_pool.terminate()
+    assert roots == expected
+    assert parallel.stats['reexecuted'] == stats['reexecuted']  # speculated
+    assert writes.value == 0
+    # the code is stored by the replaying process
+    blk.commit_state()
+    blk.reset_cache()
+    created = utils.sha3(rlp.encode([utils.privtoaddr(keys[0]).decode('hex'), utils.encode_int(0)]))[12:]
+    assert blk.get_code(created) == utils.zpad(utils.encode_int(42), 32)
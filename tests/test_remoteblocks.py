@@ -2,6 +2,7 @@ from pyethereum import blocks
 from pyethereum import processblock
 from pyethereum import rlp
 from pyethereum import transactions
+from pyethereum import tracing
 from pyethereum.config import get_default_config
 import pyethereum.utils as utils
 import logging
@@ -24,6 +25,14 @@ pblogger.log_json = False        # generate machine readable output
 pblogger.log_apply_op = True     # log anything per operation at all
 
 
+@pytest.fixture(autouse=True)
+def trace(monkeypatch):
+    "traces to the debug log while a test of this module runs"
+    monkeypatch.setattr(tracing, 'tracers', tracing.Tracers())
+    monkeypatch.setattr(processblock, 'tracers', tracing.tracers)
+    tracing.tracers.register(pblogger)
+
+
 
 def load_raw():
     "rlp and hex encoded blocks in multiline file,"
@@ -64,6 +64,24 @@ def test_gas_deduction():
 
 
 @pytest.mark.blk42
+def test_recover_senders():
+    import multiprocessing
+    k, v, k2, v2 = accounts()
+    tx = get_transaction()
+    # recovered lazily
+    txs = [transactions.Transaction.deserialize(tx.serialize()) for i in range(3)]
+    assert txs[0]._sender is None and txs[0].sender == v
+    transactions.recover_senders(txs)
+    assert [t._sender for t in txs] == [v] * 3
+    pool = multiprocessing.Pool(2)
+    try:
+        txs = [transactions.Transaction.deserialize(tx.serialize()) for i in range(3)]
+        transactions.recover_senders(txs, pool)
+        assert [t._sender for t in txs] == [v] * 3
+    finally:
+        pool.terminate()
+
+
 def test_deserialize_cpp_block_42():
     # 54.204.10.41 / NEthereum(++)/ZeroGox/v0.5.9/ncurses/Linux/g++ V:17L
     # E       TypeError: ord() expected a character, but string of length 0 found
@@ -163,6 +181,30 @@ def deserialize_child(parent, rlpdata):
     return block
 
 
+def test_sender_cache(monkeypatch):
+    k, v, k2, v2 = accounts()
+    cache = transactions.configure_sender_cache(10)
+    tx = get_transaction()  # signing fills the cache
+    assert len(cache) == 1
+    for i in range(3):
+        assert transactions.Transaction.deserialize(tx.serialize()).sender == v
+    assert cache.hits == 3 and cache.misses == 0
+    cache.clear()
+    recovered = []
+    recover_sender = transactions.recover_sender
+    monkeypatch.setattr(transactions, 'recover_sender',
+                        lambda args: recovered.append(args) or recover_sender(args))
+    txs = [transactions.Transaction.deserialize(tx.serialize()) for i in range(2)]
+    transactions.recover_senders(txs)  # duplicates are recovered once
+    assert [t.sender for t in txs] == [v, v] and len(recovered) == 1
+    assert len(cache) == 1
+    # the same payload signed by another key is another entry
+    tx2 = get_transaction()
+    tx2.sign(k2)
+    assert transactions.Transaction.deserialize(tx2.serialize()).sender == v2
+    transactions.configure_sender_cache(16384)
+
+
 # TODO ##########################################
 #
 # test for remote block with invalid transaction
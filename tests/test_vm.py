@@ -18,6 +18,8 @@ pblogger.log_block = False       # dump block after TX was applied
 pblogger.log_memory = False      # dump memory before each op
 pblogger.log_op = True           # log op, gas, stack before each op
 pblogger.log_json = False        # generate machine readable output
+pb.tracers.register(pblogger)  # trace to the debug log
+pb.debug_mode = True             # check the stack after every op
 
 
 def check_testdata(data_keys, expected_keys):
@@ -73,6 +75,195 @@ def test_SystemOperationsInfo():
 
 
 
+def test_program_analysis():
+    from pyethereum.program import Program
+    from pyethereum.opcodes import reverse_opcodes as op
+    # PUSH2 0x0101 PUSH1 0 JUMPI ADD STOP PUSH1 (truncated)
+    code = ''.join(map(chr, [op['PUSH2'], 1, 1, op['PUSH1'], 0, op['JUMPI'],
+                             op['ADD'], op['STOP'], op['PUSH1']]))
+    p = Program(code)
+    assert len(p) == len(code)
+    assert p.push_values[0] == 257 and p.push_values[3] == 0
+    assert p.push_values[8] == 0 and p.push_values[1] is None
+    # a push immediate which is an opcode itself is decoded as well
+    assert p.ops[1][0] == 'ADD' and p.ops[5][-1] == op['JUMPI']
+    assert pb.get_program(code) is pb.get_program(code[:])
+
+
+def test_code_cache():
+    import pyethereum.db
+    from pyethereum import compiler
+    from pyethereum import dbkeys
+    from pyethereum.program import Program
+    from tests.utils import set_db
+    set_db()
+    code = '\x60\x01' * 3
+    # charged with the analysis, not only the code
+    size = Program(code).size
+    assert size == 6 + 6 * 24 + 3 * 32
+    cache = pb.configure_code_cache(size + 10)
+    codehash = u.encode_hash(code)  # stored like contract code
+    program = pb.get_program(code)
+    assert pb.get_program(code) is program
+    assert cache.hits == 1 and cache.size == size
+    # compiled segments are charged, once the program is used again
+    segment = compiler.get_segment(program, 0)
+    assert program.size == size + segment.size
+    pb.get_program(code)
+    assert codehash not in cache and cache.evictions == 1  # too large now
+    pb.get_program(code)
+    pb.get_program('\x01' * 5)  # evicts
+    assert codehash not in cache and cache.evictions == 2
+    pb.get_program(code)
+    db = pyethereum.db.DB(u.get_db_path())
+    pb.save_code_cache(db)
+    assert dbkeys.HOT_CODE_KEY in db.uncommitted  # committed by the caller
+    cache = pb.configure_code_cache(size + 10)
+    assert pb.load_code_cache(db) == 1  # the other code is not stored
+    assert codehash in cache and cache.hits == 0
+    pb.configure_code_cache(16 * 1024 ** 2)
+
+
+def test_memory_ops():
+    from pyethereum.opcodes import reverse_opcodes as op
+    from tests.utils import set_db
+    set_db()
+    # MSTORE 0x1234 at 0, CALLDATACOPY 3 bytes from 1 to 40, RETURN 0..48
+    code = ''.join(map(chr, [op['PUSH2'], 0x12, 0x34, op['PUSH1'], 0, op['MSTORE'],
+                             op['PUSH1'], 3, op['PUSH1'], 1, op['PUSH1'], 40,
+                             op['CALLDATACOPY'],
+                             op['PUSH1'], 48, op['PUSH1'], 0, op['RETURN']]))
+    blk = blocks.genesis()
+    sender, to = '1' * 40, '2' * 40
+    tx = transactions.Transaction(0, 0, 1000, to, 0, 'abcd')
+    tx.sender = sender
+    msg = pb.Message(u.normalize_address(sender), u.normalize_address(to),
+                     0, 1000, 'abcd')
+    success, gas, output = pb.apply_msg(blk, tx, msg, code)
+    assert success
+    assert output == [0] * 30 + [0x12, 0x34] + [0] * 8 + map(ord, 'bcd') + [0] * 5
+    # 10 ops at 1 gas and 2 words of memory
+    assert gas == 1000 - 10 - 2
+
+
+def test_compiled_segments(monkeypatch):
+    from pyethereum import compiler
+    from pyethereum.opcodes import reverse_opcodes as op
+    from tests.utils import set_db
+    set_db()
+    monkeypatch.setattr(pblogger, 'log_apply_op', False)
+    # acc, i = 0, 10; while i: acc += i; i -= 1; return [GAS, acc]
+    code = ''.join(map(chr, [op['PUSH1'], 0, op['PUSH1'], 10,
+                             op['DUP1'], op['NOT'], op['PUSH1'], 20, op['JUMPI'],
+                             op['SWAP1'], op['DUP2'], op['ADD'], op['SWAP1'],
+                             op['PUSH1'], 1, op['SWAP1'], op['SUB'],
+                             op['PUSH1'], 4, op['JUMP'],
+                             op['POP'], op['GAS'], op['PUSH1'], 0, op['MSTORE'],
+                             op['PUSH1'], 32, op['MSTORE'],
+                             op['PUSH1'], 64, op['PUSH1'], 0, op['RETURN']]))
+    program = pb.get_program(code)
+    segment = compiler.compile_segment(program, 9)
+    assert segment.ops == 9 and 'stk.pop()' in segment.source
+    assert compiler.compile_segment(program, 24) is None  # MSTORE
+
+    def run(code, gas, compiled):
+        monkeypatch.setattr(pb, 'compile_hot_code', compiled)
+        monkeypatch.setattr(pb, 'compile_threshold', 0)
+        blk = blocks.genesis()
+        sender, to = '1' * 40, '2' * 40
+        tx = transactions.Transaction(0, 0, gas, to, 0, '')
+        tx.sender = sender
+        msg = pb.Message(u.normalize_address(sender), u.normalize_address(to),
+                         0, gas, '')
+        return pb.apply_msg(blk, tx, msg, code)
+
+    success, gas, output = run(code, 1000, True)
+    assert success and output[-1] == 55
+    # the ops after GAS cost 7 and 2 words of memory
+    assert u.big_endian_to_int(''.join(map(chr, output[:32]))) == gas + 9
+    assert program.segments[4] is not None
+    # the compiled segments fall back to the interpreter on out of gas
+    for gas in range(0, 170, 7) + [1000]:
+        assert run(code, gas, True) == run(code, gas, False)
+    # and on stack underflow
+    for code in ['\x01', '\x60\x01\x09', '\x60\x01\x01\x60\x00\x56']:
+        assert run(code, 100, True) == run(code, 100, False)
+
+
+def test_differential_mode(monkeypatch):
+    from pyethereum import tester, compiler
+    import serpent
+    monkeypatch.setattr(pblogger, 'log_apply_op', False)
+    monkeypatch.setattr(pb, 'differential_mode', True)
+    s = tester.state()
+    c = s.contract('return(msg.data[0] + msg.data[1] * 3)')
+    assert s.send(tester.k0, c, 0, [2, 5]) == [17]
+    # a broken compiler is detected
+    monkeypatch.setattr(pb, 'code_cache', pb.LRUCache(1024))
+    monkeypatch.setitem(compiler.EXPRESSIONS, 'MUL', '({0} * {1} + 1) % TT256')
+    with pytest.raises(pb.TierMismatch):
+        s.send(tester.k0, c, 0, [2, 5])
+
+
+def test_tracer(monkeypatch):
+    from pyethereum import tracing
+    from tests.utils import set_db
+    set_db()
+    monkeypatch.setattr(tracing, 'tracers', tracing.Tracers())
+    monkeypatch.setattr(pb, 'tracers', tracing.tracers)
+
+    class Recorder(tracing.Tracer):
+        def __init__(self):
+            self.events = []
+
+        def trace(self, name, data):
+            if name == 'OP':  # the objects are live, read them right away
+                data = data['program'].ops[data['compustate'].pc][0]
+            self.events.append((name, data))
+
+    blk = blocks.genesis()
+    sender, to = '1' * 40, '2' * 40
+    tx = transactions.Transaction(0, 0, 100, to, 0, '')
+    tx.sender = sender
+    msg = pb.Message(u.normalize_address(sender), u.normalize_address(to),
+                     0, 100, '')
+    code = '\x60\x01\x60\x02\x01'  # PUSH1 1 PUSH1 2 ADD
+    assert not pb.tracers.enabled
+    recorder = Recorder()
+    pb.tracers.register(recorder)
+    assert pb.tracers.enabled and not pb.tracers.trace_ops
+    pb.apply_msg(blk, tx, msg, code)
+    names = [name for name, data in recorder.events]
+    assert names == ['MSG APPLY', 'MSG PRE STATE', 'MSG APPLIED', 'MSG POST STATE']
+    assert recorder.events[0][1]['msg'] is msg  # structured, not formatted
+    recorder.events, recorder.trace_ops = [], True
+    pb.tracers.update()
+    pb.apply_msg(blk, tx, msg, code)
+    ops = [data for name, data in recorder.events if name == 'OP']
+    assert ops == ['PUSH1', 'PUSH1', 'ADD']
+    pb.tracers.unregister(recorder)
+    assert not pb.tracers.enabled and not pb.tracers.trace_ops
+
+
+def test_debug_mode(monkeypatch, capsys):
+    from tests.utils import set_db
+    set_db()
+    blk = blocks.genesis()
+    sender, to = '1' * 40, '2' * 40
+    tx = transactions.Transaction(0, 0, 100, to, 0, '')
+    tx.sender = sender
+    msg = pb.Message(u.normalize_address(sender), u.normalize_address(to),
+                     0, 100, '')
+    code = '\x60\x05\x80\x50'  # PUSH1 5 DUP1 POP, the debug hint
+    monkeypatch.setattr(pb, 'debug_mode', False)
+    capsys.readouterr()
+    production = pb.apply_msg(blk, tx, msg, code)
+    assert capsys.readouterr()[0] == ''
+    monkeypatch.setattr(pb, 'debug_mode', True)
+    assert pb.apply_msg(blk, tx, msg, code) == production
+    assert capsys.readouterr()[0] == '5\n'
+
+
 def do_test_vm(name):
     logger.debug('running test:%r', name)
     for testname in vm_tests_fixtures(name).keys():
@@ -137,14 +328,15 @@ def do_test_vm(name):
     
         def apply_msg_wrapper(_block, _tx, msg, code):
             apply_message_calls.append(dict(gasLimit=msg.gas, value=msg.value,
-                                            destination=msg.to,
+                                            destination=msg.to.encode('hex'),
                                             data=msg.data.encode('hex')))
             result, gas_rem, data = orig_apply_msg(_block, _tx, msg, code)
             return result, gas_rem, data
 
         pb.apply_msg = apply_msg_wrapper
 
-        msg = pb.Message(tx.sender, tx.to, tx.value, tx.startgas, tx.data)
+        msg = pb.Message(u.normalize_address(tx.sender), u.normalize_address(tx.to),
+                         tx.value, tx.startgas, tx.data)
         blk.delta_balance(exek['caller'], tx.value)
         blk.delta_balance(exek['address'], -tx.value)
 	try:
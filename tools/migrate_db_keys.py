@@ -0,0 +1,32 @@
+#!/usr/bin/env python
+"""
+Migrates the auxiliary indexes of a chain db and the account transactions
+of its indexdb to the compact binary keys, see pyethereum.dbkeys. Usage:
+
+    migrate_db_keys.py [<data_dir>]
+
+The node migrates its db on startup as well, the indexdb is migrated when
+it is opened.
+"""
+import sys
+import logging
+from pyethereum import utils
+from pyethereum import dbkeys
+from pyethereum.db import DB
+
+
+def main():
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    if len(sys.argv) > 1:
+        utils.data_dir.set(sys.argv[1])
+    for path, migrate in ((utils.get_db_path(), dbkeys.migrate),
+                          (utils.get_index_path(), dbkeys.migrate_index)):
+        db = DB(path)
+        if not dbkeys.needs_migration(db):
+            print 'db @ %s is up to date' % path
+            continue
+        print 'migrated %d keys of db @ %s' % (migrate(db), path)
+
+
+if __name__ == '__main__':
+    main()